@@ -1,23 +1,197 @@
 import os
-import base64
+import time
+import json
+import asyncio
+import hashlib
 import tempfile
 import traceback
+import metrics
+import offload
 from logger_setup import logger
-from g4f.client import AsyncClient
+from provider_errors import ProviderError, classify, wrap_error, next_delay, retry_budget
+from config import PROVIDER_CONCURRENCY, AI_STUB_PROVIDERS, RETRY_MAX_ATTEMPTS
 
-async def get_ai_response(provider_name, model, messages, image_bytes=None):
-    """Get response from AI model using g4f."""
+# Класс клиента g4f; импортируется при первом обращении, так как g4f загружается долго
+_async_client_class = None
+
+# Ограничение одновременных запросов к каждому провайдеру
+_provider_semaphores = {}
+
+# Одинаковые запросы, которые сейчас выполняются: ключ -> _InflightCall
+_inflight_calls = {}
+
+
+class _InflightCall:
+    """Общий запрос к провайдеру, результат которого ждут несколько обработчиков."""
+
+    def __init__(self, key, task):
+        self.key = key
+        self.task = task
+        self.waiters = 0
+
+    def detach(self):
+        """Убирает запрос из таблицы, чтобы новые обработчики запускали свой."""
+        if _inflight_calls.get(self.key) is self:
+            del _inflight_calls[self.key]
+
+
+def _get_async_client_class():
+    """Импортирует g4f при первом обращении."""
+    global _async_client_class
+    if _async_client_class is None:
+        if AI_STUB_PROVIDERS:
+            from stub_provider import StubAsyncClient
+            _async_client_class = StubAsyncClient
+            logger.warning("Using local stub providers instead of g4f")
+            return _async_client_class
+        started = time.perf_counter()
+        from g4f.client import AsyncClient
+        _async_client_class = AsyncClient
+        logger.info(f"Imported g4f client in {time.perf_counter() - started:.2f}s")
+    return _async_client_class
+
+
+def set_client_class(client_class):
+    """Подменяет класс клиента (например, на заглушку из stub_provider)."""
+    global _async_client_class
+    _async_client_class = client_class
+
+
+def create_client():
+    """Создает клиент g4f."""
+    return _get_async_client_class()()
+
+
+def preload_client():
+    """Импортирует g4f заранее, чтобы первый запрос пользователя не ждал импорта."""
+    _get_async_client_class()
+
+
+def provider_slot(provider_name):
+    """Семафор, ограничивающий число одновременных запросов к провайдеру."""
+    semaphore = _provider_semaphores.get(provider_name)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(PROVIDER_CONCURRENCY)
+        _provider_semaphores[provider_name] = semaphore
+    return semaphore
+
+
+def _request_key(kind, *parts):
+    """Строит ключ запроса по хешу его содержимого."""
+    payload = json.dumps([kind, *parts], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _is_stateless(messages):
+    """Запрос без истории: только системный промпт и первое сообщение пользователя."""
+    return all(message["role"] != "assistant" for message in messages) and \
+        sum(1 for message in messages if message["role"] == "user") == 1
+
+
+async def _coalesce(key, factory):
+    """
+    Объединяет одинаковые запросы: все ожидающие получают результат одного вызова.
+    Отмена одного ожидающего не затрагивает остальных; запрос к провайдеру
+    отменяется, только когда ушли все ожидающие.
+    """
+    call = _inflight_calls.get(key)
+    if call is None:
+        call = _InflightCall(key, asyncio.ensure_future(factory()))
+        _inflight_calls[key] = call
+        call.task.add_done_callback(lambda _: call.detach())
+    else:
+        logger.debug(f"Joined in-flight request {key[:12]} ({call.waiters} waiters)")
+
+    call.waiters += 1
+    try:
+        return await asyncio.shield(call.task)
+    finally:
+        call.waiters -= 1
+        if call.waiters == 0 and not call.task.done():
+            logger.debug(f"All waiters left request {key[:12]}, cancelling it")
+            call.detach()
+            call.task.cancel()
+
+
+async def get_ai_response(provider_name, model, messages, image_bytes=None, retry=True):
+    """Get response from AI model using g4f. retry=False disables retries of transient errors."""
+    # История хранится компактно; список словарей для провайдера создается только здесь.
+    # Это же копия: история пользователя может измениться, пока идет запрос
+    messages = messages.to_messages() if hasattr(messages, "to_messages") else list(messages)
+    if image_bytes is None and _is_stateless(messages):
+        key = _request_key("chat", provider_name, model, messages)
+        return await _coalesce(key, lambda: _request_ai_response(provider_name, model, messages, retry=retry))
+    return await _request_ai_response(provider_name, model, messages, image_bytes, retry)
+
+
+async def _with_retries(provider_name, model, attempt, max_attempts=RETRY_MAX_ATTEMPTS):
+    """
+    Выполняет attempt(), повторяя временные ошибки с декоррелированным интервалом,
+    пока есть попытки и общий бюджет повторов. Ошибки выбрасываются как ProviderError.
+    """
+    # Бюджет пополняют только запросы, которым разрешены повторы: проверки
+    # доступности (max_attempts=1) не должны оплачивать повторы пользователей
+    if max_attempts > 1:
+        retry_budget.record_request()
+    delay = 0.0
+    for attempt_number in range(1, max_attempts + 1):
+        try:
+            return await attempt()
+        except Exception as e:
+            error = wrap_error(e, provider_name, model)
+            can_retry = error.transient and attempt_number < max_attempts
+            if can_retry and not retry_budget.try_spend():
+                metrics.increment("provider_retry_budget_exhausted", provider=provider_name or "auto")
+                logger.warning(f"Retry budget exhausted, not retrying {error.category} error from {provider_name}/{model}")
+                can_retry = False
+            if not can_retry:
+                if error is e:
+                    raise
+                raise error from e
+            
+            delay = next_delay(delay)
+            metrics.increment("provider_retries", provider=provider_name or "auto", category=error.category)
+            logger.warning(
+                f"Transient {error.category} error from {provider_name}/{model}, "
+                f"retry {attempt_number} of {max_attempts - 1} in {delay:.1f}s: {str(error)}"
+            )
+            await asyncio.sleep(delay)
+
+
+async def _request_ai_response(provider_name, model, messages, image_bytes=None, retry=True):
+    """Send a request to the AI model, retrying transient errors."""
+    return await _with_retries(
+        provider_name,
+        model,
+        lambda: _attempt_ai_response(provider_name, model, messages, image_bytes),
+        RETRY_MAX_ATTEMPTS if retry else 1,
+    )
+
+
+async def _attempt_ai_response(provider_name, model, messages, image_bytes=None):
+    """Send a single request to the AI model using g4f."""
+    async with provider_slot(provider_name):
+        return await _send_ai_request(provider_name, model, messages, image_bytes)
+
+
+def _write_temp_image(image_bytes):
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as temp_file:
+        temp_file.write(image_bytes)
+        return temp_file.name
+
+
+async def _send_ai_request(provider_name, model, messages, image_bytes=None):
     try:
         # Создаем AsyncClient
-        client = AsyncClient()
+        client = create_client()
         logger.debug(f"Created AsyncClient for {provider_name}/{model}")
         
         # Подготавливаем запрос в зависимости от наличия изображения
         if image_bytes:
             try:
                 # Для работы с изображениями используем base64 кодирование
-                # Конвертируем байты изображения в base64
-                base64_image = base64.b64encode(image_bytes).decode('utf-8')
+                # Конвертируем байты изображения в base64 вне цикла событий
+                base64_image = await offload.run_cpu(offload.encode_base64, image_bytes)
                 logger.debug(f"Encoded image to base64, size: {len(base64_image)}")
                 
                 # Формируем содержимое сообщения с изображением
@@ -44,12 +218,13 @@ async def get_ai_response(provider_name, model, messages, image_bytes=None):
                     stream=False
                 )
             except Exception as img_err:
+                # Временную ошибку повторит _with_retries; другой формат нужен только при несовместимости
+                if classify(img_err)[1]:
+                    raise
                 logger.warning(f"Error using content format for image: {str(img_err)}. Trying alternative method...")
                 
                 # Сохраняем изображение во временный файл
-                with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as temp_file:
-                    temp_file.write(image_bytes)
-                    temp_path = temp_file.name
+                temp_path = await offload.run_io(_write_temp_image, image_bytes)
                 
                 logger.debug(f"Saved image to temporary file: {temp_path}")
                 
@@ -67,7 +242,7 @@ async def get_ai_response(provider_name, model, messages, image_bytes=None):
                 finally:
                     # Удаляем временный файл
                     try:
-                        os.unlink(temp_path)
+                        await offload.run_io(os.unlink, temp_path)
                         logger.debug(f"Deleted temporary file: {temp_path}")
                     except Exception as e:
                         logger.warning(f"Failed to delete temp file {temp_path}: {str(e)}")
@@ -83,6 +258,8 @@ async def get_ai_response(provider_name, model, messages, image_bytes=None):
         
         # Извлекаем текст ответа
         result = response.choices[0].message.content
+        if not result:
+            raise ProviderError("Empty response", provider_name, model, "empty_response", transient=True)
         logger.debug(f"Received response from {provider_name}/{model}, length: {len(result)}")
         return result
         
@@ -91,11 +268,32 @@ async def get_ai_response(provider_name, model, messages, image_bytes=None):
         logger.debug(traceback.format_exc())
         raise
 
-async def generate_image(provider_name, model, prompt):
-    """Generate image using g4f."""
+async def generate_image(provider_name, model, prompt, variant=0, retry=True):
+    """Generate image using g4f.
+
+    Разные значения variant дают независимые запросы с одинаковым промптом.
+    """
+    key = _request_key("image", model, prompt, variant)
+    return await _coalesce(key, lambda: _generate_image(provider_name, model, prompt, retry))
+
+
+async def _generate_image(provider_name, model, prompt, retry=True):
+    """Generate an image, retrying transient errors."""
+    return await _with_retries(
+        provider_name, model, lambda: _attempt_image(provider_name, model, prompt), RETRY_MAX_ATTEMPTS if retry else 1
+    )
+
+
+async def _attempt_image(provider_name, model, prompt):
+    """Send a single image generation request using g4f."""
+    async with provider_slot(provider_name):
+        return await _send_image_request(provider_name, model, prompt)
+
+
+async def _send_image_request(provider_name, model, prompt):
     try:
         logger.info(f"Generating image with {provider_name}/{model}, prompt: '{prompt[:50]}...'")
-        client = AsyncClient()
+        client = create_client()
     
         response = await client.images.generate(
             prompt=prompt,
@@ -104,6 +302,8 @@ async def generate_image(provider_name, model, prompt):
             provider=None,
             response_format="url"
         )
+        if not response.data or not response.data[0].url:
+            raise ProviderError("Empty image response", provider_name, model, "empty_response", transient=True)
         image_url = response.data[0].url
         
         logger.debug(f"Generated image URL: {image_url}")
@@ -112,4 +312,6 @@ async def generate_image(provider_name, model, prompt):
     except Exception as e:
         logger.error(f"Error generating image with {model}: {str(e)}")
         logger.debug(traceback.format_exc())
-        raise Exception(f"Не удалось сгенерировать изображение: {str(e)}") 
\ No newline at end of file
+        # Категория определяется по исходной ошибке, а пользователь видит привычный текст
+        category, transient = classify(e)
+        raise ProviderError(f"Не удалось сгенерировать изображение: {str(e)}", provider_name, model, category, transient) from e 
\ No newline at end of file
@@ -0,0 +1,275 @@
+"""
+Замер задержки моделей и провайдеров из models.json.
+
+    python benchmark.py [--type text|image|all] [--model ID ...] [--repeat 3] [--concurrency 4]
+    python benchmark.py --stub [--stub-latency 0.2] [--stub-failure-rate 0.1]
+
+Для каждой модели выполняется набор запросов: короткий вопрос, длинная
+история разговора, вопрос об изображении (для моделей с vision) и промпт
+для генерации изображения (для моделей изображений). Ответы текстовых
+моделей читаются потоком, поэтому измеряется время до первого токена.
+Запросы отправляются без повторов, чтобы была видна доля ошибок.
+
+В отчете модели каждого типа упорядочены по доле успешных запросов и
+медианной задержке; для каждой модели предлагается "timeout" для
+models.json и задержка, после которой имеет смысл отправлять дублирующий
+запрос. С --stub вместо g4f используется локальная заглушка, и скрипт
+работает без сети.
+"""
+import sys
+import json
+import math
+import time
+import zlib
+import struct
+import asyncio
+import argparse
+import base64
+
+import ai_client
+import stub_provider
+from provider_errors import classify
+from model_registry import validate_models_config
+from config import MODELS_FILE, REQUEST_TIMEOUT, IMAGE_REQUEST_TIMEOUT
+
+SHORT_CHAT = [{"role": "user", "content": "Ответь одним предложением: почему небо голубое?"}]
+IMAGE_PROMPT = "A lighthouse on a rocky coast at sunset, oil painting"
+VISION_QUESTION = "Опиши, что изображено на картинке, в одном предложении."
+
+# Грубая оценка числа токенов по длине текста (как в квотах)
+CHARS_PER_TOKEN = 4
+
+
+def long_context_messages(turns=12):
+    """Длинная история разговора (около 10 тысяч символов) с вопросом по ее началу."""
+    paragraph = (
+        "Проект переносит обработку заказов из монолита в отдельные сервисы. "
+        "Каждый сервис хранит свои данные, а события передаются через очередь сообщений. "
+    )
+    messages = [{"role": "system", "content": "Ты помогаешь инженеру разобраться в архитектуре проекта."}]
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"Часть {turn + 1}. " + paragraph * 4})
+        messages.append({"role": "assistant", "content": f"Понял часть {turn + 1}. " + paragraph * 2})
+    messages.append({"role": "user", "content": "Кратко: как сервисы обмениваются событиями?"})
+    return messages
+
+
+def test_image_png(size=64):
+    """Небольшое PNG-изображение (градиент), собранное без сторонних библиотек."""
+    rows = b"".join(
+        b"\x00" + bytes(value for x in range(size) for value in (x * 4 % 256, y * 4 % 256, 128))
+        for y in range(size)
+    )
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+
+def vision_messages():
+    image_url = "data:image/png;base64," + base64.b64encode(test_image_png()).decode("ascii")
+    return [{"role": "user", "content": [
+        {"type": "text", "text": VISION_QUESTION},
+        {"type": "image_url", "image_url": {"url": image_url}},
+    ]}]
+
+
+def build_cases(models_config, model_type, selected):
+    """Список (тип, модель, провайдер, сценарий, запрос) для выбранных моделей."""
+    cases = []
+    for current_type in ("text", "image"):
+        if model_type not in (current_type, "all"):
+            continue
+        for model_id, model_info in models_config[current_type].items():
+            if selected and model_id not in selected:
+                continue
+            provider = model_info["provider"]
+            timeout = model_info.get("timeout", IMAGE_REQUEST_TIMEOUT if current_type == "image" else REQUEST_TIMEOUT)
+            if current_type == "image":
+                cases.append((current_type, model_id, provider, "image_prompt", IMAGE_PROMPT, timeout))
+                continue
+            cases.append((current_type, model_id, provider, "short_chat", SHORT_CHAT, timeout))
+            cases.append((current_type, model_id, provider, "long_context", long_context_messages(), timeout))
+            if model_info.get("vision"):
+                cases.append((current_type, model_id, provider, "vision", vision_messages(), timeout))
+    return cases
+
+
+async def stream_chat(provider, model, messages):
+    """Запрос с потоковым ответом. Возвращает (время до первого токена, текст)."""
+    started = time.perf_counter()
+    first_token = None
+    parts = []
+    client = ai_client.create_client()
+    async for chunk in client.chat.completions.create(model=model, messages=messages, provider=provider, stream=True):
+        content = chunk.choices[0].delta.content if chunk.choices else None
+        if content:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            parts.append(content)
+    text = "".join(parts)
+    if not text:
+        raise ValueError("Empty response")
+    return first_token, text
+
+
+async def generate_image(provider, model, prompt):
+    client = ai_client.create_client()
+    response = await client.images.generate(prompt=prompt, model=model, provider=None, response_format="url")
+    if not response.data or not response.data[0].url:
+        raise ValueError("Empty image response")
+    return response.data[0].url
+
+
+async def run_case(semaphore, case, timeout_override):
+    model_type, model, provider, scenario, request, timeout = case
+    result = {"type": model_type, "model": model, "provider": provider, "scenario": scenario,
+              "ok": False, "ttft": None, "latency": None, "tokens": 0, "error": None}
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            if model_type == "image":
+                await asyncio.wait_for(generate_image(provider, model, request), timeout_override or timeout)
+            else:
+                ttft, text = await asyncio.wait_for(stream_chat(provider, model, request), timeout_override or timeout)
+                result["ttft"] = ttft
+                result["tokens"] = len(text) // CHARS_PER_TOKEN
+            result["ok"] = True
+        except Exception as e:
+            result["error"] = classify(e)[0]
+        result["latency"] = time.perf_counter() - started
+    status = "ok" if result["ok"] else result["error"]
+    print(f"  {model:<28} {scenario:<13} {result['latency']:7.2f}s {status}", file=sys.stderr)
+    return result
+
+
+def percentile(values, fraction):
+    """Процентиль по ближайшему рангу; None для пустого списка."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(len(values) * fraction) - 1))]
+
+
+def summarize(results):
+    """Сводка по моделям: доля успехов, задержки, скорость, ошибки и предложения по срокам."""
+    by_model = {}
+    for result in results:
+        by_model.setdefault((result["type"], result["model"]), []).append(result)
+
+    summaries = []
+    for (model_type, model), runs in by_model.items():
+        successes = [run for run in runs if run["ok"]]
+        latencies = [run["latency"] for run in successes]
+        ttfts = [run["ttft"] for run in successes if run["ttft"] is not None]
+        streaming = [run for run in successes if run["ttft"] is not None and run["latency"] > run["ttft"]]
+        errors = {}
+        for run in runs:
+            if not run["ok"]:
+                errors[run["error"]] = errors.get(run["error"], 0) + 1
+
+        p99 = percentile(latencies, 0.99)
+        # Срок с запасом над самым медленным успешным ответом, с шагом 5 секунд
+        suggested_timeout = max(10, math.ceil(p99 * 1.5 / 5) * 5) if p99 is not None else None
+        # Дублирующий запрос отправляется, если первый не начал отвечать дольше обычного (p95)
+        hedge_source = ttfts if ttfts else latencies
+        hedge_delay = percentile(hedge_source, 0.95)
+        summaries.append({
+            "type": model_type,
+            "model": model,
+            "provider": runs[0]["provider"],
+            "runs": len(runs),
+            "success_rate": len(successes) / len(runs),
+            "ttft_p50": percentile(ttfts, 0.5),
+            "ttft_p95": percentile(ttfts, 0.95),
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "tokens_per_second": (
+                sum(run["tokens"] for run in streaming) / sum(run["latency"] - run["ttft"] for run in streaming)
+                if streaming else None
+            ),
+            "errors": errors,
+            "suggested_timeout": suggested_timeout,
+            "suggested_hedge_delay": round(hedge_delay, 1) if hedge_delay is not None else None,
+        })
+    summaries.sort(key=lambda s: (s["type"] != "text", -s["success_rate"], s["latency_p50"] if s["latency_p50"] is not None else math.inf))
+    return summaries
+
+
+def _seconds(value):
+    return f"{value:.2f}" if value is not None else "-"
+
+
+def print_report(summaries):
+    for model_type in ("text", "image"):
+        rows = [summary for summary in summaries if summary["type"] == model_type]
+        if not rows:
+            continue
+        print(f"\n{model_type.capitalize()} models (best first):")
+        print(f"{'#':>2} {'model':<28} {'provider':<16} {'ok':>5} {'ttft p50':>9} {'ttft p95':>9} "
+              f"{'lat p50':>8} {'lat p95':>8} {'tok/s':>7}  errors")
+        for rank, row in enumerate(rows, 1):
+            errors = ", ".join(f"{category}: {count}" for category, count in sorted(row["errors"].items())) or "-"
+            tokens_per_second = f"{row['tokens_per_second']:.0f}" if row["tokens_per_second"] else "-"
+            print(f"{rank:>2} {row['model']:<28} {row['provider']:<16} {row['success_rate']:>5.0%} "
+                  f"{_seconds(row['ttft_p50']):>9} {_seconds(row['ttft_p95']):>9} "
+                  f"{_seconds(row['latency_p50']):>8} {_seconds(row['latency_p95']):>8} {tokens_per_second:>7}  {errors}")
+
+    print("\nSuggested settings for models.json (timeout) and hedge delays, seconds:")
+    for row in summaries:
+        if row["suggested_timeout"] is None:
+            print(f"  {row['type']}/{row['model']}: no successful requests")
+        else:
+            print(f"  {row['type']}/{row['model']}: \"timeout\": {row['suggested_timeout']}, "
+                  f"hedge after {row['suggested_hedge_delay']}")
+
+
+async def run_benchmark(cases, repeat, concurrency, timeout_override):
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [run_case(semaphore, case, timeout_override) for _ in range(repeat) for case in cases]
+    return await asyncio.gather(*tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency benchmark of models from models.json")
+    parser.add_argument("--models-file", default=str(MODELS_FILE), help="models configuration (default: %(default)s)")
+    parser.add_argument("--type", choices=("text", "image", "all"), default="all", help="which models to test")
+    parser.add_argument("--model", action="append", default=[], help="test only this model (can be repeated)")
+    parser.add_argument("--repeat", type=int, default=3, help="requests per model and scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight at once")
+    parser.add_argument("--timeout", type=float, default=None, help="override per-model timeouts, seconds")
+    parser.add_argument("--json", dest="json_path", help="also write raw results and summary to this file")
+    parser.add_argument("--stub", action="store_true", help="use the local stub provider instead of g4f (no network)")
+    parser.add_argument("--stub-latency", type=float, default=None, help="stub: response latency, seconds")
+    parser.add_argument("--stub-failure-rate", type=float, default=None, help="stub: fraction of failing requests")
+    args = parser.parse_args()
+
+    with open(args.models_file, "r", encoding="utf-8") as f:
+        models_config = validate_models_config(json.load(f))
+    if args.stub:
+        ai_client.set_client_class(stub_provider.StubAsyncClient)
+        stub_provider.set_behavior(latency=args.stub_latency, failure_rate=args.stub_failure_rate)
+    else:
+        ai_client.preload_client()
+
+    cases = build_cases(models_config, args.type, set(args.model))
+    if not cases:
+        parser.error("no models selected")
+    print(f"Running {len(cases) * args.repeat} requests ({len(cases)} cases x {args.repeat}) "
+          f"with concurrency {args.concurrency}{' against the stub' if args.stub else ''}", file=sys.stderr)
+
+    started = time.perf_counter()
+    results = asyncio.run(run_benchmark(cases, args.repeat, args.concurrency, args.timeout))
+    summaries = summarize(results)
+    print(f"Finished in {time.perf_counter() - started:.1f}s")
+    print_report(summaries)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "summary": summaries}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,50 @@
+import time
+
+# Профиль импорта: время загрузки основных зависимостей при запуске
+_import_profile = []
+_import_started = time.perf_counter()
+
+import asyncio
+from telegram import Update
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters
 )
+_import_profile.append(("telegram.ext", time.perf_counter() - _import_started))
 
-from logger_setup import logger
-from config import TOKEN
+from logger_setup import logger, setup_logging
+import offload
+import metrics
+import memory_report
+from config import (
+    TOKEN,
+    load_config,
+    TELEGRAM_CONNECTION_POOL_SIZE,
+    TELEGRAM_GET_UPDATES_POOL_SIZE,
+    TELEGRAM_CONNECT_TIMEOUT,
+    TELEGRAM_READ_TIMEOUT,
+    TELEGRAM_WRITE_TIMEOUT,
+    TELEGRAM_POOL_TIMEOUT,
+    TELEGRAM_POLL_TIMEOUT,
+    TELEGRAM_POLL_INTERVAL,
+    TELEGRAM_CONCURRENT_UPDATES,
+    TELEGRAM_BASE_URL,
+    TELEGRAM_BASE_FILE_URL,
+    TELEGRAM_LOCAL_MODE,
+    MEMORY_TRACE_ON_START,
+)
+from ai_client import preload_client
+from model_registry import model_registry
+from provider_health import provider_health
+from state_persistence import IncrementalPersistence
+from session_preloader import preload_hot_sessions
+from quota import quota_manager
+from message_debouncer import message_debouncer, flush_pending_messages
+from request_tracker import serialize_per_user
 from bot_handlers import (
     start, 
     help_command, 
@@ -20,49 +57,153 @@ from bot_handlers import (
     setup_commands,
     translate,
     language,
-    handle_language_selection
+    handle_language_selection,
+    memory_command,
+    metrics_command,
+    compare_command,
+    handle_compare_callback
 )
+_import_profile.append(("bot modules", time.perf_counter() - _import_started - _import_profile[-1][1]))
+
+async def post_init(application) -> None:
+    """Run startup work that should not delay polling."""
+    await setup_commands(application)
+    
+    # g4f загружается в фоне, пока бот уже принимает обновления
+    application.create_task(asyncio.to_thread(preload_client))
+    
+    # models.json перечитывается без перезапуска: по изменению файла или по SIGHUP
+    model_registry.install_signal_handler()
+    application.create_task(model_registry.watch())
+    
+    # Фоновая проверка провайдеров; первая проверка заодно прогревает соединения
+    application.create_task(provider_health.run())
+    
+    # Отчет о памяти в лог по SIGUSR1
+    memory_report.install_signal_handler()
+    
+    # Задержка цикла событий попадает в метрики
+    application.create_task(offload.monitor_loop_lag())
+    
+    # Сводка метрик периодически пишется в лог
+    application.create_task(metrics.log_periodically())
+    
+    # Использование квот групповых чатов
+    await offload.run_io(quota_manager.load)
+    
+    # Сессии недавно активных пользователей загружаются заранее
+    application.create_task(preload_hot_sessions())
+
+async def post_stop(application) -> None:
+    """Answer merged messages that were still waiting while the bot can send replies."""
+    await message_debouncer.flush_all()
+
+async def post_shutdown(application) -> None:
+    """Finish queued session writes before exit."""
+    await offload.drain()
+    offload.shutdown()
+
+def report_import_profile() -> None:
+    """Log how long startup imports took."""
+    total = time.perf_counter() - _import_started
+    details = ", ".join(f"{name}: {seconds:.3f}s" for name, seconds in _import_profile)
+    logger.info(f"Startup import profile: {details}; total before polling: {total:.3f}s")
+
+def build_application() -> Application:
+    """Create the Application with transport settings from the environment."""
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        # Пул для ответов пользователям
+        .connection_pool_size(TELEGRAM_CONNECTION_POOL_SIZE)
+        .connect_timeout(TELEGRAM_CONNECT_TIMEOUT)
+        .read_timeout(TELEGRAM_READ_TIMEOUT)
+        .write_timeout(TELEGRAM_WRITE_TIMEOUT)
+        .pool_timeout(TELEGRAM_POOL_TIMEOUT)
+        # Отдельный пул для длинного опроса, чтобы он не занимал соединения для ответов
+        .get_updates_connection_pool_size(TELEGRAM_GET_UPDATES_POOL_SIZE)
+        .get_updates_connect_timeout(TELEGRAM_CONNECT_TIMEOUT)
+        .get_updates_pool_timeout(TELEGRAM_POOL_TIMEOUT)
+        # Обновления разных пользователей обрабатываются параллельно, обновления
+        # одного пользователя - по очереди (request_tracker.serialize_per_user)
+        .concurrent_updates(TELEGRAM_CONCURRENT_UPDATES)
+        # Состояние многошаговых сценариев переживает перезапуск
+        .persistence(IncrementalPersistence())
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    if TELEGRAM_BASE_FILE_URL:
+        builder = builder.base_file_url(TELEGRAM_BASE_FILE_URL)
+    if TELEGRAM_LOCAL_MODE:
+        builder = builder.local_mode(True)
+    
+    logger.info(
+        f"Telegram transport: pool {TELEGRAM_CONNECTION_POOL_SIZE} (+{TELEGRAM_GET_UPDATES_POOL_SIZE} for updates), "
+        f"API {TELEGRAM_BASE_URL or 'default'}, local mode: {TELEGRAM_LOCAL_MODE}"
+    )
+    return builder.build()
 
 def main() -> None:
     """Start the bot."""
+    setup_logging()
+    if MEMORY_TRACE_ON_START:
+        memory_report.start_tracing()
+    load_config()
+    model_registry.load()
+    report_import_profile()
+    
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TOKEN).build()
+    application = build_application()
 
+    # Команды и фото сначала отправляют накопленные сообщения пользователя (группа -1 идет раньше остальных)
+    application.add_handler(TypeHandler(Update, serialize_per_user(flush_pending_messages)), group=-1)
+    
     # Add command handlers for all chat types
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("newchat", new_chat))
-    application.add_handler(CommandHandler("image", image_mode))
-    application.add_handler(CommandHandler("translate", translate))
-    application.add_handler(CommandHandler("language", language))
+    application.add_handler(CommandHandler("start", serialize_per_user(start)))
+    application.add_handler(CommandHandler("help", serialize_per_user(help_command)))
+    application.add_handler(CommandHandler("newchat", serialize_per_user(new_chat)))
+    application.add_handler(CommandHandler("image", serialize_per_user(image_mode)))
+    application.add_handler(CommandHandler("translate", serialize_per_user(translate)))
+    application.add_handler(CommandHandler("language", serialize_per_user(language)))
+    application.add_handler(CommandHandler("memory", serialize_per_user(memory_command)))
+    application.add_handler(CommandHandler("metrics", serialize_per_user(metrics_command)))
+    application.add_handler(CommandHandler("compare", serialize_per_user(compare_command)))
     
     # Add callback query handlers
-    application.add_handler(CallbackQueryHandler(handle_model_selection, pattern="^model:"))
-    application.add_handler(CallbackQueryHandler(handle_system_prompt_choice, pattern="^systemprompt:"))
-    application.add_handler(CallbackQueryHandler(handle_language_selection, pattern="^lang:"))
+    application.add_handler(CallbackQueryHandler(serialize_per_user(handle_model_selection), pattern="^model:"))
+    application.add_handler(CallbackQueryHandler(serialize_per_user(handle_system_prompt_choice), pattern="^systemprompt:"))
+    application.add_handler(CallbackQueryHandler(serialize_per_user(handle_language_selection), pattern="^lang:"))
+    application.add_handler(CallbackQueryHandler(serialize_per_user(handle_compare_callback), pattern="^compare:"))
     
     # Add message handler for photos
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    application.add_handler(MessageHandler(filters.PHOTO, serialize_per_user(handle_photo)))
     
     # Add message handler for text in private chats
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, 
-        handle_message
+        serialize_per_user(handle_message)
     ))
     
     # Add message handler for text in group chats
     # Будет обрабатываться в handle_message через проверку упоминания или ответа
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND & filters.ChatType.GROUPS, 
-        handle_message
+        serialize_per_user(handle_message)
     ))
 
-    # Setup menu commands when bot starts
-    application.post_init = setup_commands
+    # Setup menu commands and background startup work when bot starts
+    application.post_init = post_init
+    application.post_stop = post_stop
+    application.post_shutdown = post_shutdown
 
     logger.info("Starting bot...")
     # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    # Таймаут чтения get_updates из билдера run_polling не учитывает, поэтому он передается явно
+    application.run_polling(
+        poll_interval=TELEGRAM_POLL_INTERVAL,
+        timeout=TELEGRAM_POLL_TIMEOUT,
+        read_timeout=TELEGRAM_READ_TIMEOUT,
+    )
     logger.info("Bot stopped")
 
 if __name__ == "__main__":
@@ -1,11 +1,28 @@
+import os
+import time
+import asyncio
 import traceback
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeAllPrivateChats, BotCommandScopeAllGroupChats
+from pathlib import Path
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, BotCommand, BotCommandScopeAllPrivateChats, BotCommandScopeAllGroupChats
+from telegram.error import TelegramError
 from telegram.ext import ContextTypes
 
+import outbox
+import offload
+import metrics
+import memory_report
 from logger_setup import logger
-from config import MODELS_CONFIG
-from session import user_sessions, save_user_session, get_or_create_session, UserSession
+from config import IMAGE_MAX_VARIANTS, IMAGE_VARIANTS_TIMEOUT, HEALTH_HIDE_UNAVAILABLE, TELEGRAM_LOCAL_MODE, ADMIN_IDS, MESSAGE_DEBOUNCE_WINDOW, COMPARE_MAX_MODELS
+from model_registry import model_registry
+from session import user_sessions, save_user_session, get_or_create_session_async
 from ai_client import get_ai_response, generate_image
+from image_cache import image_cache
+from prompt_registry import prompt_registry
+from provider_health import provider_health
+from translation_batcher import translation_batcher
+from request_tracker import run_user_request, cancel_user_request, RequestSuperseded
+from quota import quota_manager, estimate_tokens, rejection_text, QuotaExceeded
+from message_debouncer import message_debouncer
 from translations import get_text, TRANSLATIONS
 
 async def setup_commands(application):
@@ -14,6 +31,7 @@ async def setup_commands(application):
         BotCommand("newchat", "Начать новый текстовый разговор"),
         BotCommand("image", "Генерация изображений"),
         BotCommand("translate", "Перевод текста"),
+        BotCommand("compare", "Сравнить ответы моделей"),
         BotCommand("language", "Изменить язык интерфейса"),
         BotCommand("help", "Показать справку"),
     ]
@@ -31,6 +49,20 @@ async def setup_commands(application):
     
     logger.info("Bot commands menu has been set up for private and group chats")
 
+async def download_file(telegram_file):
+    """
+    Получает содержимое файла. С собственным сервером Bot API в локальном режиме
+    file_path указывает на файл на диске, и он читается в пуле потоков без HTTP.
+    """
+    file_path = telegram_file.file_path
+    if TELEGRAM_LOCAL_MODE and file_path and os.path.isabs(file_path):
+        return bytearray(await offload.run_io(Path(file_path).read_bytes))
+    return await telegram_file.download_as_bytearray()
+
+def model_selection_keyboard(model_type):
+    """Клавиатура выбора модели с учетом доступности провайдеров."""
+    return model_registry.keyboard(model_type, provider_health.unavailable(model_type), HEALTH_HIDE_UNAVAILABLE)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     user_id = update.effective_user.id
@@ -38,10 +70,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info(f"User {user_id} (@{username}) started the bot")
     
     # Initialize user session
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
-    await update.message.reply_text(get_text("welcome", lang))
+    await outbox.reply_text(update.message, get_text("welcome", lang))
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a more informative help message when the command /help is issued."""
@@ -49,7 +81,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     logger.info(f"User {user_id} requested help")
     
     # Get user session for language
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
     help_text = (
@@ -58,38 +90,56 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         get_text("help_instructions", lang)
     )
     
-    await update.message.reply_text(help_text, parse_mode="Markdown")
+    await outbox.reply_text(update.message, help_text, parse_mode="Markdown")
     logger.debug(f"Sent detailed help message to user {user_id}")
 
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the memory report to an administrator (/memory)."""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        logger.warning(f"User {user_id} requested memory report but is not an administrator")
+        return
+    
+    logger.info(f"Administrator {user_id} requested memory report")
+    report = await memory_report.build_report()
+    await outbox.reply_text(update.message, report)
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the metrics summary to an administrator (/metrics)."""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        logger.warning(f"User {user_id} requested metrics but is not an administrator")
+        return
+    
+    logger.info(f"Administrator {user_id} requested metrics")
+    await outbox.reply_text(update.message, metrics.format_snapshot())
+
 async def new_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Start a new chat session and ask user to choose a model."""
     user_id = update.effective_user.id
     logger.info(f"User {user_id} started new chat")
     
+    # Ответ на запрос из старого чата больше не нужен
+    cancel_user_request(user_id, reason="new chat")
+    
     # Initialize user session
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
-    # Create buttons for text models
-    keyboard = []
-    for model_id, model_info in MODELS_CONFIG["text"].items():
-        display_name = model_info.get("display_name", model_id)
-        keyboard.append([InlineKeyboardButton(display_name, callback_data=f"model:text:{model_id}")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(get_text("select_text_model", lang), reply_markup=reply_markup)
+    await outbox.reply_text(update.message, get_text("select_text_model", lang), reply_markup=model_selection_keyboard("text"))
     logger.debug(f"Sent model selection menu to user {user_id}")
 
 async def image_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Switch to image generation mode and ask user to choose a model."""
     user_id = update.effective_user.id
     logger.info(f"User {user_id} switched to image mode")
+    cancel_user_request(user_id, reason="image mode")
     
     # Определяем тип чата
     is_group_chat = update.effective_chat.type in ["group", "supergroup"]
     
     # Initialize user session
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
     # В групповом чате сбрасываем флаг генерации изображения при каждом вызове команды /image
@@ -97,14 +147,20 @@ async def image_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         session.group_image_generated = False
         logger.debug(f"Reset group_image_generated flag for user {user_id} in group chat")
     
-    # Create buttons for image models
-    keyboard = []
-    for model_id, model_info in MODELS_CONFIG["image"].items():
-        display_name = model_info.get("display_name", model_id)
-        keyboard.append([InlineKeyboardButton(display_name, callback_data=f"model:image:{model_id}")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(get_text("select_image_model", lang), reply_markup=reply_markup)
+    # /image N [модель ...] — генерировать N вариантов, при необходимости разными моделями
+    if context.args:
+        count_arg, *model_args = context.args
+        if count_arg.isdigit():
+            count = max(1, min(int(count_arg), IMAGE_MAX_VARIANTS))
+            session.set_image_variants(count, model_args)
+            await outbox.reply_text(update.message, get_text(
+                "image_variants_set",
+                lang,
+                count,
+                ", ".join(model_registry.display_name("image", m) for m in session.image_variant_models) or "-"
+            ))
+    
+    await outbox.reply_text(update.message, get_text("select_image_model", lang), reply_markup=model_selection_keyboard("image"))
     logger.debug(f"Sent image model selection menu to user {user_id}")
     
     save_user_session(user_id)
@@ -115,7 +171,7 @@ async def language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info(f"User {user_id} requested language change")
     
     # Initialize user session
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     current_lang = session.get_interface_language()
     
     # Create buttons for language selection
@@ -131,7 +187,7 @@ async def language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         keyboard.append([InlineKeyboardButton(button_text, callback_data=f"lang:{lang_code}")])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(get_text("language_selection", current_lang), reply_markup=reply_markup)
+    await outbox.reply_text(update.message, get_text("language_selection", current_lang), reply_markup=reply_markup)
     logger.debug(f"Sent language selection menu to user {user_id}")
 
 async def handle_language_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -147,7 +203,7 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
     _, lang_code = callback_data.split(":", 1)
     
     # Get user session and set language
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     session.set_interface_language(lang_code)
     save_user_session(user_id)
     
@@ -156,7 +212,7 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
     lang_name = get_text(lang_name_key, lang_code)
     
     # Confirm language change in the new selected language
-    await query.edit_message_text(get_text("language_set", lang_code, lang_name))
+    await outbox.edit_message_text(query, get_text("language_set", lang_code, lang_name))
     logger.debug(f"User {user_id} changed interface language to {lang_code}")
 
 async def handle_model_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -172,26 +228,29 @@ async def handle_model_selection(update: Update, context: ContextTypes.DEFAULT_T
     is_group_chat = update.effective_chat.type in ["group", "supergroup"]
     
     # Get user session for language
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
     # Extract model type and name from callback data
     _, model_type, model_name = callback_data.split(":", 2)
+    cancel_user_request(user_id, reason="model changed")
     
-    # Set the model for the user session
-    user_sessions[user_id].set_model(model_name, model_type)
+    # Set the model for the user session; the keyboard may be older than the current models.json
+    if not user_sessions[user_id].set_model(model_name, model_type):
+        await outbox.edit_message_text(query, get_text("model_unavailable", lang))
+        return
     
     if model_type == "image":
         user_sessions[user_id].clear_history()
-        provider = MODELS_CONFIG['image'][model_name]['provider']
-        display_name = MODELS_CONFIG['image'][model_name].get('display_name', model_name)
+        display_name = model_registry.display_name("image", model_name)
         
         # В групповых чатах сбрасываем флаг генерации изображения при выборе модели
         if is_group_chat:
             user_sessions[user_id].group_image_generated = False
             logger.debug(f"Reset group_image_generated flag for user {user_id} in group chat during model selection")
         
-        await query.edit_message_text(
+        await outbox.edit_message_text(
+            query,
             f"{get_text('model_selected', lang, display_name)}\n\n"
             f"{get_text('send_image_prompt', lang)}"
         )
@@ -204,14 +263,21 @@ async def handle_model_selection(update: Update, context: ContextTypes.DEFAULT_T
         [InlineKeyboardButton(get_text("set_system_prompt", lang), callback_data="systemprompt:custom")],
         [InlineKeyboardButton(get_text("no_system_prompt", lang), callback_data="systemprompt:none")]
     ]
+    # Готовые системные промпты из prompts.json
+    for preset_name in prompt_registry.presets():
+        keyboard.append([InlineKeyboardButton(
+            prompt_registry.preset_display_name(preset_name, lang),
+            callback_data=f"systemprompt:preset:{preset_name}"
+        )])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     vision_info = ""
-    if MODELS_CONFIG["text"][model_name].get("vision", False):
+    if session.supports_vision():
         vision_info = get_text("vision_capability", lang)
     
-    display_name = MODELS_CONFIG["text"][model_name].get("display_name", model_name)
-    await query.edit_message_text(
+    display_name = model_registry.display_name("text", model_name)
+    await outbox.edit_message_text(
+        query,
         f"{get_text('model_selected', lang, display_name)}\n\n"
         f"{get_text('system_prompt_question', lang, vision_info)}",
         reply_markup=reply_markup
@@ -229,27 +295,225 @@ async def handle_system_prompt_choice(update: Update, context: ContextTypes.DEFA
     logger.info(f"User {user_id} selected prompt type: {callback_data}")
     
     # Get user session for language
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
     _, choice = callback_data.split(":", 1)
     
+    # Выбор системного промпта очищает историю, поэтому текущий запрос больше не нужен
+    cancel_user_request(user_id, reason="system prompt changed")
+    
     if choice == "custom":
         # User wants to set a custom system prompt
-        await query.edit_message_text(get_text("send_system_prompt", lang))
+        await outbox.edit_message_text(query, get_text("send_system_prompt", lang))
         context.user_data["awaiting_system_prompt"] = True
         logger.debug(f"User {user_id} is setting a custom prompt")
     
+    elif choice.startswith("preset:"):
+        # User picked a ready-made system prompt
+        preset_name = choice.split(":", 1)[1]
+        prompt = prompt_registry.preset_prompt(preset_name)
+        if prompt is None:
+            await outbox.edit_message_text(query, get_text("preset_unavailable", lang))
+            return
+        session.system_prompt = prompt
+        session.clear_history()
+        display_name = model_registry.display_name("text", session.current_model)
+        await outbox.edit_message_text(query, get_text("system_prompt_set", lang, display_name))
+        logger.debug(f"User {user_id} chose system prompt preset '{preset_name}'")
+    
     else:  # none
         # User doesn't want a system prompt
         user_sessions[user_id].system_prompt = None
         user_sessions[user_id].clear_history()
-        display_name = MODELS_CONFIG["text"][user_sessions[user_id].current_model].get("display_name", user_sessions[user_id].current_model)
-        await query.edit_message_text(get_text("chat_created_no_prompt", lang, display_name))
+        display_name = model_registry.display_name("text", user_sessions[user_id].current_model)
+        await outbox.edit_message_text(query, get_text("chat_created_no_prompt", lang, display_name))
         logger.debug(f"User {user_id} chose not to set a system prompt")
     
     save_user_session(user_id)
 
+def compare_keyboard(selected, lang):
+    """Клавиатура выбора моделей для сравнения: выбранные отмечены галочкой."""
+    unavailable = provider_health.unavailable("text")
+    rows = []
+    for model_id in model_registry.models("text"):
+        if model_id in unavailable and HEALTH_HIDE_UNAVAILABLE and model_id not in selected:
+            continue
+        mark = "✅ " if model_id in selected else ("⚠️ " if model_id in unavailable else "")
+        rows.append([InlineKeyboardButton(
+            mark + model_registry.display_name("text", model_id),
+            callback_data=f"compare:toggle:{model_id}"
+        )])
+    rows.append([InlineKeyboardButton(get_text("compare_run_button", lang), callback_data="compare:run")])
+    return InlineKeyboardMarkup(rows)
+
+def compare_selection(context):
+    """Модели, выбранные для сравнения и все еще присутствующие в models.json."""
+    return [model for model in context.user_data.get("compare_models", []) if model_registry.get("text", model)]
+
+async def compare_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Start comparing answers of several text models to one question."""
+    user_id = update.effective_user.id
+    session = await get_or_create_session_async(user_id)
+    lang = session.get_interface_language()
+    
+    # Вопрос можно сразу написать после команды: /compare текст вопроса
+    prompt = " ".join(context.args).strip() if context.args else ""
+    if prompt:
+        context.user_data["compare_prompt"] = prompt
+    else:
+        context.user_data.pop("compare_prompt", None)
+    context.user_data["awaiting_compare_prompt"] = False
+    
+    selected = compare_selection(context)
+    context.user_data["compare_models"] = selected
+    logger.info(f"User {user_id} opened model comparison")
+    await outbox.reply_text(
+        update.message,
+        get_text("compare_select_models", lang, COMPARE_MAX_MODELS),
+        reply_markup=compare_keyboard(selected, lang)
+    )
+
+async def handle_compare_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle model toggles, the start button and answer adoption of /compare."""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    session = await get_or_create_session_async(user_id)
+    lang = session.get_interface_language()
+    action = query.data.split(":")[1]
+    
+    if action == "toggle":
+        model = query.data.split(":", 2)[2]
+        selected = compare_selection(context)
+        if model in selected:
+            selected.remove(model)
+        elif len(selected) >= COMPARE_MAX_MODELS:
+            await query.answer(get_text("compare_too_many", lang, COMPARE_MAX_MODELS), show_alert=True)
+            return
+        elif model_registry.get("text", model):
+            selected.append(model)
+        context.user_data["compare_models"] = selected
+        await query.answer()
+        await outbox.edit_message_reply_markup(query, compare_keyboard(selected, lang))
+    
+    elif action == "run":
+        selected = compare_selection(context)
+        if len(selected) < 2:
+            await query.answer(get_text("compare_too_few", lang), show_alert=True)
+            return
+        await query.answer()
+        names = ", ".join(model_registry.display_name("text", model) for model in selected)
+        prompt = context.user_data.pop("compare_prompt", "")
+        if not prompt:
+            context.user_data["awaiting_compare_prompt"] = True
+            await outbox.edit_message_text(query, get_text("compare_send_prompt", lang, names))
+            return
+        await outbox.edit_message_text(query, get_text("compare_started", lang, names))
+        # Сравнение идет в фоне, чтобы новое сообщение или /newchat могли его отменить
+        context.application.create_task(run_comparison(update, context, query.message, prompt), update=update)
+    
+    elif action == "adopt":
+        _, _, run_id, model = query.data.split(":", 3)
+        run = context.user_data.get("compare_run")
+        if not run or str(run["id"]) != run_id or model not in run["answers"]:
+            await query.answer(get_text("compare_expired", lang), show_alert=True)
+            return
+        # В историю попадает только один ответ сравнения
+        context.user_data.pop("compare_run", None)
+        session.add_message("user", run["prompt"])
+        session.add_message("assistant", run["answers"][model])
+        save_user_session(user_id)
+        logger.info(f"User {user_id} adopted the answer of {model} from comparison")
+        await query.answer(get_text("compare_adopted", lang, model_registry.display_name("text", model)))
+        await outbox.edit_message_reply_markup(query, None)
+
+async def run_comparison(update: Update, context: ContextTypes.DEFAULT_TYPE, message, prompt) -> None:
+    """Send one prompt to the selected models concurrently and post each answer as soon as it arrives."""
+    user_id = update.effective_user.id
+    session = await get_or_create_session_async(user_id)
+    lang = session.get_interface_language()
+    
+    # Сравнивается ответ на один вопрос: без истории, но с системным промптом пользователя
+    messages = [{"role": "user", "content": prompt}]
+    if session.system_prompt:
+        messages.insert(0, {"role": "system", "content": session.system_prompt})
+    
+    # Квота каждой модели возвращается, если ее ответ не получен
+    charges = {}
+    for model in compare_selection(context):
+        try:
+            charges[model] = quota_manager.acquire(
+                user_id, session, update.effective_chat, "text", model,
+                tokens=estimate_tokens(session.system_prompt, prompt)
+            )
+        except QuotaExceeded as e:
+            await outbox.reply_text(message, f"{model_registry.display_name('text', model)}: {rejection_text(e, lang)}")
+    models = list(charges)
+    if not models:
+        return
+    
+    # Ответы хранятся до выбора одного из них; кнопки ссылаются на номер сравнения
+    run = {"id": message.message_id, "prompt": prompt, "answers": {}}
+    context.user_data["compare_run"] = run
+    logger.info(f"User {user_id} compares {len(models)} models: {', '.join(models)}")
+    
+    async def ask(model):
+        provider_name = model_registry.get("text", model)["provider"]
+        try:
+            answer = await asyncio.wait_for(
+                get_ai_response(provider_name, model, messages),
+                model_registry.timeout("text", model)
+            )
+            return model, answer, None
+        except asyncio.TimeoutError:
+            return model, None, get_text("request_timeout", lang)
+        except Exception as e:
+            logger.warning(f"Comparison request to {model} failed: {str(e)}")
+            return model, None, str(e)
+    
+    async def fan_out():
+        # Запросы идут параллельно, каждый под лимитом своего провайдера
+        tasks = [asyncio.ensure_future(ask(model)) for model in models]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                model, answer, error = await next_done
+                display_name = model_registry.display_name("text", model)
+                if answer is None:
+                    await outbox.reply_text(message, get_text("compare_answer_error", lang, display_name, error))
+                    continue
+                run["answers"][model] = answer
+                quota_manager.record_tokens(user_id, session, update.effective_chat, "text", model, estimate_tokens(answer))
+                adopt_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(
+                    get_text("compare_adopt_button", lang),
+                    callback_data=f"compare:adopt:{run['id']}:{model}"
+                )]])
+                await outbox.reply_text(message, f"{display_name}:\n\n{answer}", reply_markup=adopt_keyboard)
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    chat_action = outbox.start_chat_action(context.bot, update.effective_chat, "typing")
+    started = time.perf_counter()
+    try:
+        # Новое сообщение или /newchat отменяют сравнение, как и обычный запрос
+        await run_user_request(message.chat_id, user_id, fan_out())
+        await outbox.reply_text(message, get_text("compare_done", lang, f"{time.perf_counter() - started:.1f}"))
+        logger.info(f"Comparison of user {user_id} finished in {time.perf_counter() - started:.1f}s")
+    
+    except RequestSuperseded:
+        logger.info(f"Comparison of user {user_id} was superseded")
+    
+    except Exception as e:
+        logger.error(f"Error in comparison for user {user_id}: {str(e)}")
+        logger.debug(traceback.format_exc())
+        await outbox.reply_text(message, get_text("error_occurred", lang, str(e)))
+    
+    finally:
+        chat_action.cancel()
+        for model, charge in charges.items():
+            if model not in run["answers"]:
+                quota_manager.release(charge)
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle photos sent by users."""
     user_id = update.effective_user.id
@@ -281,18 +545,18 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     logger.info(f"User {user_id} sent a photo: {photo_id}")
     
     # Check if user has an active session
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
     # Check if model supports vision
     if not session.supports_vision():
-        await update.message.reply_text(get_text("no_vision_support", lang))
+        await outbox.reply_text(update.message, get_text("no_vision_support", lang))
         logger.warning(f"User {user_id} tried to use vision with non-supporting model: {session.current_model}")
         return
     
     # Get the photo file
     photo_file = await update.message.photo[-1].get_file()
-    photo_bytes = await photo_file.download_as_bytearray()
+    photo_bytes = await download_file(photo_file)
     
     # Store image for future use
     session.last_image = photo_bytes
@@ -304,9 +568,9 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if caption:
         # If there's a caption, process it as a question about the image
         logger.info(f"User {user_id} sent image with caption: {caption}")
-        await handle_image_question(update, context, caption, photo_bytes)
+        context.application.create_task(handle_image_question(update, context, caption, photo_bytes), update=update)
     else:
-        await update.message.reply_text(get_text("image_received", lang))
+        await outbox.reply_text(update.message, get_text("image_received", lang))
         context.user_data["awaiting_image_question"] = True
         logger.debug(f"User {user_id} uploaded image without caption, awaiting question")
     
@@ -321,7 +585,7 @@ async def handle_image_question(update: Update, context: ContextTypes.DEFAULT_TY
     is_group_chat = update.effective_chat.type in ["group", "supergroup"]
     
     # Get user session for language
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
     # If question is not provided, use the message text
@@ -340,41 +604,77 @@ async def handle_image_question(update: Update, context: ContextTypes.DEFAULT_TY
         image_bytes = user_sessions[user_id].last_image
         
         if image_bytes is None:
-            await message.reply_text(get_text("no_image_found", lang))
+            await outbox.reply_text(message, get_text("no_image_found", lang))
             logger.warning(f"User {user_id} tried to ask about an image, but no image was found")
             return
     
-    # Show typing indicator
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+    # Модель могла быть удалена из models.json после загрузки изображения
+    had_model = session.current_model is not None
+    if not session.refresh_model():
+        await outbox.reply_text(message, get_text("model_unavailable" if had_model else "select_model_first", lang))
+        return
+    
+    chat_action = None
+    charge = None
     
     try:
-        # Add user message to history
-        user_sessions[user_id].add_message("user", question)
+        charge = quota_manager.acquire(
+            user_id, session, update.effective_chat, "text", session.current_model,
+            tokens=estimate_tokens(session.history, question)
+        )
+        # Typing indicator is sent in the background and refreshed until the answer is ready
+        chat_action = outbox.start_chat_action(context.bot, update.effective_chat, "typing")
         
         # Get response from the model
         model = user_sessions[user_id].current_model
         provider_name = user_sessions[user_id].provider
-        history = user_sessions[user_id].history
+        # Вопрос попадает в историю только вместе с ответом: отмененный
+        # или просроченный запрос не оставляет в ней вопрос без ответа
+        history = user_sessions[user_id].history.copy()
+        history.add("user", question)
         
         logger.info(f"User {user_id} asked about image: '{question}' using {model} ({provider_name})")
         
         # Send request to g4f with image
-        response = await get_ai_response(provider_name, model, history, image_bytes)
+        response = await run_user_request(
+            update.effective_chat.id,
+            user_id,
+            get_ai_response(provider_name, model, history, image_bytes),
+            model_registry.timeout("text", model)
+        )
         
-        # Add assistant response to history
+        # Add the question and the response to history
+        user_sessions[user_id].add_message("user", question)
         user_sessions[user_id].add_message("assistant", response)
+        quota_manager.record_tokens(user_id, session, update.effective_chat, "text", model, estimate_tokens(response))
         
         # Save updated session
         save_user_session(user_id)
         
         # Send the response to the user
-        await message.reply_text(response)
+        await outbox.reply_text(message, response)
         logger.info(f"Sent image analysis response to user {user_id}, response length: {len(response)}")
+    
+    except QuotaExceeded as e:
+        await outbox.reply_text(message, rejection_text(e, lang))
+    
+    except RequestSuperseded:
+        quota_manager.release(charge)
+        logger.info(f"Image question of user {user_id} was superseded, dropping its response")
+    
+    except asyncio.TimeoutError:
+        quota_manager.release(charge)
+        await outbox.reply_text(message, get_text("request_timeout", lang))
         
     except Exception as e:
+        quota_manager.release(charge)
         logger.error(f"Error analyzing image for user {user_id}: {str(e)}")
         logger.debug(traceback.format_exc())
-        await message.reply_text(get_text("image_error", lang, str(e)))
+        await outbox.reply_text(message, get_text("image_error", lang, str(e)))
+    
+    finally:
+        if chat_action is not None:
+            chat_action.cancel()
 
 async def translate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Start translation mode."""
@@ -382,13 +682,13 @@ async def translate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info(f"User {user_id} initiated translation mode")
     
     # Initialize user session
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
     # Set translation mode
     context.user_data["awaiting_target_language"] = True
     
-    await update.message.reply_text(get_text("translation_mode_activated", lang))
+    await outbox.reply_text(update.message, get_text("translation_mode_activated", lang))
     logger.debug(f"User {user_id} was asked to specify target language")
 
 async def handle_target_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -409,7 +709,7 @@ async def handle_target_language(update: Update, context: ContextTypes.DEFAULT_T
     target_language = message_text
     
     # Get user session for language
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
     logger.info(f"User {user_id} selected translation target language: {target_language}")
@@ -419,7 +719,7 @@ async def handle_target_language(update: Update, context: ContextTypes.DEFAULT_T
     context.user_data["awaiting_target_language"] = False
     context.user_data["awaiting_translation_text"] = True
     
-    await update.message.reply_text(get_text("translation_language_selected", lang, target_language))
+    await outbox.reply_text(update.message, get_text("translation_language_selected", lang, target_language))
     logger.debug(f"User {user_id} was asked to provide text for translation")
 
 async def handle_translation_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -429,54 +729,54 @@ async def handle_translation_text(update: Update, context: ContextTypes.DEFAULT_
     target_language = context.user_data.get("translation_target_language")
     
     # Get user session for language
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
     logger.info(f"User {user_id} sent text for translation to {target_language}: '{text_to_translate[:50]}...'")
     
-    # Clear translation mode
-    context.user_data["awaiting_translation_text"] = False
-    
-    # Show typing indicator
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+    chat_action = None
+    charge = None
     
     try:
-        # Create a prompt for translation
-        translate_prompt = f"Переведи следующий текст на {target_language}. Верни только переведенный текст без объяснений и комментариев:\n\n{text_to_translate}"
+        # Перевод учитывается в текстовых квотах так же, как обычное сообщение
+        model = translation_batcher.model
+        charge = quota_manager.acquire(
+            user_id, session, update.effective_chat, "text", model, tokens=estimate_tokens(text_to_translate)
+        )
         
-        # Create temporary session for translation
-        temp_session = UserSession()
-        temp_session.set_model("gpt-4o", "text")
-        temp_session.add_message("user", translate_prompt)
+        # Show typing indicator while the translation is in progress
+        chat_action = outbox.start_chat_action(context.bot, update.effective_chat, "typing")
         
-        # Get response from the model
+        # Translation requests from different users are sent to the model in batches
         logger.info(f"Requesting translation for user {user_id} to {target_language}")
-        response = await get_ai_response(temp_session.provider, temp_session.current_model, temp_session.history)
+        response = await translation_batcher.translate(text_to_translate, target_language)
+        quota_manager.record_tokens(user_id, session, update.effective_chat, "text", model, estimate_tokens(response))
+        save_user_session(user_id)
         
         # Send the translation
-        await update.message.reply_text(get_text("translation_result", lang, target_language, response))
+        await outbox.reply_text(update.message, get_text("translation_result", lang, target_language, response))
         logger.info(f"Translation sent to user {user_id}, response length: {len(response)}")
+    
+    except QuotaExceeded as e:
+        await outbox.reply_text(update.message, rejection_text(e, lang))
         
     except Exception as e:
+        quota_manager.release(charge)
         logger.error(f"Error during translation for user {user_id}: {str(e)}")
         logger.debug(traceback.format_exc())
-        await update.message.reply_text(get_text("translation_error", lang, str(e)))
+        await outbox.reply_text(update.message, get_text("translation_error", lang, str(e)))
+    
+    finally:
+        if chat_action is not None:
+            chat_action.cancel()
 
 async def translate_text_to_english(text):
-    """Переводит текст на английский язык, используя GPT-4o."""
+    """Переводит текст на английский язык."""
     try:
         logger.info(f"Translating text to English: '{text[:50]}...'")
         
-        # Создаем временную сессию для перевода
-        temp_session = UserSession()
-        temp_session.set_model("gpt-4o", "text")
-        
-        # Формируем запрос на перевод
-        translate_prompt = f"Translate the following text to English. Return only the translated text without explanations or comments:\n\n{text}"
-        temp_session.add_message("user", translate_prompt)
-        
-        # Получаем перевод от модели
-        response = await get_ai_response(temp_session.provider, temp_session.current_model, temp_session.history)
+        # Перевод отправляется модели вместе с другими запросами, пришедшими одновременно
+        response = await translation_batcher.translate(text, "English")
         
         logger.info(f"Translation to English completed, length: {len(response)}")
         return response
@@ -486,6 +786,92 @@ async def translate_text_to_english(text):
         # Если произошла ошибка, возвращаем оригинальный текст
         return text
 
+async def send_generated_image(update: Update, provider_name, model, prompt, caption):
+    """
+    Отправляет изображение из кэша по file_id или генерирует новое.
+    Возвращает True, если изображение сгенерировано заново.
+    """
+    message = update.message
+    cached = image_cache.get(model, prompt)
+    
+    if cached is not None:
+        if cached.file_id:
+            try:
+                await outbox.reply_photo(message, photo=cached.file_id, caption=caption)
+                image_cache.record(True)
+                logger.info(f"Sent cached image for {model} by file_id")
+                return False
+            except TelegramError as e:
+                logger.warning(f"Cached file_id for {model} is no longer valid: {str(e)}")
+                image_cache.forget_file_id(model, prompt)
+        
+        # Если file_id не сработал, пробуем локальную копию
+        image_bytes = await image_cache.read_local_copy(cached)
+        if image_bytes is not None:
+            sent = await outbox.reply_photo(message, photo=image_bytes, caption=caption)
+            image_cache.put(model, prompt, sent.photo[-1].file_id)
+            image_cache.record(True)
+            logger.info(f"Sent cached image for {model} from local copy")
+            return False
+        
+        # Запись оказалась непригодной: это промах кэша
+        image_cache.record(False)
+    
+    image_url = await generate_image(provider_name, model, prompt)
+    sent = await outbox.reply_photo(message, photo=image_url, caption=caption)
+    
+    # Сохраняем file_id, который Telegram присвоил изображению
+    photo = sent.photo[-1]
+    image_bytes = None
+    if image_cache.keeps_local_copies:
+        try:
+            photo_file = await photo.get_file()
+            image_bytes = await download_file(photo_file)
+        except TelegramError as e:
+            logger.warning(f"Failed to download generated image for local cache: {str(e)}")
+    image_cache.put(model, prompt, photo.file_id, image_bytes)
+    return True
+
+async def send_image_variants(update: Update, session, prompt):
+    """Генерирует несколько вариантов параллельно и отправляет их одной медиагруппой."""
+    plan = session.get_image_variant_plan()
+    
+    async def generate_variant(variant, model):
+        provider_name = model_registry.get("image", model)["provider"]
+        return model, await generate_image(provider_name, model, prompt, variant=variant)
+    
+    tasks = [asyncio.ensure_future(generate_variant(i, model)) for i, model in enumerate(plan)]
+    results = []
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=IMAGE_VARIANTS_TIMEOUT):
+            try:
+                model, image_url = await next_done
+                results.append((model, image_url))
+                logger.debug(f"Image variant {len(results)}/{len(plan)} ready from {model}")
+            except asyncio.TimeoutError:
+                logger.warning(f"Image variants timed out after {IMAGE_VARIANTS_TIMEOUT}s, {len(results)}/{len(plan)} ready")
+                break
+            except Exception as e:
+                logger.warning(f"Image variant failed: {str(e)}")
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    lang = session.get_interface_language()
+    if not results:
+        raise Exception(get_text("image_variants_failed", lang))
+    
+    caption = get_text("generated_with", lang, ", ".join(dict.fromkeys(model for model, _ in results)))
+    if len(results) == 1:
+        _, image_url = results[0]
+        return [await outbox.reply_photo(update.message, photo=image_url, caption=caption)]
+    
+    media = [
+        InputMediaPhoto(media=image_url, caption=caption if i == 0 else None)
+        for i, (_, image_url) in enumerate(results)
+    ]
+    return await outbox.reply_media_group(update.message, media=media)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle user messages."""
     user_id = update.effective_user.id
@@ -517,7 +903,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     logger.info(f"User {user_id} sent message in {'group' if is_group_chat else 'private'} chat: '{message_text[:30]}...' ({len(message_text)} chars)")
     
     # Initialize user session
-    session = get_or_create_session(user_id)
+    session = await get_or_create_session_async(user_id)
     lang = session.get_interface_language()
     
     # If we're waiting for a system prompt
@@ -525,8 +911,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Set the system prompt
         session.set_system_prompt(message_text)
         context.user_data["awaiting_system_prompt"] = False
-        display_name = MODELS_CONFIG["text"][session.current_model].get("display_name", session.current_model)
-        await update.message.reply_text(get_text("system_prompt_set", lang, display_name))
+        display_name = model_registry.display_name("text", session.current_model)
+        await outbox.reply_text(update.message, get_text("system_prompt_set", lang, display_name))
         logger.debug(f"User {user_id} set custom system prompt: '{message_text[:50]}...'")
         save_user_session(user_id)
         return
@@ -537,26 +923,51 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     
     # If we're waiting for text to translate
+    # Долгие запросы к модели идут отдельной задачей, чтобы не задерживать
+    # следующие обновления пользователя (см. request_tracker.serialize_per_user)
     if context.user_data.get("awaiting_translation_text", False):
-        await handle_translation_text(update, context)
+        context.user_data["awaiting_translation_text"] = False
+        context.application.create_task(handle_translation_text(update, context), update=update)
+        return
+    
+    # If we're waiting for a question to compare models on
+    if context.user_data.get("awaiting_compare_prompt", False):
+        context.user_data["awaiting_compare_prompt"] = False
+        context.application.create_task(run_comparison(update, context, update.message, message_text), update=update)
         return
     
     # If we're waiting for a question about an image
     if context.user_data.get("awaiting_image_question", False):
         context.user_data["awaiting_image_question"] = False
         logger.debug(f"User {user_id} asked question about previously uploaded image")
-        await handle_image_question(update, context)
+        context.application.create_task(handle_image_question(update, context), update=update)
+        return
+    
+    # Несколько сообщений, отправленных подряд, объединяются в один запрос к модели
+    if not session.is_image_mode and MESSAGE_DEBOUNCE_WINDOW > 0:
+        message_debouncer.add((update.effective_chat.id, user_id), update, context, message_text, answer_message)
         return
     
-    # Check if model is selected
-    if not session.current_model:
-        await update.message.reply_text(get_text("select_model_first", lang))
+    context.application.create_task(answer_message(update, context, message_text), update=update)
+
+async def answer_message(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text) -> None:
+    """Send a message (or several merged messages) to the selected model and reply."""
+    user_id = update.effective_user.id
+    is_group_chat = update.effective_chat.type in ["group", "supergroup"]
+    session = await get_or_create_session_async(user_id)
+    lang = session.get_interface_language()
+    
+    # Check if model is selected and still present in models.json
+    had_model = session.current_model is not None
+    if not session.refresh_model():
+        await outbox.reply_text(update.message, get_text("model_unavailable" if had_model else "select_model_first", lang))
         logger.warning(f"User {user_id} tried to chat without selecting a model first")
         return
     
-    # Show typing indicator or upload photo indicator
-    action = "upload_photo" if session.is_image_mode else "typing"
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=action)
+    # Индикатор (typing или upload_photo) запускается только после проверки квоты
+    # и ранних выходов; он идет параллельно запросу и обновляется до отправки ответа
+    chat_action = None
+    charge = None
     
     try:
         if session.is_image_mode:
@@ -573,17 +984,33 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             
             logger.info(f"User {user_id} requested image generation with prompt: '{message_text[:50]}...'")
             
-            # Переводим запрос на английский
-            english_prompt = await translate_text_to_english(message_text)
+            # Каждый вариант учитывается и в лимитах своей модели
+            plan = session.get_image_variant_plan()
+            charge = quota_manager.acquire(
+                user_id, session, update.effective_chat, "image", model, images=len(plan), variant_models=plan
+            )
+            chat_action = outbox.start_chat_action(context.bot, update.effective_chat, "upload_photo")
             
-            # Генерируем изображение с переведенным запросом
-            image_url = await generate_image(provider_name, model, english_prompt)
+            async def generate_and_send():
+                # Переводим запрос на английский
+                english_prompt = await translate_text_to_english(message_text)
+                
+                # Генерируем изображение с переведенным запросом (или берем из кэша) и отправляем
+                if len(plan) > 1:
+                    await send_image_variants(update, session, english_prompt)
+                    return True
+                return await send_generated_image(
+                    update,
+                    provider_name,
+                    model,
+                    english_prompt,
+                    caption=get_text("generated_with", lang, model)
+                )
             
-            # Send the image
-            await update.message.reply_photo(
-                photo=image_url, 
-                caption=get_text("generated_with", lang, model)
-            )
+            generated = await run_user_request(update.effective_chat.id, user_id, generate_and_send(), model_registry.timeout("image", model))
+            if not generated:
+                # Изображение из кэша не расходует квоту
+                quota_manager.release(charge)
             logger.info(f"Generated and sent image to user {user_id}")
             
             # Если это групповой чат, помечаем что изображение было сгенерировано
@@ -593,30 +1020,59 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             
         else:
             # Handle text conversation
-            # Add user message to history
-            session.add_message("user", message_text)
+            charge = quota_manager.acquire(
+                user_id, session, update.effective_chat, "text", session.current_model,
+                tokens=estimate_tokens(session.history, message_text)
+            )
+            chat_action = outbox.start_chat_action(context.bot, update.effective_chat, "typing")
             
             # Get response from the model
             model = session.current_model
             provider_name = session.provider
-            history = session.history
+            # Сообщение попадает в историю только вместе с ответом: отмененный
+            # или просроченный запрос не оставляет в ней вопрос без ответа
+            history = session.history.copy()
+            history.add("user", message_text)
             
             logger.info(f"Getting AI response for user {user_id} using {model} ({provider_name})")
             
-            # Send request to g4f
-            response = await get_ai_response(provider_name, model, history)
+            # Send request to g4f; a newer message or /newchat cancels this request
+            response = await run_user_request(
+                update.effective_chat.id,
+                user_id,
+                get_ai_response(provider_name, model, history),
+                model_registry.timeout("text", model)
+            )
             
-            # Add assistant response to history
+            # Add the message and the response to history
+            session.add_message("user", message_text)
             session.add_message("assistant", response)
+            quota_manager.record_tokens(user_id, session, update.effective_chat, "text", model, estimate_tokens(response))
             
             # Send the response to the user
-            await update.message.reply_text(response)
+            await outbox.reply_text(update.message, response)
             logger.info(f"Sent AI response to user {user_id}, response length: {len(response)}")
         
         # Save session after successful response
         save_user_session(user_id)
     
+    except QuotaExceeded as e:
+        await outbox.reply_text(update.message, rejection_text(e, lang))
+    
+    except RequestSuperseded:
+        quota_manager.release(charge)
+        logger.info(f"Request of user {user_id} was superseded, dropping its response")
+    
+    except asyncio.TimeoutError:
+        quota_manager.release(charge)
+        await outbox.reply_text(update.message, get_text("request_timeout", lang))
+    
     except Exception as e:
+        quota_manager.release(charge)
         logger.error(f"Error in handle_message for user {user_id}: {str(e)}")
         logger.debug(traceback.format_exc())
-        await update.message.reply_text(get_text("error_occurred", lang, str(e))) 
\ No newline at end of file
+        await outbox.reply_text(update.message, get_text("error_occurred", lang, str(e)))
+    
+    finally:
+        if chat_action is not None:
+            chat_action.cancel()
\ No newline at end of file
@@ -0,0 +1,115 @@
+"""
+Компактное хранение истории сообщений.
+
+Вместо списка словарей {"role": ..., "content": ...} история хранит две
+параллельные последовательности: коды ролей (по одному байту на сообщение)
+и тексты сообщений. Словари в формате провайдера создаются только при
+отправке запроса. Интерфейс совместим со списком: len(), итерация, индексы
+и срезы возвращают словари, append() принимает словарь.
+
+Запуск `python chat_history.py` сравнивает расход памяти на сообщение.
+"""
+import sys
+import tracemalloc
+from array import array
+
+# Общая таблица ролей; код роли — индекс в таблице
+_ROLE_NAMES = [sys.intern("system"), sys.intern("user"), sys.intern("assistant")]
+_ROLE_CODES = {role: code for code, role in enumerate(_ROLE_NAMES)}
+
+
+def _role_code(role):
+    code = _ROLE_CODES.get(role)
+    if code is None:
+        role = sys.intern(role)
+        code = len(_ROLE_NAMES)
+        _ROLE_NAMES.append(role)
+        _ROLE_CODES[role] = code
+    return code
+
+
+class ChatHistory:
+    __slots__ = ("_roles", "_contents")
+
+    def __init__(self, messages=()):
+        self._roles = array("B")
+        self._contents = []
+        for message in messages:
+            self.append(message)
+
+    def add(self, role, content):
+        self._roles.append(_role_code(role))
+        self._contents.append(content)
+
+    def append(self, message):
+        self.add(message["role"], message["content"])
+
+    def clear(self):
+        self._roles = array("B")
+        self._contents = []
+
+    def copy(self):
+        """Неглубокая копия: тексты сообщений общие, последовательности свои."""
+        history = ChatHistory()
+        history._roles = array("B", self._roles)
+        history._contents = list(self._contents)
+        return history
+
+    def pairs(self):
+        """Итерирует пары (роль, текст) без создания словарей."""
+        return ((_ROLE_NAMES[code], content) for code, content in zip(self._roles, self._contents))
+
+    def to_messages(self):
+        """Возвращает историю в формате провайдера: список словарей."""
+        return [{"role": role, "content": content} for role, content in self.pairs()]
+
+    def memory_size(self):
+        """Приблизительный объем памяти истории в байтах (последовательности и тексты)."""
+        return (
+            sys.getsizeof(self._roles)
+            + sys.getsizeof(self._contents)
+            + sum(sys.getsizeof(content) for content in self._contents)
+        )
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __iter__(self):
+        return ({"role": role, "content": content} for role, content in self.pairs())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [
+                {"role": _ROLE_NAMES[code], "content": content}
+                for code, content in zip(self._roles[index], self._contents[index])
+            ]
+        return {"role": _ROLE_NAMES[self._roles[index]], "content": self._contents[index]}
+
+    def __repr__(self):
+        return f"ChatHistory({len(self)} messages)"
+
+
+def _measure(messages=100000):
+    """Измеряет накладные расходы на сообщение (без учета самих текстов)."""
+    contents = [f"message {i}" for i in range(messages)]
+    roles = ["user", "assistant"]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    as_dicts = [{"role": roles[i % 2], "content": contents[i]} for i in range(messages)]
+    dict_bytes = tracemalloc.get_traced_memory()[0] - before
+    del as_dicts
+
+    before = tracemalloc.get_traced_memory()[0]
+    compact = ChatHistory()
+    for i in range(messages):
+        compact.add(roles[i % 2], contents[i])
+    compact_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    print(f"list of dicts: {dict_bytes / messages:6.1f} bytes per message")
+    print(f"ChatHistory:   {compact_bytes / messages:6.1f} bytes per message")
+
+
+if __name__ == "__main__":
+    _measure()
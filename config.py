@@ -1,27 +1,143 @@
 import os
-import json
 from pathlib import Path
 from dotenv import load_dotenv
-from logger_setup import logger
 
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Пользователи, которым доступны служебные команды (/memory), через запятую
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
 
 # Constants
 CHATS_DIR = Path("chats")
-CHATS_DIR.mkdir(exist_ok=True)
-
-# Load models configuration
-def load_models_config():
-    try:
-        with open("models.json", "r", encoding="utf-8") as f:
-            models_config = json.load(f)
-        logger.info(f"Loaded {len(models_config['text'])} text models and {len(models_config['image'])} image models")
-        return models_config
-    except Exception as e:
-        logger.error(f"Failed to load models configuration: {str(e)}")
-        raise
-
-# Load models configuration
-MODELS_CONFIG = load_models_config() 
\ No newline at end of file
+MODELS_FILE = Path("models.json")
+PROMPTS_DIR = CHATS_DIR / "prompts"
+PROMPT_PRESETS_FILE = Path("prompts.json")
+# Сколько текстов системных промптов держать в памяти
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "1000"))
+# Состояние многошаговых сценариев (context.user_data) и как часто сохранять изменения, секунды
+STATE_FILE = CHATS_DIR / "user_state.jsonl"
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "5"))
+# Уровень сжатия файлов сессий gzip (1-9); см. python session_format.py
+SESSION_COMPRESSION_LEVEL = int(os.getenv("SESSION_COMPRESSION_LEVEL", "3"))
+# Предзагрузка сессий после запуска: активные за последние часы, не больше заданного числа и объема памяти
+SESSION_PRELOAD_MAX_AGE_HOURS = float(os.getenv("SESSION_PRELOAD_MAX_AGE_HOURS", "24"))
+SESSION_PRELOAD_MAX_SESSIONS = int(os.getenv("SESSION_PRELOAD_MAX_SESSIONS", "1000"))
+SESSION_PRELOAD_MEMORY_MB = float(os.getenv("SESSION_PRELOAD_MEMORY_MB", "64"))
+SESSION_PRELOAD_BATCH = int(os.getenv("SESSION_PRELOAD_BATCH", "32"))
+# Как часто проверять изменения models.json, секунды
+MODELS_RELOAD_INTERVAL = float(os.getenv("MODELS_RELOAD_INTERVAL", "10"))
+
+# Сроки выполнения запросов по умолчанию (в models.json можно задать "timeout" для модели), секунды
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "90"))
+IMAGE_REQUEST_TIMEOUT = float(os.getenv("IMAGE_REQUEST_TIMEOUT", "120"))
+
+# Максимум одновременных запросов к одному провайдеру
+PROVIDER_CONCURRENCY = int(os.getenv("PROVIDER_CONCURRENCY", "4"))
+
+# Повторы при временных ошибках провайдера: число попыток, интервалы (секунды) и общий бюджет повторов
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "0.2"))
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "20"))
+
+# Пул для работы вне цикла событий: base64, запись сессий и файлов.
+# OFFLOAD_CPU_EXECUTOR=process переносит вычислительные задачи в отдельные процессы
+OFFLOAD_WORKERS = int(os.getenv("OFFLOAD_WORKERS", "4"))
+OFFLOAD_CPU_EXECUTOR = os.getenv("OFFLOAD_CPU_EXECUTOR", "thread")
+# Измерение задержки цикла событий, секунды
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_WARN = float(os.getenv("LOOP_LAG_WARN", "0.1"))
+# Как часто писать сводку метрик в лог, секунды (0 — не писать; сводка доступна командой /metrics)
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "600"))
+
+# Отчет о памяти (/memory или SIGUSR1): глубина стека tracemalloc и число строк в разделах отчета
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", "1"))
+MEMORY_TRACE_ON_START = os.getenv("MEMORY_TRACE_ON_START", "0") == "1"
+MEMORY_REPORT_TOP = int(os.getenv("MEMORY_REPORT_TOP", "10"))
+
+# Локальные провайдеры-заглушки вместо g4f (для проверок без сети)
+AI_STUB_PROVIDERS = os.getenv("AI_STUB_PROVIDERS", "0") == "1"
+STUB_LATENCY = float(os.getenv("STUB_LATENCY", "0.2"))
+STUB_FAILURE_RATE = float(os.getenv("STUB_FAILURE_RATE", "0"))
+STUB_FAILING_PROVIDERS = [p for p in os.getenv("STUB_FAILING_PROVIDERS", "").split(",") if p]
+
+# Фоновая проверка доступности провайдеров
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "300"))
+HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", "30"))
+HEALTH_PROBE_BUDGET = int(os.getenv("HEALTH_PROBE_BUDGET", "200"))
+# Проверка модели изображений — настоящая генерация, поэтому по умолчанию выключена
+HEALTH_PROBE_IMAGES = os.getenv("HEALTH_PROBE_IMAGES", "0") == "1"
+HEALTH_FAILURE_THRESHOLD = int(os.getenv("HEALTH_FAILURE_THRESHOLD", "2"))
+HEALTH_HIDE_UNAVAILABLE = os.getenv("HEALTH_HIDE_UNAVAILABLE", "0") == "1"
+
+# Перевод: запросы, пришедшие в пределах окна (секунды), отправляются модели одним пакетом;
+# к простаивающему пакетировщику запрос уходит сразу
+TRANSLATION_MODEL = os.getenv("TRANSLATION_MODEL", "gpt-4o")
+TRANSLATION_BATCH_WINDOW = float(os.getenv("TRANSLATION_BATCH_WINDOW", "0.1"))
+TRANSLATION_BATCH_SIZE = int(os.getenv("TRANSLATION_BATCH_SIZE", "20"))
+
+# Лимиты отправки сообщений Telegram (сообщений в секунду)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_PRIVATE_CHAT_RATE = float(os.getenv("TELEGRAM_PRIVATE_CHAT_RATE", "1"))
+TELEGRAM_GROUP_CHAT_RATE = float(os.getenv("TELEGRAM_GROUP_CHAT_RATE", str(20 / 60)))
+TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+# Индикаторы действия ("печатает...") ограничиваются отдельно от сообщений, действий в секунду на чат
+TELEGRAM_CHAT_ACTION_RATE = float(os.getenv("TELEGRAM_CHAT_ACTION_RATE", "1"))
+# Транспорт Telegram: отдельные пулы соединений для get_updates и для отправки сообщений
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.getenv("TELEGRAM_CONNECTION_POOL_SIZE", "64"))
+TELEGRAM_GET_UPDATES_POOL_SIZE = int(os.getenv("TELEGRAM_GET_UPDATES_POOL_SIZE", "2"))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "10"))
+TELEGRAM_WRITE_TIMEOUT = float(os.getenv("TELEGRAM_WRITE_TIMEOUT", "20"))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", "5"))
+# Длинный опрос: сколько сервер держит запрос get_updates и пауза между запросами, секунды
+TELEGRAM_POLL_TIMEOUT = int(os.getenv("TELEGRAM_POLL_TIMEOUT", "30"))
+TELEGRAM_POLL_INTERVAL = float(os.getenv("TELEGRAM_POLL_INTERVAL", "0"))
+# Сколько обновлений обрабатывается одновременно: долгий запрос к провайдеру не задерживает
+# остальные сообщения, а новое сообщение или /newchat успевает отменить его
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", "256"))
+# Собственный сервер Bot API (telegram-bot-api): адреса и локальный режим, в котором
+# файлы читаются с диска сервера, а не скачиваются по HTTP
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "")
+TELEGRAM_BASE_FILE_URL = os.getenv("TELEGRAM_BASE_FILE_URL", "")
+TELEGRAM_LOCAL_MODE = os.getenv("TELEGRAM_LOCAL_MODE", "0") == "1"
+
+# Сообщения пользователя, пришедшие с паузой меньше MESSAGE_DEBOUNCE_WINDOW секунд, объединяются
+# в один запрос (0 — отключить); ожидание с первого сообщения не дольше MESSAGE_DEBOUNCE_MAX_WAIT секунд
+MESSAGE_DEBOUNCE_WINDOW = float(os.getenv("MESSAGE_DEBOUNCE_WINDOW", "1"))
+MESSAGE_DEBOUNCE_MAX_WAIT = float(os.getenv("MESSAGE_DEBOUNCE_MAX_WAIT", "4"))
+
+# Индикатор "печатает..." обновляется каждые CHAT_ACTION_INTERVAL секунд, не больше CHAT_ACTION_MAX_REFRESHES раз
+CHAT_ACTION_INTERVAL = float(os.getenv("CHAT_ACTION_INTERVAL", "4"))
+CHAT_ACTION_MAX_REFRESHES = int(os.getenv("CHAT_ACTION_MAX_REFRESHES", "30"))
+
+# Квоты: запросы и оценка токенов за окно QUOTA_WINDOW секунд, изображения за сутки (0 — без ограничения).
+# В models.json для модели можно задать дополнительные лимиты "quota": {"requests", "tokens", "images"}
+QUOTA_WINDOW = float(os.getenv("QUOTA_WINDOW", "3600"))
+QUOTA_BUCKETS = int(os.getenv("QUOTA_BUCKETS", "60"))
+QUOTA_USER_REQUESTS = int(os.getenv("QUOTA_USER_REQUESTS", "60"))
+QUOTA_USER_TOKENS = int(os.getenv("QUOTA_USER_TOKENS", "200000"))
+QUOTA_USER_IMAGES_PER_DAY = int(os.getenv("QUOTA_USER_IMAGES_PER_DAY", "50"))
+QUOTA_GROUP_REQUESTS = int(os.getenv("QUOTA_GROUP_REQUESTS", "200"))
+QUOTA_GROUP_TOKENS = int(os.getenv("QUOTA_GROUP_TOKENS", "600000"))
+QUOTA_GROUP_IMAGES_PER_DAY = int(os.getenv("QUOTA_GROUP_IMAGES_PER_DAY", "100"))
+GROUP_QUOTA_FILE = CHATS_DIR / "group_quotas.json"
+
+# Сколько текстовых моделей можно выбрать для сравнения ответов (/compare)
+COMPARE_MAX_MODELS = int(os.getenv("COMPARE_MAX_MODELS", "4"))
+
+# Генерация нескольких вариантов изображения
+IMAGE_MAX_VARIANTS = int(os.getenv("IMAGE_MAX_VARIANTS", "4"))
+IMAGE_VARIANTS_TIMEOUT = float(os.getenv("IMAGE_VARIANTS_TIMEOUT", "120"))
+
+# Кэш сгенерированных изображений
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "500"))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 3600)))
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "")
+
+def load_config():
+    """Готовит каталоги данных. Вызывается один раз при запуске."""
+    CHATS_DIR.mkdir(exist_ok=True)
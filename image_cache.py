@@ -0,0 +1,193 @@
+"""
+Кэш сгенерированных изображений.
+
+Ключ кэша — модель и нормализованный английский промпт. После первой отправки
+сохраняется file_id Telegram, и повторный запрос отправляется по нему без
+обращения к провайдеру. Дополнительно можно хранить копию изображения на диске
+на случай, если file_id перестанет работать.
+"""
+import re
+import time
+import hashlib
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+
+import metrics
+import offload
+from logger_setup import logger
+from config import IMAGE_CACHE_SIZE, IMAGE_CACHE_TTL, IMAGE_CACHE_DIR
+
+
+def normalize_prompt(prompt):
+    """Приводит промпт к виду, по которому совпадают одинаковые запросы."""
+    prompt = re.sub(r"\s+", " ", prompt.strip().lower())
+    return prompt.rstrip(" .!")
+
+
+class CachedImage:
+    __slots__ = ("key", "file_id", "path", "created_at")
+
+    def __init__(self, key, file_id=None, path=None, created_at=None):
+        self.key = key
+        self.file_id = file_id
+        self.path = path
+        self.created_at = created_at if created_at is not None else time.time()
+
+
+class ImageCache:
+    def __init__(self, max_entries=IMAGE_CACHE_SIZE, ttl=IMAGE_CACHE_TTL, cache_dir=IMAGE_CACHE_DIR):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._disk_purged = False
+
+    @property
+    def keeps_local_copies(self):
+        return self.cache_dir is not None
+
+    def _key(self, model, prompt):
+        return hashlib.sha256(f"{model}\n{normalize_prompt(prompt)}".encode("utf-8")).hexdigest()
+
+    def _local_path(self, key):
+        return self.cache_dir / f"{key}.jpg"
+
+    def _is_expired(self, created_at):
+        return self.ttl > 0 and time.time() - created_at > self.ttl
+
+    def record(self, hit):
+        """
+        Учитывает обращение к кэшу. Попадание засчитывает вызывающий, когда
+        изображение действительно отправлено из кэша (file_id или копия на диске).
+        """
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        metrics.increment("image_cache_requests", result="hit" if hit else "miss")
+        metrics.set_gauge("image_cache_hit_ratio", self.hit_ratio())
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, model, prompt):
+        """Возвращает запись кэша или None (промах учитывается сразу)."""
+        key = self._key(model, prompt)
+        entry = self._entries.get(key)
+
+        if entry is not None and self._is_expired(entry.created_at):
+            self._remove(key)
+            entry = None
+
+        # Копия на диске переживает перезапуск бота
+        if entry is None and self.keeps_local_copies:
+            path = self._local_path(key)
+            if path.exists() and not self._is_expired(path.stat().st_mtime):
+                entry = CachedImage(key, path=path, created_at=path.stat().st_mtime)
+                self._entries[key] = entry
+
+        if entry is None:
+            self.record(False)
+            return None
+
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, model, prompt, file_id, image_bytes=None):
+        """Сохраняет file_id (и, если включено, байты изображения)."""
+        key = self._key(model, prompt)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = CachedImage(key)
+            self._entries[key] = entry
+        entry.file_id = file_id
+        self._entries.move_to_end(key)
+
+        if image_bytes is not None and self.keeps_local_copies:
+            # Запись на диск выполняется в пуле потоков, а путь присваивается в цикле событий
+            task = offload.run_ordered(("image_cache", key), self._store_local_copy, key, bytes(image_bytes))
+            if task is not None:
+                task.add_done_callback(lambda done: self._attach_local_copy(key, done))
+
+        self._evict()
+        metrics.set_gauge("image_cache_entries", len(self._entries))
+
+    def _store_local_copy(self, key, image_bytes):
+        """Записывает копию изображения (в пуле потоков). Возвращает путь или None."""
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._purge_stale_files()
+            path = self._local_path(key)
+            path.write_bytes(image_bytes)
+            logger.debug(f"Stored local copy of generated image: {path} ({len(image_bytes)} bytes)")
+            return path
+        except Exception as e:
+            logger.warning(f"Failed to store local copy of generated image: {str(e)}")
+            logger.debug(traceback.format_exc())
+            return None
+
+    def _attach_local_copy(self, key, task):
+        if task.cancelled() or task.exception() is not None or task.result() is None:
+            return
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.path = task.result()
+        else:
+            # Запись вытеснена, пока копия записывалась: файл больше никому не нужен
+            offload.run_ordered(("image_cache", key), task.result().unlink, True)
+
+    def forget_file_id(self, model, prompt):
+        """Убирает недействительный file_id, оставляя копию на диске."""
+        entry = self._entries.get(self._key(model, prompt))
+        if entry is None:
+            return
+        entry.file_id = None
+        if entry.path is None:
+            self._remove(entry.key)
+
+    async def read_local_copy(self, entry):
+        """Читает копию изображения с диска или возвращает None."""
+        if entry.path is None:
+            return None
+        try:
+            return await offload.run_io(entry.path.read_bytes)
+        except OSError as e:
+            logger.warning(f"Failed to read local image copy {entry.path}: {str(e)}")
+            entry.path = None
+            return None
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.path is not None:
+            try:
+                entry.path.unlink()
+            except OSError:
+                pass
+
+    def _purge_stale_files(self):
+        """Один раз удаляет устаревшие копии, оставшиеся от прошлых запусков."""
+        if self._disk_purged:
+            return
+        self._disk_purged = True
+        for path in self.cache_dir.glob("*.jpg"):
+            try:
+                if self._is_expired(path.stat().st_mtime):
+                    path.unlink()
+            except OSError:
+                pass
+
+    def _evict(self):
+        expired = [key for key, entry in self._entries.items() if self._is_expired(entry.created_at)]
+        for key in expired:
+            self._remove(key)
+        while len(self._entries) > self.max_entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+            metrics.increment("image_cache_evictions")
+
+
+image_cache = ImageCache()
@@ -0,0 +1,162 @@
+"""
+Отчет об использовании памяти по запросу (/memory для администраторов или SIGUSR1).
+
+Отчет состоит из двух частей:
+- учет по сессиям: байты истории, последнего изображения и системного промпта
+  и пользователи с наибольшим объемом;
+- снимок tracemalloc: крупнейшие места выделения памяти, распределение по
+  пакетам (бот, g4f, telegram, ...) и рост относительно предыдущего отчета,
+  по которому видны утечки.
+
+tracemalloc замедляет выделение памяти, поэтому включается при первом
+запросе отчета (или сразу при запуске, если MEMORY_TRACE_ON_START=1).
+"""
+import os
+import sys
+import signal
+import asyncio
+import tracemalloc
+
+import offload
+from logger_setup import logger
+from session import user_sessions
+from config import MEMORY_TRACE_FRAMES, MEMORY_REPORT_TOP
+
+_TRACE_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+_BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Снимок предыдущего отчета для сравнения
+_previous_snapshot = None
+
+
+def start_tracing(frames=MEMORY_TRACE_FRAMES):
+    """Включает tracemalloc. Возвращает True, если трассировка только что включена."""
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(frames)
+    logger.info(f"Memory allocation tracing started ({frames} frames)")
+    return True
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def session_footprint(session):
+    """Объем памяти сессии по частям, байты."""
+    return {
+        "history": session.history.memory_size(),
+        "image": sys.getsizeof(session.last_image) if session.last_image is not None else 0,
+        "prompt": sys.getsizeof(session.system_prompt) if session.system_prompt else 0,
+    }
+
+
+def session_report(sessions, top_n):
+    footprints = {user_id: session_footprint(session) for user_id, session in list(sessions.items())}
+    totals = {part: sum(footprint[part] for footprint in footprints.values()) for part in ("history", "image")}
+    # Промпты общие для сессий (реестр промптов), поэтому считаются один раз
+    prompts = {id(session.system_prompt): sys.getsizeof(session.system_prompt)
+               for session in list(sessions.values()) if session.system_prompt}
+    images = sum(1 for footprint in footprints.values() if footprint["image"])
+
+    lines = [
+        f"Sessions: {len(footprints)}",
+        f"  history: {format_bytes(totals['history'])}",
+        f"  images: {format_bytes(totals['image'])} in {images} sessions",
+        f"  system prompts: {format_bytes(sum(prompts.values()))} in {len(prompts)} unique prompts",
+    ]
+    top = sorted(footprints.items(), key=lambda item: sum(item[1].values()), reverse=True)[:top_n]
+    if top:
+        lines.append(f"Top {len(top)} users:")
+        for user_id, footprint in top:
+            lines.append(
+                f"  {user_id}: {format_bytes(sum(footprint.values()))} "
+                f"(history {format_bytes(footprint['history'])}, image {format_bytes(footprint['image'])}, "
+                f"prompt {format_bytes(footprint['prompt'])}, {len(sessions[user_id].history)} messages)"
+            )
+    return lines
+
+
+def _package(filename):
+    """Пакет, к которому относится файл: модули бота, пакет из site-packages или stdlib."""
+    if filename.startswith(_BOT_DIR) and "site-packages" not in filename:
+        return "bot"
+    marker = "site-packages" + os.sep
+    if marker in filename:
+        return filename.split(marker, 1)[1].split(os.sep, 1)[0]
+    if filename.startswith("<"):
+        return "other"
+    return "stdlib"
+
+
+def _frame(stat):
+    frame = stat.traceback[0]
+    return f"{os.path.relpath(frame.filename, _BOT_DIR) if frame.filename.startswith(_BOT_DIR) else frame.filename}:{frame.lineno}"
+
+
+def tracemalloc_report(top_n):
+    """Снимок tracemalloc и сравнение с предыдущим; выполняется в пуле потоков."""
+    global _previous_snapshot
+    snapshot = tracemalloc.take_snapshot().filter_traces(_TRACE_FILTERS)
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"Traced memory: {format_bytes(current)} (peak {format_bytes(peak)})"]
+
+    packages = {}
+    for stat in snapshot.statistics("filename"):
+        package = _package(stat.traceback[0].filename)
+        packages[package] = packages.get(package, 0) + stat.size
+    lines.append("By package:")
+    for package, size in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top_n]:
+        lines.append(f"  {package}: {format_bytes(size)}")
+
+    lines.append("Top allocation sites:")
+    for stat in snapshot.statistics("lineno")[:top_n]:
+        lines.append(f"  {_frame(stat)}: {format_bytes(stat.size)} in {stat.count} blocks")
+
+    if _previous_snapshot is not None:
+        growth = [diff for diff in snapshot.compare_to(_previous_snapshot, "lineno") if diff.size_diff > 0][:top_n]
+        lines.append("Growth since previous report:")
+        for diff in growth:
+            lines.append(f"  {_frame(diff)}: +{format_bytes(diff.size_diff)} (+{diff.count_diff} blocks), now {format_bytes(diff.size)}")
+        if not growth:
+            lines.append("  none")
+    _previous_snapshot = snapshot
+    return lines
+
+
+async def build_report(top_n=MEMORY_REPORT_TOP):
+    """Собирает текст отчета. При первом вызове включает tracemalloc."""
+    lines = session_report(user_sessions, top_n)
+    if start_tracing():
+        lines.append("Allocation tracing has just been enabled; request the report again to see allocation sites.")
+    else:
+        lines += await offload.run_io(tracemalloc_report, top_n)
+    return "\n".join(lines)
+
+
+async def _log_report():
+    try:
+        logger.info(f"Memory report:\n{await build_report()}")
+    except Exception as e:
+        logger.error(f"Failed to build memory report: {str(e)}")
+
+
+def install_signal_handler():
+    """Пишет отчет о памяти в лог по SIGUSR1 (если платформа поддерживает сигналы)."""
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    try:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, lambda: loop.create_task(_log_report()))
+        logger.info("Memory report will be logged on SIGUSR1")
+    except (NotImplementedError, RuntimeError) as e:
+        logger.warning(f"Could not install SIGUSR1 handler: {str(e)}")
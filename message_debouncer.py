@@ -0,0 +1,103 @@
+"""
+Объединение нескольких сообщений, отправленных подряд, в один запрос.
+
+Пользователи часто разбивают одну мысль на 3–4 коротких сообщения. Вместо
+отдельного запроса к модели на каждое сообщение бот ждет паузу в
+MESSAGE_DEBOUNCE_WINDOW секунд (но не дольше MESSAGE_DEBOUNCE_MAX_WAIT с
+первого сообщения) и отправляет модели все тексты одним сообщением. Ответ
+приходит на последнее сообщение.
+
+Обработчик только добавляет текст и сразу возвращается, а объединенный
+запрос выполняется отдельной задачей приложения. Команды, фото и нажатия
+кнопок (например, выбор модели изображений) отправляют накопленные сообщения
+сразу, до своей обработки (см. flush_pending_messages). При остановке бота
+накопленные сообщения обрабатываются до выхода (flush_all).
+"""
+import asyncio
+
+import metrics
+from logger_setup import logger
+from config import MESSAGE_DEBOUNCE_WINDOW, MESSAGE_DEBOUNCE_MAX_WAIT
+
+
+class _Burst:
+    __slots__ = ("texts", "update", "context", "callback", "started", "timer")
+
+    def __init__(self, update, context, callback, started):
+        self.texts = []
+        self.update = update
+        self.context = context
+        self.callback = callback
+        self.started = started
+        self.timer = None
+
+
+class MessageDebouncer:
+    def __init__(self, window=MESSAGE_DEBOUNCE_WINDOW, max_wait=MESSAGE_DEBOUNCE_MAX_WAIT):
+        self.window = window
+        self.max_wait = max_wait
+        # (chat_id, user_id) -> накапливаемая серия сообщений
+        self._pending = {}
+
+    def add(self, key, update, context, text, callback):
+        """
+        Добавляет текст в серию сообщений. Когда серия закончится, будет вызван
+        callback(update, context, объединенный_текст) с последним обновлением.
+        """
+        loop = asyncio.get_running_loop()
+        burst = self._pending.get(key)
+        if burst is None:
+            burst = self._pending[key] = _Burst(update, context, callback, loop.time())
+        else:
+            burst.timer.cancel()
+            burst.update = update
+            burst.context = context
+        burst.texts.append(text)
+        delay = min(self.window, burst.started + self.max_wait - loop.time())
+        burst.timer = loop.call_later(max(0.0, delay), self.flush, key)
+
+    def _take(self, key):
+        """Забирает серию из ожидания; возвращает ее и объединенный текст."""
+        burst = self._pending.pop(key)
+        burst.timer.cancel()
+        if len(burst.texts) > 1:
+            metrics.increment("messages_coalesced", len(burst.texts) - 1)
+            logger.info(f"Merged {len(burst.texts)} consecutive messages of user {key[1]} into one request")
+        return burst, "\n".join(burst.texts)
+
+    def flush(self, key):
+        """Сразу запускает обработку накопленной серии. Возвращает задачу или None, если серии нет."""
+        if key not in self._pending:
+            return None
+        burst, text = self._take(key)
+        return burst.context.application.create_task(burst.callback(burst.update, burst.context, text), update=burst.update)
+
+    async def flush_all(self):
+        """Обрабатывает все накопленные серии и дожидается ответов (при остановке бота)."""
+        bursts = [self._take(key) for key in list(self._pending)]
+        if bursts:
+            logger.info(f"Answering {len(bursts)} pending message bursts before shutdown")
+        await asyncio.gather(
+            *(burst.callback(burst.update, burst.context, text) for burst, text in bursts),
+            return_exceptions=True,
+        )
+
+
+message_debouncer = MessageDebouncer()
+
+
+async def flush_pending_messages(update, context):
+    """Команда, фото или нажатие кнопки сначала отправляет накопленные сообщения пользователя."""
+    if update.effective_user is None or update.effective_chat is None:
+        return
+    if update.callback_query is None:
+        message = update.message
+        if message is None:
+            return
+        is_command = bool(message.text and message.text.startswith("/"))
+        if not (is_command or message.photo):
+            return
+    if message_debouncer.flush((update.effective_chat.id, update.effective_user.id)) is not None:
+        # Даем объединенному запросу начаться (и прочитать режим и модель) раньше,
+        # чем команда или кнопка изменит сессию
+        await asyncio.sleep(0)
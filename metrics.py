@@ -0,0 +1,75 @@
+"""
+Простые метрики бота в памяти процесса: счетчики, значения и наблюдения.
+
+Сводку можно получить командой /metrics (только для ADMIN_IDS); кроме того,
+она пишется в лог каждые METRICS_LOG_INTERVAL секунд.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+
+from logger_setup import logger
+from config import METRICS_LOG_INTERVAL
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_observations = {}
+
+
+def _metric_name(name, labels):
+    if not labels:
+        return name
+    label_text = ",".join(f"{key}={value}" for key, value in sorted(labels.items()))
+    return f"{name}{{{label_text}}}"
+
+
+def increment(name, value=1, **labels):
+    """Увеличивает счетчик."""
+    with _lock:
+        _counters[_metric_name(name, labels)] += value
+
+
+def set_gauge(name, value, **labels):
+    """Устанавливает текущее значение метрики."""
+    with _lock:
+        _gauges[_metric_name(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Добавляет наблюдение (например, задержку) в сводку count/sum/max."""
+    with _lock:
+        summary = _observations.setdefault(_metric_name(name, labels), {"count": 0, "sum": 0.0, "max": 0.0})
+        summary["count"] += 1
+        summary["sum"] += value
+        summary["max"] = max(summary["max"], value)
+
+
+def snapshot():
+    """Возвращает копию всех метрик."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "observations": {name: dict(summary) for name, summary in _observations.items()},
+        }
+
+
+def format_snapshot():
+    """Форматирует метрики для лога или сообщения администратору."""
+    data = snapshot()
+    lines = [f"{name} = {value:g}" for name, value in sorted(data["counters"].items())]
+    lines += [f"{name} = {value:g}" for name, value in sorted(data["gauges"].items())]
+    for name, summary in sorted(data["observations"].items()):
+        average = summary["sum"] / summary["count"] if summary["count"] else 0.0
+        lines.append(f"{name}: count={summary['count']} avg={average:.3f} max={summary['max']:.3f}")
+    return "\n".join(lines) if lines else "No metrics recorded yet"
+
+
+async def log_periodically(interval=METRICS_LOG_INTERVAL):
+    """Фоновая задача: пишет сводку метрик в лог."""
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(f"Metrics:\n{format_snapshot()}")
@@ -0,0 +1,187 @@
+"""
+Реестр моделей из models.json.
+
+Реестр проверяет конфигурацию, заранее строит клавиатуры выбора модели и
+отображаемые имена и перечитывает файл без перезапуска бота: по изменению
+файла или по сигналу SIGHUP. Новая конфигурация подменяет старую целиком,
+поэтому обработчики никогда не видят наполовину загруженный файл.
+"""
+import json
+import signal
+import asyncio
+import traceback
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from logger_setup import logger
+from config import MODELS_FILE, MODELS_RELOAD_INTERVAL, REQUEST_TIMEOUT, IMAGE_REQUEST_TIMEOUT
+
+MODEL_TYPES = ("text", "image")
+
+
+class ModelConfigError(Exception):
+    """Ошибка в содержимом models.json."""
+
+
+def validate_models_config(models_config):
+    """Проверяет структуру models.json и возвращает ее без изменений."""
+    if not isinstance(models_config, dict):
+        raise ModelConfigError("models.json must contain an object")
+
+    for model_type in MODEL_TYPES:
+        models = models_config.get(model_type)
+        if not isinstance(models, dict) or not models:
+            raise ModelConfigError(f"Section '{model_type}' must be a non-empty object")
+
+        for model_id, model_info in models.items():
+            if not isinstance(model_info, dict):
+                raise ModelConfigError(f"Model '{model_id}' must be an object")
+            if not isinstance(model_info.get("provider"), str) or not model_info["provider"]:
+                raise ModelConfigError(f"Model '{model_id}' has no provider")
+            if not isinstance(model_info.get("display_name", model_id), str):
+                raise ModelConfigError(f"Model '{model_id}' has invalid display_name")
+            if not isinstance(model_info.get("vision", False), bool):
+                raise ModelConfigError(f"Model '{model_id}' has invalid vision flag")
+            timeout = model_info.get("timeout", 1)
+            if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+                raise ModelConfigError(f"Model '{model_id}' has invalid timeout")
+            quota = model_info.get("quota", {})
+            if not isinstance(quota, dict) or any(
+                kind not in ("requests", "tokens", "images")
+                or isinstance(limit, bool) or not isinstance(limit, int) or limit < 0
+                for kind, limit in quota.items()
+            ):
+                raise ModelConfigError(f"Model '{model_id}' has invalid quota")
+
+    return models_config
+
+
+class _RegistrySnapshot:
+    """Неизменяемый снимок конфигурации с кешем построенных клавиатур."""
+
+    def __init__(self, models_config, mtime):
+        self.config = models_config
+        self.mtime = mtime
+        self.display_names = {
+            model_type: {
+                model_id: model_info.get("display_name", model_id)
+                for model_id, model_info in models_config[model_type].items()
+            }
+            for model_type in MODEL_TYPES
+        }
+        # Клавиатуры строятся один раз для каждого набора недоступных моделей
+        self.keyboards = {}
+
+    def keyboard(self, model_type, unavailable=frozenset(), hide_unavailable=False):
+        key = (model_type, unavailable, hide_unavailable)
+        keyboard = self.keyboards.get(key)
+        if keyboard is None:
+            rows = []
+            for model_id, display_name in self.display_names[model_type].items():
+                if model_id in unavailable:
+                    if hide_unavailable:
+                        continue
+                    display_name = f"⚠️ {display_name}"
+                rows.append([InlineKeyboardButton(display_name, callback_data=f"model:{model_type}:{model_id}")])
+            keyboard = InlineKeyboardMarkup(rows)
+            self.keyboards[key] = keyboard
+        return keyboard
+
+
+class ModelRegistry:
+    def __init__(self, path=MODELS_FILE):
+        self.path = path
+        self._snapshot = None
+        self._seen_mtime = None
+
+    def load(self):
+        """Загружает models.json. При ошибке при первой загрузке выбрасывает исключение."""
+        try:
+            mtime = self.path.stat().st_mtime
+            with open(self.path, "r", encoding="utf-8") as f:
+                models_config = validate_models_config(json.load(f))
+        except Exception as e:
+            logger.error(f"Failed to load models configuration: {str(e)}")
+            raise
+
+        previous = self._snapshot
+        self._snapshot = _RegistrySnapshot(models_config, mtime)
+        logger.info(f"Loaded {len(models_config['text'])} text models and {len(models_config['image'])} image models")
+
+        if previous is not None:
+            for model_type in MODEL_TYPES:
+                removed = set(previous.config[model_type]) - set(models_config[model_type])
+                if removed:
+                    logger.warning(f"Removed {model_type} models: {', '.join(sorted(removed))}")
+        return models_config
+
+    def reload(self):
+        """Перечитывает models.json, оставляя прежнюю конфигурацию при ошибке."""
+        try:
+            self.load()
+            return True
+        except Exception:
+            logger.warning("Keeping previous models configuration")
+            logger.debug(traceback.format_exc())
+            return False
+
+    @property
+    def config(self):
+        return self._snapshot.config
+
+    def models(self, model_type):
+        return self._snapshot.config[model_type]
+
+    def get(self, model_type, model_id):
+        """Возвращает описание модели или None, если модели нет в конфигурации."""
+        return self._snapshot.config[model_type].get(model_id)
+
+    def display_name(self, model_type, model_id):
+        return self._snapshot.display_names[model_type].get(model_id, model_id)
+
+    def timeout(self, model_type, model_id):
+        """Срок выполнения запроса к модели, секунды."""
+        default = IMAGE_REQUEST_TIMEOUT if model_type == "image" else REQUEST_TIMEOUT
+        model_info = self.get(model_type, model_id) or {}
+        return model_info.get("timeout", default)
+
+    def quota(self, model_type, model_id):
+        """Дополнительные лимиты модели: {"requests": ..., "tokens": ..., "images": ...}."""
+        model_info = self.get(model_type, model_id) or {}
+        return model_info.get("quota", {})
+
+    def keyboard(self, model_type, unavailable=frozenset(), hide_unavailable=False):
+        """Клавиатура выбора модели; недоступные модели помечаются или скрываются."""
+        return self._snapshot.keyboard(model_type, unavailable, hide_unavailable)
+
+    def _file_changed(self):
+        """Проверяет, изменился ли файл с последней попытки загрузки."""
+        try:
+            mtime = self.path.stat().st_mtime
+        except OSError:
+            return False
+        changed = mtime != self._snapshot.mtime and mtime != self._seen_mtime
+        self._seen_mtime = mtime
+        return changed
+
+    async def watch(self, interval=MODELS_RELOAD_INTERVAL):
+        """Следит за изменением файла и перезагружает конфигурацию."""
+        logger.info(f"Watching {self.path} for changes every {interval}s")
+        while True:
+            await asyncio.sleep(interval)
+            if self._file_changed():
+                logger.info(f"{self.path} changed, reloading models configuration")
+                self.reload()
+
+    def install_signal_handler(self):
+        """Перезагружает конфигурацию по SIGHUP (если платформа поддерживает сигналы)."""
+        if not hasattr(signal, "SIGHUP"):
+            return
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload)
+            logger.info("Models configuration will be reloaded on SIGHUP")
+        except (NotImplementedError, RuntimeError) as e:
+            logger.warning(f"Could not install SIGHUP handler: {str(e)}")
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,127 @@
+"""
+Общие исполнители для работы, которая не должна занимать цикл событий.
+
+Кодирование фотографий в base64, сериализация и запись сессий, временные
+файлы и копии изображений на диске выполняются в пуле потоков (или, для
+чисто вычислительных задач, в пуле процессов, если OFFLOAD_CPU_EXECUTOR=process).
+Задержка цикла событий измеряется фоновой задачей и попадает в метрики,
+чтобы было видно, не тормозит ли один пользователь остальных.
+"""
+import time
+import base64
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import metrics
+from logger_setup import logger
+from config import OFFLOAD_WORKERS, OFFLOAD_CPU_EXECUTOR, LOOP_LAG_INTERVAL, LOOP_LAG_WARN
+
+_io_executor = None
+_cpu_executor = None
+# Последняя поставленная задача для каждого ключа: задачи с одним ключом выполняются по порядку
+_chains = {}
+
+
+def _get_io_executor():
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(max_workers=OFFLOAD_WORKERS, thread_name_prefix="offload")
+    return _io_executor
+
+
+def _get_cpu_executor():
+    global _cpu_executor
+    if OFFLOAD_CPU_EXECUTOR != "process":
+        return _get_io_executor()
+    if _cpu_executor is None:
+        _cpu_executor = ProcessPoolExecutor(max_workers=OFFLOAD_WORKERS)
+    return _cpu_executor
+
+
+async def run_io(func, *args):
+    """Выполняет блокирующую функцию (диск, сеть) в пуле потоков."""
+    return await asyncio.get_running_loop().run_in_executor(_get_io_executor(), func, *args)
+
+
+async def run_cpu(func, *args):
+    """
+    Выполняет вычислительную функцию в пуле для CPU-задач.
+    В режиме process функция и аргументы должны сериализоваться pickle.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_get_cpu_executor(), func, *args)
+
+
+def run_ordered(key, func, *args):
+    """
+    Ставит блокирующую функцию в очередь пула потоков так, что задачи с
+    одинаковым ключом выполняются строго по порядку. Возвращает asyncio.Task.
+    Вне цикла событий (скрипты обслуживания) функция выполняется сразу.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        func(*args)
+        return None
+
+    previous = _chains.get(key)
+
+    async def run_after_previous():
+        if previous is not None:
+            try:
+                await previous
+            except Exception:
+                pass
+        return await run_io(func, *args)
+
+    def forget(done):
+        if _chains.get(key) is done:
+            del _chains[key]
+
+    task = asyncio.ensure_future(run_after_previous())
+    _chains[key] = task
+    task.add_done_callback(forget)
+    return task
+
+
+async def drain():
+    """Дожидается всех поставленных упорядоченных задач."""
+    while _chains:
+        await asyncio.gather(*list(_chains.values()), return_exceptions=True)
+
+
+def shutdown():
+    global _io_executor, _cpu_executor
+    for executor in (_io_executor, _cpu_executor):
+        if executor is not None:
+            executor.shutdown(wait=True)
+    _io_executor = _cpu_executor = None
+
+
+# Кратно 3, чтобы куски кодировались без выравнивания и склеивались в тот же результат
+_BASE64_CHUNK = 3 * 64 * 1024
+
+
+def encode_base64(data):
+    """
+    Кодирует байты в base64 по кускам. b64encode не отпускает GIL, поэтому
+    кодирование большого файла целиком в потоке остановило бы и цикл событий;
+    между кусками GIL переходит к другим потокам.
+    """
+    view = memoryview(data)
+    return "".join(
+        base64.b64encode(view[i:i + _BASE64_CHUNK]).decode("ascii")
+        for i in range(0, len(view), _BASE64_CHUNK)
+    )
+
+
+async def monitor_loop_lag(interval=LOOP_LAG_INTERVAL, warn_threshold=LOOP_LAG_WARN):
+    """Фоновая задача: измеряет, насколько позже запланированного просыпается цикл событий."""
+    logger.info(f"Event loop lag monitor started, interval {interval}s")
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - started - interval)
+        metrics.observe("event_loop_lag_seconds", lag)
+        metrics.set_gauge("event_loop_lag_last_seconds", lag)
+        if lag > warn_threshold:
+            logger.warning(f"Event loop was blocked for {lag * 1000:.0f} ms")
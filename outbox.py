@@ -0,0 +1,316 @@
+"""
+Планировщик исходящих сообщений Telegram.
+
+Все ответы бота проходят через общий планировщик, который соблюдает лимиты
+Telegram: общий лимит бота и лимиты отдельных чатов (в группах строже).
+Интерактивные ответы отправляются раньше служебных действий, ответ 429
+(RetryAfter) обрабатывается повторной отправкой, а длинные тексты делятся
+на части по 4096 символов (часть, в которой разбиение разорвало разметку
+parse_mode, отправляется без разметки). Альбом расходует лимит за каждое изображение, а
+индикаторы действия (typing) имеют в чате свой лимит и не задерживают ответы.
+"""
+import time
+import asyncio
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+import metrics
+from logger_setup import logger
+from config import (
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_PRIVATE_CHAT_RATE,
+    TELEGRAM_GROUP_CHAT_RATE,
+    TELEGRAM_SEND_RETRIES,
+    TELEGRAM_CHAT_ACTION_RATE,
+    CHAT_ACTION_INTERVAL,
+    CHAT_ACTION_MAX_REFRESHES,
+)
+
+# Приоритеты: меньше — важнее
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PROGRESS = 1
+
+# Лимиты чата: сообщения и индикаторы действия учитываются отдельно
+BUDGET_MESSAGES = "messages"
+BUDGET_ACTIONS = "actions"
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Запас токенов чата: сколько сообщений можно отправить подряд без ожидания
+CHAT_BURST = 3
+
+# Сколько корзин чатов хранить, прежде чем удалять неактивные
+MAX_IDLE_BUCKETS = 10000
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Сколько секунд ждать до появления токена."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now, amount=1):
+        # Запрос дороже одного токена (альбом) уходит в минус: следующие подождут дольше
+        self._refill(now)
+        self.tokens -= amount
+
+    def pause(self, seconds):
+        """Останавливает отправку на время, указанное Telegram в RetryAfter."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def is_idle(self, now):
+        return now >= self.paused_until and self.delay(now) == 0 and self.tokens >= self.capacity
+
+
+class _PendingSend:
+    __slots__ = ("priority", "seq", "chat_id", "is_group", "budget", "cost", "future", "enqueued_at")
+
+    def __init__(self, priority, seq, chat_id, is_group, budget, cost, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.is_group = is_group
+        self.budget = budget
+        self.cost = cost
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class OutboundScheduler:
+    def __init__(self,
+                 global_rate=TELEGRAM_GLOBAL_RATE,
+                 private_rate=TELEGRAM_PRIVATE_CHAT_RATE,
+                 group_rate=TELEGRAM_GROUP_CHAT_RATE,
+                 action_rate=TELEGRAM_CHAT_ACTION_RATE,
+                 max_retries=TELEGRAM_SEND_RETRIES):
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.action_rate = action_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        # (chat_id, лимит) -> TokenBucket
+        self._chats = {}
+        self._pending = []
+        self._seq = 0
+        self._wakeup = None
+        self._dispatcher = None
+
+    def _chat_bucket(self, chat_id, is_group, budget=BUDGET_MESSAGES):
+        bucket = self._chats.get((chat_id, budget))
+        if bucket is None:
+            if budget == BUDGET_ACTIONS:
+                bucket = TokenBucket(self.action_rate, 1)
+            else:
+                bucket = TokenBucket(self.group_rate if is_group else self.private_rate, CHAT_BURST)
+            self._chats[(chat_id, budget)] = bucket
+            if len(self._chats) > MAX_IDLE_BUCKETS:
+                self._prune_buckets()
+        return bucket
+
+    def _prune_buckets(self):
+        now = time.monotonic()
+        busy = {(pending.chat_id, pending.budget) for pending in self._pending}
+        for key in [k for k, b in self._chats.items() if k not in busy and b.is_idle(now)]:
+            del self._chats[key]
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def _acquire(self, chat_id, is_group, priority, budget, cost):
+        """Ждет своей очереди на отправку в чат."""
+        self._ensure_dispatcher()
+        self._seq += 1
+        pending = _PendingSend(priority, self._seq, chat_id, is_group, budget, cost,
+                               asyncio.get_running_loop().create_future())
+        self._pending.append(pending)
+        metrics.set_gauge("outbox_queue_depth", len(self._pending))
+        self._wakeup.set()
+        await pending.future
+        metrics.observe("outbox_wait_seconds", time.monotonic() - pending.enqueued_at, priority=priority)
+
+    async def _dispatch(self):
+        """Выдает разрешения на отправку в порядке приоритета с учетом лимитов."""
+        while True:
+            self._pending = [p for p in self._pending if not p.future.done()]
+            metrics.set_gauge("outbox_queue_depth", len(self._pending))
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            wait = self._global.delay(now)
+            if wait == 0:
+                wait = None
+                for pending in sorted(self._pending, key=lambda p: (p.priority, p.seq)):
+                    bucket = self._chat_bucket(pending.chat_id, pending.is_group, pending.budget)
+                    chat_delay = bucket.delay(now)
+                    if chat_delay == 0:
+                        self._global.consume(now, pending.cost)
+                        bucket.consume(now, pending.cost)
+                        self._pending.remove(pending)
+                        pending.future.set_result(None)
+                        wait = 0
+                        break
+                    wait = chat_delay if wait is None else min(wait, chat_delay)
+                if wait == 0:
+                    continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def send(self, chat, call, priority=PRIORITY_INTERACTIVE, budget=BUDGET_MESSAGES, cost=1):
+        """
+        Отправляет запрос call() в чат chat с учетом лимитов и повторов после 429.
+        cost — сколько сообщений запрос расходует из лимитов (для альбома — число изображений).
+        """
+        is_group = chat.type in ["group", "supergroup"]
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat.id, is_group, priority, budget, cost)
+            try:
+                return await call()
+            except RetryAfter as e:
+                metrics.increment("outbox_retry_after", chat_type="group" if is_group else "private")
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Telegram flood limit in chat {chat.id}, retrying in {e.retry_after}s")
+                self._chat_bucket(chat.id, is_group, budget).pause(e.retry_after)
+
+
+scheduler = OutboundScheduler()
+
+
+def split_text(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Делит текст на части не длиннее limit, по возможности по границам строк."""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip(" \n")
+    chunks.append(text)
+    return chunks
+
+
+async def reply_text(message, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """Отвечает на сообщение, разбивая длинный текст. Клавиатура прикрепляется к последней части."""
+    reply_markup = kwargs.pop("reply_markup", None)
+    return await _reply_chunks(message, split_text(text), reply_markup, priority, **kwargs)
+
+
+async def _reply_chunks(message, chunks, reply_markup, priority, split=None, **kwargs):
+    split = len(chunks) > 1 if split is None else split
+    sent = None
+    for i, chunk in enumerate(chunks):
+        markup = reply_markup if i == len(chunks) - 1 else None
+        sent = await _send_chunk(
+            message.chat,
+            lambda options, chunk=chunk, markup=markup: message.reply_text(chunk, reply_markup=markup, **options),
+            priority,
+            kwargs,
+            split,
+        )
+    return sent
+
+
+async def _send_chunk(chat, call, priority, options, split):
+    """
+    Отправляет часть текста call(options). Если текст был разбит, граница части
+    могла разорвать разметку (блок кода, жирный текст) — тогда Telegram не
+    разбирает ее, и часть отправляется без parse_mode.
+    """
+    try:
+        return await scheduler.send(chat, lambda: call(options), priority)
+    except BadRequest as e:
+        if not (split and options.get("parse_mode") and "can't parse entities" in str(e).lower()):
+            raise
+        logger.warning(f"Markup of a split message part in chat {chat.id} is broken, sending it as plain text")
+        plain = {key: value for key, value in options.items() if key != "parse_mode"}
+        return await scheduler.send(chat, lambda: call(plain), priority)
+
+
+async def reply_photo(message, priority=PRIORITY_INTERACTIVE, **kwargs):
+    return await scheduler.send(message.chat, lambda: message.reply_photo(**kwargs), priority)
+
+
+async def reply_media_group(message, priority=PRIORITY_INTERACTIVE, **kwargs):
+    # Каждое изображение альбома Telegram считает отдельным сообщением
+    cost = max(1, len(kwargs.get("media") or ()))
+    return await scheduler.send(message.chat, lambda: message.reply_media_group(**kwargs), priority, cost=cost)
+
+
+async def edit_message_text(query, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """
+    Изменяет текст сообщения. Если текст длиннее лимита, в сообщение попадает
+    первая часть, а остальные отправляются ответами; клавиатура — у последней части.
+    """
+    reply_markup = kwargs.pop("reply_markup", None)
+    first, *rest = split_text(text)
+    markup = None if rest else reply_markup
+    edited = await _send_chunk(
+        query.message.chat,
+        lambda options: query.edit_message_text(first, reply_markup=markup, **options),
+        priority,
+        kwargs,
+        bool(rest),
+    )
+    if not rest:
+        return edited
+    return await _reply_chunks(query.message, rest, reply_markup, priority, split=True, **kwargs)
+
+
+async def edit_message_reply_markup(query, reply_markup=None, priority=PRIORITY_INTERACTIVE):
+    return await scheduler.send(query.message.chat, lambda: query.edit_message_reply_markup(reply_markup=reply_markup), priority)
+
+
+async def send_chat_action(bot, chat, action):
+    return await scheduler.send(
+        chat, lambda: bot.send_chat_action(chat_id=chat.id, action=action), PRIORITY_PROGRESS, budget=BUDGET_ACTIONS
+    )
+
+
+def start_chat_action(bot, chat, action, interval=CHAT_ACTION_INTERVAL, max_refreshes=CHAT_ACTION_MAX_REFRESHES):
+    """
+    Показывает действие (typing, upload_photo) в фоне, не задерживая запрос к
+    провайдеру, и обновляет его, пока задача не отменена: Telegram сбрасывает
+    действие примерно через 5 секунд. Возвращает задачу, которую нужно
+    отменить после ответа или ошибки.
+    """
+    return asyncio.ensure_future(_refresh_chat_action(bot, chat, action, interval, max_refreshes))
+
+
+async def _refresh_chat_action(bot, chat, action, interval, max_refreshes):
+    for _ in range(max_refreshes + 1):
+        try:
+            await send_chat_action(bot, chat, action)
+            metrics.increment("chat_actions_sent", action=action)
+        except TelegramError as e:
+            logger.debug(f"Failed to send chat action {action} to chat {chat.id}: {str(e)}")
+        await asyncio.sleep(interval)
+    logger.debug(f"Stopped refreshing chat action {action} in chat {chat.id} after {max_refreshes} refreshes")
@@ -0,0 +1,121 @@
+"""
+Реестр системных промптов.
+
+Промпт хранится один раз и адресуется по хешу содержимого: сессии ссылаются
+на промпт по идентификатору, а одинаковые промпты разных пользователей
+занимают одну строку в памяти и один файл на диске. Здесь же загружаются
+именованные готовые промпты из prompts.json.
+
+Регистрация промпта не обращается к диску: файл промпта записывается в пуле
+потоков вместе с первой сессией, которая на него ссылается, а читается при
+загрузке сессии. В памяти хранятся PROMPT_CACHE_SIZE недавно использованных
+текстов.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import traceback
+from collections import OrderedDict
+
+from logger_setup import logger
+from config import PROMPTS_DIR, PROMPT_PRESETS_FILE, PROMPT_CACHE_SIZE
+
+
+def prompt_id_for(text):
+    """Идентификатор промпта по его содержимому."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:24]
+
+
+class PromptRegistry:
+    def __init__(self, store_dir=PROMPTS_DIR, presets_file=PROMPT_PRESETS_FILE, cache_size=PROMPT_CACHE_SIZE):
+        self.store_dir = store_dir
+        self.presets_file = presets_file
+        self.cache_size = cache_size
+        # prompt_id -> текст, недавно использованные последними
+        self._texts = OrderedDict()
+        # Сессии загружаются и сохраняются в пуле потоков
+        self._lock = threading.Lock()
+        self._presets = None
+
+    def _path(self, prompt_id):
+        return self.store_dir / f"{prompt_id}.txt"
+
+    def _remember(self, prompt_id, text):
+        """Кладет текст в кэш и возвращает общий экземпляр."""
+        with self._lock:
+            text = self._texts.setdefault(prompt_id, text)
+            self._texts.move_to_end(prompt_id)
+            while len(self._texts) > self.cache_size:
+                self._texts.popitem(last=False)
+        return text
+
+    def register(self, text):
+        """Регистрирует промпт и возвращает общий экземпляр текста и его идентификатор."""
+        prompt_id = prompt_id_for(text)
+        return self._remember(prompt_id, text), prompt_id
+
+    def store(self, prompt_id, text):
+        """Записывает файл промпта, если его еще нет. Блокирующая: вызывается в пуле потоков."""
+        path = self._path(prompt_id)
+        if path.exists():
+            return
+        try:
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.store_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(temp_path, path)
+            logger.debug(f"Stored new system prompt {prompt_id} ({len(text)} chars)")
+        except Exception as e:
+            logger.error(f"Failed to store system prompt {prompt_id}: {str(e)}")
+            logger.debug(traceback.format_exc())
+
+    def get(self, prompt_id):
+        """
+        Возвращает общий для всех сессий экземпляр текста промпта или None, если
+        файла нет. Может читать файл: вызывается в пуле потоков при загрузке сессии.
+        """
+        with self._lock:
+            text = self._texts.get(prompt_id)
+            if text is not None:
+                self._texts.move_to_end(prompt_id)
+                return text
+        try:
+            text = self._path(prompt_id).read_text(encoding="utf-8")
+        except OSError as e:
+            logger.error(f"System prompt {prompt_id} not found: {str(e)}")
+            return None
+        return self._remember(prompt_id, text)
+
+    def presets(self):
+        """Готовые промпты: {имя: {"display_name": ..., "prompt": ...}}."""
+        if self._presets is None:
+            try:
+                with open(self.presets_file, "r", encoding="utf-8") as f:
+                    self._presets = json.load(f)
+                logger.info(f"Loaded {len(self._presets)} system prompt presets")
+            except FileNotFoundError:
+                self._presets = {}
+            except Exception as e:
+                logger.error(f"Failed to load system prompt presets: {str(e)}")
+                self._presets = {}
+        return self._presets
+
+    def preset_display_name(self, name, lang):
+        """Название готового промпта на языке интерфейса."""
+        display_name = self.presets()[name].get("display_name", name)
+        if isinstance(display_name, dict):
+            return display_name.get(lang) or display_name.get("ru") or name
+        return display_name
+
+    def preset_prompt(self, name):
+        """Текст готового промпта или None, если его нет в prompts.json."""
+        preset = self.presets().get(name)
+        if preset is None:
+            return None
+        return preset["prompt"]
+
+
+prompt_registry = PromptRegistry()
@@ -0,0 +1,161 @@
+"""
+Классификация ошибок провайдеров и бюджет повторных запросов.
+
+Ошибки делятся на временные (таймауты, 5xx, ограничение частоты, сетевые
+сбои, пустой ответ), которые имеет смысл повторить, и постоянные (неизвестная
+модель, нет доступа, отказ по содержанию, неверный запрос), которые не
+повторяются. Повторы идут с "декоррелированным" случайным интервалом и
+расходуют общий бюджет: каждый обычный запрос пополняет его на долю
+RETRY_BUDGET_RATIO, каждый повтор тратит единицу. Когда провайдер
+недоступен, повторы быстро исчерпывают бюджет и перестают умножать нагрузку.
+"""
+import re
+import time
+import random
+import asyncio
+
+import metrics
+from config import (
+    RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY,
+    RETRY_BUDGET_RATIO,
+    RETRY_BUDGET_MIN_PER_SECOND,
+    RETRY_BUDGET_MAX,
+)
+
+# Категории по имени класса исключения (g4f и aiohttp не импортируются ради классификации)
+_CATEGORIES_BY_CLASS = {
+    "RateLimitError": ("rate_limit", True),
+    "ConversationLimitError": ("rate_limit", True),
+    "TimeoutError": ("timeout", True),
+    "ServerTimeoutError": ("timeout", True),
+    "ClientConnectionError": ("network", True),
+    "ClientPayloadError": ("network", True),
+    "ConnectionError": ("network", True),
+    "ModelNotFoundError": ("model_not_found", False),
+    "ModelNotAllowedError": ("model_not_found", False),
+    "ModelNotSupportedError": ("model_not_found", False),
+    "MissingAuthError": ("auth", False),
+    "NoValidHarFileError": ("auth", False),
+    "PaymentRequiredError": ("auth", False),
+    "MissingRequirementsError": ("provider_unavailable", False),
+    "ProviderNotFoundError": ("provider_unavailable", False),
+    "ProviderNotWorkingError": ("provider_unavailable", False),
+}
+
+# Код ответа берется только из явного контекста ("status: 503", "HTTP 502",
+# "Response 429", "503 Service Unavailable"), а не из любого трехзначного числа
+_STATUS_RE = re.compile(
+    r"(?:status(?:[ _]?code)?|HTTP(?:/\d(?:\.\d)?)?|response|error code)[ _:=]*([45]\d\d)\b"
+    r"|\b([45]\d\d) (?:Too Many|Internal|Bad (?:Gateway|Request)|Service Unavailable|Gateway Time|"
+    r"Unauthorized|Forbidden|Not Found|Payment Required)",
+    re.I,
+)
+_REFUSAL_RE = re.compile(
+    r"content.?policy|safety (?:polic|filter|system)|blocked (?:by|due to) (?:the |our )?(?:content|safety) polic"
+    r"|(?<!connection )\brefus(?:e|ed|al)\b|nsfw|inappropriate",
+    re.I,
+)
+_MESSAGE_PATTERNS = [
+    (re.compile(r"rate.?limit|too many requests|quota", re.I), ("rate_limit", True)),
+    (re.compile(r"timed? ?out|timeout", re.I), ("timeout", True)),
+    (re.compile(r"model.{0,40}(not found|not supported|unknown|does not exist)", re.I), ("model_not_found", False)),
+]
+
+
+class ProviderError(Exception):
+    """Ошибка запроса к провайдеру с категорией для метрик и решения о повторе."""
+
+    def __init__(self, message, provider=None, model=None, category="unknown", transient=False):
+        super().__init__(message)
+        self.provider = provider
+        self.model = model
+        self.category = category
+        self.transient = transient
+
+
+def _status_category(status):
+    if status == 429:
+        return "rate_limit", True
+    if status >= 500:
+        return "server_error", True
+    if status in (401, 402, 403):
+        return "auth", False
+    if status == 404:
+        return "model_not_found", False
+    return "bad_request", False
+
+
+def classify(error):
+    """Возвращает (категория, временная ли ошибка)."""
+    if isinstance(error, ProviderError):
+        return error.category, error.transient
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout", True
+
+    message = str(error)
+    # Отказ по содержанию важнее кода ответа: повтор его не исправит
+    if _REFUSAL_RE.search(message):
+        return "content_refused", False
+    for cls in type(error).__mro__:
+        if cls.__name__ in _CATEGORIES_BY_CLASS:
+            return _CATEGORIES_BY_CLASS[cls.__name__]
+
+    status = getattr(error, "status", None) or getattr(error, "status_code", None)
+    if not isinstance(status, int):
+        match = _STATUS_RE.search(message)
+        status = int(match.group(1) or match.group(2)) if match else None
+    if status is not None:
+        return _status_category(status)
+
+    for pattern, result in _MESSAGE_PATTERNS:
+        if pattern.search(message):
+            return result
+    if isinstance(error, OSError):
+        return "network", True
+    return "unknown", False
+
+
+def wrap_error(error, provider, model):
+    """Превращает исключение провайдера в ProviderError и учитывает его в метриках."""
+    category, transient = classify(error)
+    metrics.increment("provider_errors", provider=provider or "auto", category=category)
+    if isinstance(error, ProviderError):
+        return error
+    return ProviderError(str(error) or type(error).__name__, provider, model, category, transient)
+
+
+class RetryBudget:
+    """Общий бюджет повторов: доля от обычных запросов плюс небольшой постоянный запас."""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_per_second=RETRY_BUDGET_MIN_PER_SECOND, max_tokens=RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.updated) * self.min_per_second)
+        self.updated = now
+
+    def record_request(self):
+        self._refill()
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self):
+        self._refill()
+        metrics.set_gauge("retry_budget_tokens", round(self.tokens, 2))
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def next_delay(previous, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """Декоррелированный случайный интервал: между base и утроенным предыдущим, не больше cap."""
+    return min(cap, random.uniform(base, max(base, previous * 3)))
+
+
+retry_budget = RetryBudget()
@@ -0,0 +1,162 @@
+"""
+Фоновая проверка доступности моделей из models.json.
+
+Планировщик периодически отправляет каждой текстовой модели (и модели
+изображений, если HEALTH_PROBE_IMAGES=1) короткий пробный запрос,
+записывает доступность и задержку и заодно прогревает соединения и импорт
+g4f до прихода пользователей. Общее
+число проверок ограничено бюджетом в час. Модели, которые не отвечают
+несколько проверок подряд, помечаются (или скрываются) в клавиатурах
+/newchat и /image.
+"""
+import time
+import asyncio
+import traceback
+
+import metrics
+from logger_setup import logger
+from ai_client import get_ai_response, generate_image
+from model_registry import model_registry, MODEL_TYPES
+from config import (
+    HEALTH_PROBE_INTERVAL,
+    HEALTH_PROBE_TIMEOUT,
+    HEALTH_PROBE_BUDGET,
+    HEALTH_PROBE_IMAGES,
+    HEALTH_FAILURE_THRESHOLD,
+)
+
+PROBE_MESSAGES = [{"role": "user", "content": "Reply with one word: ok"}]
+PROBE_IMAGE_PROMPT = "a small red circle on a white background"
+
+
+async def default_probe(model_type, model_id, model_info):
+    """Пробный запрос к модели через ai_client (без повторов, чтобы не тратить их бюджет)."""
+    if model_type == "image":
+        await generate_image(model_info["provider"], model_id, PROBE_IMAGE_PROMPT, retry=False)
+    else:
+        await get_ai_response(model_info["provider"], model_id, PROBE_MESSAGES, retry=False)
+
+
+class ModelHealth:
+    __slots__ = ("available", "latency", "last_checked", "failures", "last_error")
+
+    def __init__(self):
+        self.available = True
+        self.latency = None
+        self.last_checked = 0.0
+        self.failures = 0
+        self.last_error = None
+
+
+class ProviderHealth:
+    def __init__(self,
+                 probe=default_probe,
+                 interval=HEALTH_PROBE_INTERVAL,
+                 timeout=HEALTH_PROBE_TIMEOUT,
+                 budget_per_hour=HEALTH_PROBE_BUDGET,
+                 include_images=HEALTH_PROBE_IMAGES,
+                 failure_threshold=HEALTH_FAILURE_THRESHOLD):
+        self.probe = probe
+        self.interval = interval
+        self.timeout = timeout
+        self.budget_per_hour = budget_per_hour
+        self.include_images = include_images
+        self.failure_threshold = failure_threshold
+        self._status = {}
+        self._budget = float(budget_per_hour)
+        self._budget_updated = time.monotonic()
+
+    def status(self, model_type, model_id):
+        key = (model_type, model_id)
+        if key not in self._status:
+            self._status[key] = ModelHealth()
+        return self._status[key]
+
+    def is_available(self, model_type, model_id):
+        health = self._status.get((model_type, model_id))
+        return health is None or health.available
+
+    def unavailable(self, model_type):
+        """Множество моделей данного типа, которые сейчас считаются недоступными."""
+        return frozenset(
+            model_id for (status_type, model_id), health in self._status.items()
+            if status_type == model_type and not health.available
+        )
+
+    def _take_budget(self, count):
+        """Выдает не больше count проверок из часового бюджета."""
+        now = time.monotonic()
+        refill = (now - self._budget_updated) * self.budget_per_hour / 3600
+        self._budget = min(float(self.budget_per_hour), self._budget + refill)
+        self._budget_updated = now
+        granted = min(count, int(self._budget))
+        self._budget -= granted
+        return granted
+
+    async def probe_model(self, model_type, model_id, model_info):
+        """Проверяет одну модель и обновляет ее состояние."""
+        health = self.status(model_type, model_id)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.probe(model_type, model_id, model_info), self.timeout)
+        except Exception as e:
+            health.failures += 1
+            health.last_error = str(e) or type(e).__name__
+            if health.available and health.failures >= self.failure_threshold:
+                health.available = False
+                logger.warning(f"Model {model_type}/{model_id} marked unavailable: {health.last_error}")
+            logger.debug(f"Probe of {model_type}/{model_id} failed: {health.last_error}")
+            metrics.increment("health_probes", model=model_id, result="failure")
+        else:
+            health.latency = time.perf_counter() - started
+            health.failures = 0
+            health.last_error = None
+            if not health.available:
+                health.available = True
+                logger.info(f"Model {model_type}/{model_id} is available again")
+            metrics.increment("health_probes", model=model_id, result="success")
+            metrics.observe("health_probe_latency_seconds", health.latency, model=model_id)
+        finally:
+            health.last_checked = time.time()
+            metrics.set_gauge("model_available", 1 if health.available else 0, model=model_id)
+
+    async def run_round(self):
+        """Проверяет модели, давно не проверявшиеся, в пределах бюджета."""
+        model_types = MODEL_TYPES if self.include_images else ("text",)
+        candidates = [
+            (model_type, model_id, model_info)
+            for model_type in model_types
+            for model_id, model_info in model_registry.models(model_type).items()
+        ]
+        candidates.sort(key=lambda c: self.status(c[0], c[1]).last_checked)
+
+        granted = self._take_budget(len(candidates))
+        if granted < len(candidates):
+            logger.info(f"Probe budget allows {granted} of {len(candidates)} models this round")
+        if granted:
+            await asyncio.gather(*(self.probe_model(*candidate) for candidate in candidates[:granted]))
+            logger.debug(f"Provider health:\n{self.report()}")
+
+    async def run(self):
+        """Фоновая задача: первая проверка сразу (прогрев), затем каждые interval секунд."""
+        logger.info(f"Provider health probing every {self.interval}s, budget {self.budget_per_hour} probes/hour")
+        while True:
+            try:
+                await self.run_round()
+            except Exception as e:
+                logger.error(f"Provider health round failed: {str(e)}")
+                logger.debug(traceback.format_exc())
+            await asyncio.sleep(self.interval)
+
+    def report(self):
+        """Текстовая сводка состояния моделей."""
+        lines = []
+        for (model_type, model_id), health in sorted(self._status.items()):
+            state = "up" if health.available else "DOWN"
+            latency = f"{health.latency:.2f}s" if health.latency is not None else "-"
+            error = f" ({health.last_error})" if health.last_error else ""
+            lines.append(f"{model_type}/{model_id}: {state}, latency {latency}{error}")
+        return "\n".join(lines)
+
+
+provider_health = ProviderHealth()
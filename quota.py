@@ -0,0 +1,311 @@
+"""
+Квоты пользователей и групповых чатов.
+
+Перед запросом к провайдеру проверяются лимиты на число запросов и оценку
+токенов (история плюс ответ) за окно QUOTA_WINDOW и на число изображений
+за сутки — отдельно для пользователя и, в группах, для всего чата. Для
+модели в models.json можно задать дополнительные, более строгие лимиты
+("quota": {"requests": 20, "tokens": 100000, "images": 10}), например для
+рассуждающих моделей.
+
+Запрос учитывается до обращения к провайдеру, а если он завершился ошибкой,
+истек его срок, его отменил новый запрос или изображение взято из кэша,
+учтенное возвращается в квоты (QuotaManager.release).
+
+Использование хранится в скользящих окнах из QUOTA_BUCKETS корзин: память
+не зависит от числа запросов. Окна пользователя сохраняются вместе с его
+сессией, окна групповых чатов — в chats/group_quotas.json.
+"""
+import os
+import json
+import math
+import time
+import asyncio
+import tempfile
+import traceback
+from pathlib import Path
+
+import metrics
+import offload
+from logger_setup import logger
+from model_registry import model_registry
+from translations import get_text
+from config import (
+    ADMIN_IDS,
+    QUOTA_WINDOW,
+    QUOTA_BUCKETS,
+    QUOTA_USER_REQUESTS,
+    QUOTA_USER_TOKENS,
+    QUOTA_USER_IMAGES_PER_DAY,
+    QUOTA_GROUP_REQUESTS,
+    QUOTA_GROUP_TOKENS,
+    QUOTA_GROUP_IMAGES_PER_DAY,
+    GROUP_QUOTA_FILE,
+)
+
+QUOTA_KINDS = ("requests", "tokens", "images")
+DEFAULT_LIMITS = {
+    "user": {"requests": QUOTA_USER_REQUESTS, "tokens": QUOTA_USER_TOKENS, "images": QUOTA_USER_IMAGES_PER_DAY},
+    "group": {"requests": QUOTA_GROUP_REQUESTS, "tokens": QUOTA_GROUP_TOKENS, "images": QUOTA_GROUP_IMAGES_PER_DAY},
+}
+# Грубая оценка числа токенов по длине текста
+CHARS_PER_TOKEN = 4
+
+
+def window_length(kind):
+    """Длина окна, секунды: изображения считаются за сутки, остальное за QUOTA_WINDOW."""
+    return 86400 if kind == "images" else QUOTA_WINDOW
+
+
+def estimate_tokens(*texts):
+    """Оценка числа токенов в текстах (строки или истории чата)."""
+    chars = 0
+    for text in texts:
+        if isinstance(text, str):
+            chars += len(text)
+        elif text is not None:
+            chars += sum(len(content) for _, content in text.pairs() if isinstance(content, str))
+    return chars // CHARS_PER_TOKEN
+
+
+class QuotaExceeded(Exception):
+    """Запрос отклонен: исчерпан лимит пользователя, чата или модели."""
+
+    def __init__(self, scope, kind, model_type, model, retry_after):
+        super().__init__(f"{scope} {kind} quota{f' for {model}' if model else ''} exceeded")
+        self.scope = scope
+        self.kind = kind
+        self.model_type = model_type
+        # Модель, если исчерпан лимит, заданный для нее в models.json
+        self.model = model
+        # Через сколько секунд запрос пройдет; None, если он больше самого лимита
+        self.retry_after = retry_after
+
+
+class SlidingWindow:
+    """Скользящее окно из корзин одинаковой длины; точность ограничена длиной корзины."""
+
+    __slots__ = ("bucket_length", "buckets", "counts")
+
+    def __init__(self, length, buckets=QUOTA_BUCKETS):
+        self.bucket_length = length / buckets
+        self.buckets = buckets
+        # Номер корзины (время // длина корзины) -> сумма
+        self.counts = {}
+
+    def total(self, now):
+        oldest = int(now // self.bucket_length) - self.buckets + 1
+        for index in [index for index in self.counts if index < oldest]:
+            del self.counts[index]
+        return sum(self.counts.values())
+
+    def add(self, amount, now):
+        index = int(now // self.bucket_length)
+        self.counts[index] = self.counts.get(index, 0) + amount
+
+    def retry_after(self, amount, limit, now):
+        """Через сколько секунд из окна уйдет достаточно, чтобы поместилось amount."""
+        if amount > limit:
+            return None
+        excess = self.total(now) + amount - limit
+        for index in sorted(self.counts):
+            excess -= self.counts[index]
+            if excess <= 0:
+                return max(0.0, (index + self.buckets) * self.bucket_length - now)
+        return 0.0
+
+    def to_list(self):
+        # Сохраняется середина корзины, чтобы после смены QUOTA_BUCKETS она попала в нужную корзину
+        return [[int((index + 0.5) * self.bucket_length), count] for index, count in sorted(self.counts.items())]
+
+    @classmethod
+    def from_list(cls, length, items):
+        window = cls(length)
+        for timestamp, count in items:
+            window.add(count, timestamp)
+        return window
+
+
+class QuotaUsage:
+    """Окна использования одного пользователя или чата: общие и для отдельных моделей."""
+
+    __slots__ = ("windows",)
+
+    def __init__(self):
+        # "requests" или "requests:<модель>" -> SlidingWindow
+        self.windows = {}
+
+    def window(self, kind, model=None):
+        key = f"{kind}:{model}" if model else kind
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = SlidingWindow(window_length(kind))
+        return window
+
+    def to_dict(self, now=None):
+        """Снимок непустых окон для записи на диск."""
+        now = now or time.time()
+        return {key: window.to_list() for key, window in self.windows.items() if window.total(now)}
+
+    @classmethod
+    def from_dict(cls, data):
+        usage = cls()
+        for key, items in (data or {}).items():
+            kind = key.split(":", 1)[0]
+            if kind in QUOTA_KINDS:
+                usage.windows[key] = SlidingWindow.from_list(window_length(kind), items)
+        return usage
+
+
+class QuotaCharge:
+    """Учтенный запрос: окна и время учета, чтобы вернуть его в квоты."""
+
+    __slots__ = ("windows", "time", "released")
+
+    def __init__(self, windows, time):
+        self.windows = windows
+        self.time = time
+        self.released = False
+
+
+class QuotaManager:
+    def __init__(self, path=GROUP_QUOTA_FILE, limits=DEFAULT_LIMITS):
+        self.path = Path(path)
+        self.limits = limits
+        # chat_id -> QuotaUsage группового чата
+        self.groups = {}
+        self._dirty = False
+        self._save_task = None
+
+    def _windows(self, session, chat, model_type, amounts, model_amounts):
+        """
+        Окна с лимитами, которые затрагивает запрос: (scope, kind, model, window, amount, limit).
+        amounts учитываются в общих лимитах, model_amounts ({модель: amounts}) — в лимитах моделей.
+        """
+        subjects = [("user", session.quota_usage)]
+        if chat is not None and chat.type in ("group", "supergroup"):
+            subjects.append(("group", self.groups.setdefault(chat.id, QuotaUsage())))
+        for scope, usage in subjects:
+            for kind, amount in amounts.items():
+                limit = self.limits[scope][kind]
+                if amount and limit:
+                    yield scope, kind, None, usage.window(kind), amount, limit
+            for model, per_model in model_amounts.items():
+                model_limits = model_registry.quota(model_type, model)
+                for kind, amount in per_model.items():
+                    limit = model_limits.get(kind, 0)
+                    if amount and limit:
+                        yield scope, kind, model, usage.window(kind, model), amount, limit
+
+    def acquire(self, user_id, session, chat, model_type, model, tokens=0, images=0, variant_models=None):
+        """
+        Проверяет все лимиты и учитывает запрос. Возвращает QuotaCharge для
+        release() (None для администраторов). Если какой-то лимит исчерпан,
+        выбрасывает QuotaExceeded и ничего не учитывает.
+
+        variant_models — модели вариантов изображения, по одной на изображение:
+        лимиты каждой модели проверяются по числу ее изображений.
+        """
+        if user_id in ADMIN_IDS:
+            return None
+        now = time.time()
+        amounts = {"requests": 1, "tokens": tokens, "images": images}
+        if variant_models:
+            model_amounts = {m: {"requests": 1, "images": variant_models.count(m)} for m in dict.fromkeys(variant_models)}
+        else:
+            model_amounts = {model: amounts}
+        windows = list(self._windows(session, chat, model_type, amounts, model_amounts))
+        for scope, kind, limited_model, window, amount, limit in windows:
+            if window.total(now) + amount > limit:
+                metrics.increment("quota_rejections", scope=scope, kind=kind)
+                logger.info(f"Rejected request of user {user_id}: {scope} {kind} quota exceeded"
+                            f"{f' for {limited_model}' if limited_model else ''}")
+                raise QuotaExceeded(scope, kind, model_type, limited_model, window.retry_after(amount, limit, now))
+        return self._record(windows, now)
+
+    def record_tokens(self, user_id, session, chat, model_type, model, tokens):
+        """Учитывает токены ответа после его получения (без проверки лимита)."""
+        if user_id in ADMIN_IDS or not tokens:
+            return
+        amounts = {"tokens": tokens}
+        self._record(list(self._windows(session, chat, model_type, amounts, {model: amounts})), time.time())
+
+    def release(self, charge):
+        """Возвращает в квоты запрос, который не выполнен или не потребовал провайдера."""
+        if charge is None or charge.released:
+            return
+        charge.released = True
+        for scope, kind, limited_model, window, amount, limit in charge.windows:
+            # Вычитается из той же корзины; если она уже вышла из окна, вычитать нечего
+            window.add(-amount, charge.time)
+            if scope == "group":
+                self._schedule_save()
+        metrics.increment("quota_refunds")
+
+    def _record(self, windows, now):
+        for scope, kind, limited_model, window, amount, limit in windows:
+            window.add(amount, now)
+            if scope == "group":
+                self._schedule_save()
+        return QuotaCharge(windows, now)
+
+    # Хранение использования групповых чатов
+
+    def load(self):
+        """Читает использование групповых чатов (при запуске, в пуле потоков)."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Failed to load group quota usage: {str(e)}")
+            logger.debug(traceback.format_exc())
+            return
+        for chat_id, usage in data.items():
+            self.groups.setdefault(int(chat_id), QuotaUsage.from_dict(usage))
+        logger.info(f"Loaded quota usage of {len(data)} group chats")
+
+    def _schedule_save(self):
+        # Все изменения одного цикла записываются одной задачей
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.ensure_future(self._save())
+
+    async def _save(self):
+        await asyncio.sleep(0)
+        while self._dirty:
+            self._dirty = False
+            now = time.time()
+            snapshot = {}
+            for chat_id, usage in list(self.groups.items()):
+                data = usage.to_dict(now)
+                if data:
+                    snapshot[str(chat_id)] = data
+                else:
+                    del self.groups[chat_id]
+            await offload.run_ordered(("group_quotas", self.path), self._write, snapshot)
+
+    def _write(self, snapshot):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logger.error(f"Failed to save group quota usage: {str(e)}")
+            logger.debug(traceback.format_exc())
+
+
+def rejection_text(error, lang):
+    """Сообщение пользователю об исчерпанном лимите."""
+    if error.retry_after is None:
+        return get_text("quota_request_too_large", lang)
+    minutes = max(1, math.ceil(error.retry_after / 60))
+    if error.model:
+        return get_text("quota_model", lang, model_registry.display_name(error.model_type, error.model), minutes)
+    return get_text(f"quota_{error.scope}_{error.kind}", lang, minutes)
+
+
+quota_manager = QuotaManager()
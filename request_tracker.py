@@ -0,0 +1,103 @@
+"""
+Учет выполняющихся запросов пользователей к провайдерам.
+
+У каждого пользователя в каждом чате может быть только один активный
+запрос: сообщение в группе не отменяет ответ в личном чате. Новое
+сообщение в том же чате отменяет предыдущий запрос, а /newchat или выбор
+другой модели очищают общую историю и потому отменяют запросы
+пользователя во всех чатах, чтобы устаревший ответ не попал в нее. Отмена сразу
+освобождает место в лимите провайдера. Каждый запрос ограничен сроком,
+заданным для модели.
+
+Обработчики обновлений одного пользователя выполняются по очереди
+(serialize_per_user), поэтому многошаговые сценарии в user_data и
+переход от фото к вопросу видят обновления в порядке их прихода. Долгие
+запросы к провайдерам обработчики запускают отдельными задачами, чтобы
+очередь не ждала ответа модели.
+"""
+import asyncio
+import functools
+
+import metrics
+from logger_setup import logger
+
+# (chat_id, user_id) -> выполняющийся запрос
+_active_requests = {}
+# Запросы, отмененные из-за нового запроса того же пользователя
+_superseded = set()
+# user_id -> [блокировка, число обработчиков, ожидающих ее или держащих]
+_user_locks = {}
+
+
+class RequestSuperseded(Exception):
+    """Запрос отменен, потому что пользователь начал новый."""
+
+
+def cancel_user_request(user_id, reason="superseded", chat_id=None):
+    """
+    Отменяет активный запрос пользователя в чате chat_id или, если чат не
+    указан, во всех чатах. Возвращает True, если был отменен хотя бы один.
+    """
+    if chat_id is None:
+        keys = [key for key in _active_requests if key[1] == user_id]
+    else:
+        keys = [(chat_id, user_id)]
+    cancelled = False
+    for key in keys:
+        task = _active_requests.pop(key, None)
+        if task is None or task.done():
+            continue
+        _superseded.add(task)
+        task.cancel()
+        cancelled = True
+        metrics.increment("requests_cancelled", reason=reason)
+        logger.info(f"Cancelled in-flight request of user {user_id} in chat {key[0]} ({reason})")
+    return cancelled
+
+
+async def run_user_request(chat_id, user_id, coro, timeout=None):
+    """
+    Выполняет запрос пользователя в чате, отменив предыдущий запрос в том же чате.
+    Выбрасывает RequestSuperseded, если запрос отменен новым, и
+    asyncio.TimeoutError, если истек срок.
+    """
+    key = (chat_id, user_id)
+    cancel_user_request(user_id, reason="new request", chat_id=chat_id)
+    task = asyncio.ensure_future(asyncio.wait_for(coro, timeout) if timeout else coro)
+    _active_requests[key] = task
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if task in _superseded:
+            raise RequestSuperseded()
+        raise
+    except asyncio.TimeoutError:
+        metrics.increment("requests_timed_out")
+        logger.warning(f"Request of user {user_id} exceeded its {timeout}s deadline")
+        raise
+    finally:
+        _superseded.discard(task)
+        if _active_requests.get(key) is task:
+            del _active_requests[key]
+
+
+def serialize_per_user(callback):
+    """
+    Оборачивает обработчик так, чтобы обновления одного пользователя
+    обрабатывались по очереди; обновления разных пользователей идут параллельно.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        user = update.effective_user
+        if user is None:
+            return await callback(update, context)
+        entry = _user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await callback(update, context)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _user_locks[user.id]
+    return wrapper
@@ -1,43 +1,69 @@
-import pickle
+import asyncio
+import hashlib
 import datetime
 import traceback
+import offload
 from logger_setup import logger
-from config import CHATS_DIR, MODELS_CONFIG
+from config import CHATS_DIR
+from chat_history import ChatHistory
+from session_format import SESSION_SUFFIX, LEGACY_SUFFIX, FORMAT_VERSION, write_session, read_session, load_legacy_pickle
+from model_registry import model_registry
+from prompt_registry import prompt_registry
+from quota import QuotaUsage
 
 # User sessions storage
 user_sessions = {}
+# Загрузки сессий из файлов, которые сейчас выполняются: user_id -> asyncio.Task
+_loading = {}
 
 class UserSession:
     def __init__(self):
-        self.history = []
+        self.history = ChatHistory()
         self.current_model = None
         self.provider = None
-        self.system_prompt = None
+        # Системный промпт хранится в реестре промптов; сессия держит его идентификатор
+        # и общий для всех сессий экземпляр текста
+        self.system_prompt_id = None
+        self._system_prompt = None
         self.is_image_mode = False
         self.last_image = None
         self.interface_language = "ru"  # По умолчанию русский язык интерфейса
         # Добавляем переменную для отслеживания генерации изображений в групповом чате
         self.group_image_generated = False
+        # Сколько вариантов изображения генерировать и дополнительные модели для них
+        self.image_variants = 1
+        self.image_variant_models = []
+        # Использование квот (скользящие окна), сохраняется вместе с сессией
+        self.quota_usage = QuotaUsage()
+    
+    @property
+    def system_prompt(self):
+        """Текст системного промпта (общий экземпляр из реестра промптов)."""
+        return self._system_prompt
+    
+    @system_prompt.setter
+    def system_prompt(self, prompt):
+        if prompt:
+            self._system_prompt, self.system_prompt_id = prompt_registry.register(prompt)
+        else:
+            self._system_prompt = self.system_prompt_id = None
     
     def add_message(self, role, content):
-        self.history.append({"role": role, "content": content})
+        self.history.add(role, content)
         logger.debug(f"Added message with role '{role}', content length: {len(content) if content else 0}")
     
     def clear_history(self):
         logger.debug(f"Clearing history of {len(self.history)} messages")
-        self.history = []
+        self.history.clear()
         if self.system_prompt:
             self.add_message("system", self.system_prompt)
         self.last_image = None
     
     def set_model(self, model_name, model_type="text"):
-        config = MODELS_CONFIG["text"] if model_type == "text" else MODELS_CONFIG["image"]
-        if model_name in config:
+        model_info = model_registry.get(model_type, model_name)
+        if model_info is not None:
             self.current_model = model_name
-            if model_type == "text":
-                self.provider = config[model_name]["provider"]
-            else:
-                self.provider = config[model_name]["provider"]
+            self.provider = model_info["provider"]
             self.is_image_mode = (model_type == "image")
             # Сбрасываем флаг генерации изображения в групповом чате при выборе модели
             self.group_image_generated = False
@@ -47,6 +73,40 @@ class UserSession:
         logger.warning(f"Attempted to set unknown model: {model_name} of type {model_type}")
         return False
     
+    def set_image_variants(self, count, extra_models=()):
+        """Задает число вариантов изображения и дополнительные модели для них."""
+        self.image_variants = count
+        self.image_variant_models = [m for m in extra_models if model_registry.get("image", m)]
+        logger.info(f"Image variants set to {count}, extra models: {self.image_variant_models}")
+    
+    def get_image_variant_plan(self):
+        """Возвращает список моделей для каждого варианта изображения."""
+        models = [self.current_model] + [
+            m for m in self.image_variant_models
+            if m != self.current_model and model_registry.get("image", m)
+        ]
+        return [models[i % len(models)] for i in range(self.image_variants)]
+    
+    @property
+    def model_type(self):
+        return "image" if self.is_image_mode else "text"
+    
+    def refresh_model(self):
+        """
+        Сверяет выбранную модель с текущей конфигурацией после перезагрузки models.json.
+        Если модель удалена, сбрасывает выбор и возвращает False.
+        """
+        if not self.current_model:
+            return False
+        model_info = model_registry.get(self.model_type, self.current_model)
+        if model_info is None:
+            logger.warning(f"Model {self.current_model} is no longer configured, resetting selection")
+            self.current_model = None
+            self.provider = None
+            return False
+        self.provider = model_info["provider"]
+        return True
+    
     def reset_image_model_in_group(self):
         """Сбрасывает модель генерации изображений в групповом чате."""
         if self.is_image_mode:
@@ -65,7 +125,8 @@ class UserSession:
     
     def supports_vision(self):
         if self.current_model and not self.is_image_mode:
-            return MODELS_CONFIG["text"][self.current_model].get("vision", False)
+            model_info = model_registry.get("text", self.current_model)
+            return bool(model_info and model_info.get("vision", False))
         return False
     
     def set_interface_language(self, language_code):
@@ -82,6 +143,96 @@ class UserSession:
         return self.interface_language
 
 
+def session_shard(user_id):
+    """Подкаталог сессии: первые два символа хеша идентификатора (256 каталогов)."""
+    return hashlib.sha256(str(user_id).encode("utf-8")).hexdigest()[:2]
+
+
+def sharded_session_path(user_id):
+    """Путь к файлу сессии в подкаталоге-шарде; новые сессии пишутся сюда."""
+    return CHATS_DIR / session_shard(user_id) / f"user_{user_id}{SESSION_SUFFIX}"
+
+
+def flat_session_path(user_id):
+    """Путь к файлу сессии в общем каталоге (до перераспределения по шардам)."""
+    return CHATS_DIR / f"user_{user_id}{SESSION_SUFFIX}"
+
+
+def session_path(user_id):
+    """Путь к существующему файлу сессии: сначала в шарде, затем в общем каталоге."""
+    path = sharded_session_path(user_id)
+    if not path.exists():
+        flat_path = flat_session_path(user_id)
+        if flat_path.exists():
+            return flat_path
+    return path
+
+
+def legacy_session_path(user_id):
+    """Путь к файлу сессии в старом формате pickle."""
+    return CHATS_DIR / f"user_{user_id}{LEGACY_SUFFIX}"
+
+
+def _serialize_session(session, last_interaction=None):
+    """Создает снимок сессии для записи на диск (в том числе из другого потока)."""
+    return {
+        "history": session.history.copy(),
+        "current_model": session.current_model,
+        "provider": session.provider,
+        "system_prompt_id": session.system_prompt_id,
+        "system_prompt_text": session.system_prompt,
+        "is_image_mode": session.is_image_mode,
+        "last_interaction": last_interaction or datetime.datetime.now().isoformat(),
+        "interface_language": session.interface_language,
+        "group_image_generated": session.group_image_generated,
+        "image_variants": session.image_variants,
+        "image_variant_models": list(session.image_variant_models),
+        "quota_usage": session.quota_usage.to_dict(),
+    }
+
+
+def _deserialize_session(session_data):
+    """Создает объект сессии из данных, прочитанных с диска."""
+    session = UserSession()
+    
+    # Старые форматы хранят текст промпта, новый — ссылку на него
+    prompt_id = session_data.get("system_prompt_id")
+    if prompt_id:
+        prompt_text = prompt_registry.get(prompt_id)
+        if prompt_text is None:
+            logger.warning(f"Dropping reference to missing system prompt {prompt_id}")
+        else:
+            session.system_prompt_id = prompt_id
+            session._system_prompt = prompt_text
+    else:
+        session.system_prompt = session_data.get("system_prompt")
+    
+    # Системные сообщения ссылаются на общий экземпляр текста промпта
+    prompt_text = session.system_prompt
+    for message in session_data["history"]:
+        content = message["content"]
+        if message["role"] == "system" and content == prompt_text:
+            content = prompt_text
+        session.history.add(message["role"], content)
+    
+    session.current_model = session_data["current_model"]
+    session.provider = session_data["provider"]
+    session.is_image_mode = session_data["is_image_mode"]
+    
+    # Load interface language if available
+    if "interface_language" in session_data:
+        session.interface_language = session_data["interface_language"]
+        
+    # Load group_image_generated flag if available
+    if "group_image_generated" in session_data:
+        session.group_image_generated = session_data["group_image_generated"]
+    
+    session.image_variants = session_data.get("image_variants", 1)
+    session.image_variant_models = session_data.get("image_variant_models", [])
+    session.quota_usage = QuotaUsage.from_dict(session_data.get("quota_usage"))
+    return session
+
+
 def save_user_session(user_id):
     """Сохраняет сессию пользователя в файл."""
     if user_id not in user_sessions:
@@ -96,24 +247,10 @@ def save_user_session(user_id):
         return False
     
     try:
-        chat_file = CHATS_DIR / f"user_{user_id}.pickle"
-        
-        # Create a serializable representation of the session
-        session_data = {
-            "history": session.history,
-            "current_model": session.current_model,
-            "provider": session.provider,
-            "system_prompt": session.system_prompt,
-            "is_image_mode": session.is_image_mode,
-            "last_interaction": datetime.datetime.now().isoformat(),
-            "interface_language": session.interface_language,
-            "group_image_generated": session.group_image_generated,
-        }
-        
-        with open(chat_file, "wb") as f:
-            pickle.dump(session_data, f)
-        
-        logger.debug(f"Saved session for user {user_id} with {len(session.history)} messages")
+        # Снимок сессии делается сразу, а сжатие и запись идут в пуле потоков,
+        # по порядку для каждого пользователя
+        session_data = _serialize_session(session)
+        offload.run_ordered(("session", user_id), _write_session_file, user_id, session_data)
         return True
     except Exception as e:
         logger.error(f"Error saving session for user {user_id}: {str(e)}")
@@ -121,44 +258,149 @@ def save_user_session(user_id):
         return False
 
 
-def load_user_session(user_id):
-    """Загружает сессию пользователя из файла."""
-    chat_file = CHATS_DIR / f"user_{user_id}.pickle"
-    
-    if not chat_file.exists():
-        logger.debug(f"No saved session found for user {user_id}")
-        return None
-    
+def _write_session_file(user_id, session_data):
+    try:
+        chat_file = sharded_session_path(user_id)
+        chat_file.parent.mkdir(parents=True, exist_ok=True)
+        # Файл промпта записывается раньше сессии, которая на него ссылается
+        if session_data["system_prompt_id"]:
+            prompt_registry.store(session_data["system_prompt_id"], session_data["system_prompt_text"])
+        write_session(chat_file, session_data)
+        # Файл из общего каталога больше не нужен: сессия теперь хранится в шарде
+        flat_session_path(user_id).unlink(missing_ok=True)
+        logger.debug(f"Saved session for user {user_id} with {len(session_data['history'])} messages")
+        return True
+    except Exception as e:
+        logger.error(f"Error saving session for user {user_id}: {str(e)}")
+        logger.debug(traceback.format_exc())
+        return False
+
+
+def _read_session_file(user_id):
+    """
+    Читает файл сессии; None, если его нет. Перенос в шард (session_maintenance.py
+    reshard) может удалить файл из общего каталога между выбором пути и чтением —
+    тогда сессия читается из шарда, а не создается заново поверх сохраненной.
+    """
+    chat_file = session_path(user_id)
     try:
-        with open(chat_file, "rb") as f:
-            session_data = pickle.load(f)
+        return read_session(chat_file, prompt_registry.get)
+    except FileNotFoundError:
+        sharded_file = sharded_session_path(user_id)
+        if chat_file == sharded_file:
+            return None
+        logger.info(f"Session file of user {user_id} was moved to its shard while loading, reading it there")
+        return read_session(sharded_file, prompt_registry.get)
+
+
+def _read_user_session(user_id):
+    """
+    Читает сессию пользователя из файла. Возвращает (сессия, данные для
+    переписывания в текущем формате или None) либо None, если сессии нет.
+    """
+    try:
+        legacy_file = legacy_session_path(user_id)
+        session_data = _read_session_file(user_id)
+        if session_data is None:
+            if not legacy_file.exists():
+                logger.debug(f"No saved session found for user {user_id}")
+                return None
+            session_data = load_legacy_pickle(legacy_file)
         
         logger.info(f"Loaded session for user {user_id} with {len(session_data['history'])} messages")
         
         # Create and populate session object
-        session = UserSession()
-        session.history = session_data["history"]
-        session.current_model = session_data["current_model"]
-        session.provider = session_data["provider"]
-        session.system_prompt = session_data["system_prompt"]
-        session.is_image_mode = session_data["is_image_mode"]
+        session = _deserialize_session(session_data)
         
-        # Load interface language if available
-        if "interface_language" in session_data:
-            session.interface_language = session_data["interface_language"]
-            
-        # Load group_image_generated flag if available
-        if "group_image_generated" in session_data:
-            session.group_image_generated = session_data["group_image_generated"]
+        upgrade = None
+        if session_data.get("version") != FORMAT_VERSION:
+            upgrade = _serialize_session(session, session_data.get("last_interaction"))
         
         logger.debug(f"User {user_id} last interaction: {session_data.get('last_interaction', 'unknown')}")
-        return session
+        return session, upgrade
     except Exception as e:
         logger.error(f"Error loading session for user {user_id}: {str(e)}")
         logger.debug(traceback.format_exc())
         return None
 
 
+def _upgrade_session_file(user_id, session_data):
+    """Переписывает старый файл сессии в текущем формате и удаляет pickle-файл."""
+    if not _write_session_file(user_id, session_data):
+        return
+    legacy_file = legacy_session_path(user_id)
+    if legacy_file.exists():
+        legacy_file.unlink()
+    logger.info(f"Upgraded stored session for user {user_id} to format version {FORMAT_VERSION}")
+
+
+def _schedule_upgrade(user_id, session_data):
+    # Старые файлы переписываются в той же очереди, что и сохранения, поэтому
+    # запись после загрузки не обгонит более новое сохранение той же сессии
+    offload.run_ordered(("session", user_id), _upgrade_session_file, user_id, session_data)
+
+
+def _schedule_loaded(user_id, loaded):
+    """Ставит переписывание старого файла в очередь и возвращает сессию (или None)."""
+    if loaded is None:
+        return None
+    session, upgrade = loaded
+    if upgrade is not None:
+        _schedule_upgrade(user_id, upgrade)
+    return session
+
+
+def load_user_session(user_id):
+    """Загружает сессию пользователя из файла."""
+    return _schedule_loaded(user_id, _read_user_session(user_id))
+
+
+async def _read_and_upgrade(user_id):
+    """Читает файл в пуле потоков, а переписывание ставит в очередь из цикла событий."""
+    return _schedule_loaded(user_id, await offload.run_io(_read_user_session, user_id))
+
+
+async def _load_session_once(user_id):
+    """
+    Загружает сессию из файла в пуле потоков. Если загрузка уже идет (например,
+    ее начал фоновый предзагрузчик), ожидает ее вместо повторного чтения файла.
+    """
+    task = _loading.get(user_id)
+    if task is None:
+        task = asyncio.ensure_future(_read_and_upgrade(user_id))
+        _loading[user_id] = task
+        task.add_done_callback(lambda _: _loading.pop(user_id, None))
+    # Отмена одного ожидающего обработчика не должна прерывать общую загрузку
+    return await asyncio.shield(task)
+
+
+async def preload_session(user_id):
+    """Загружает сессию в память, если она есть на диске. Возвращает загруженную сессию или None."""
+    if user_id in user_sessions:
+        return None
+    loaded_session = await _load_session_once(user_id)
+    if loaded_session is None or user_id in user_sessions:
+        return None
+    user_sessions[user_id] = loaded_session
+    return loaded_session
+
+
+async def get_or_create_session_async(user_id):
+    """Получает сессию пользователя, не блокируя цикл событий чтением файла."""
+    if user_id not in user_sessions:
+        loaded_session = await _load_session_once(user_id)
+        # Пока шла загрузка, сессию мог создать другой обработчик
+        if user_id not in user_sessions:
+            if loaded_session:
+                user_sessions[user_id] = loaded_session
+                logger.info(f"Loaded previous session for user {user_id}")
+            else:
+                user_sessions[user_id] = UserSession()
+                logger.info(f"Created new session for user {user_id}")
+    
+    return user_sessions[user_id]
+
+
 def get_or_create_session(user_id):
     """Получает существующую или создает новую сессию для пользователя."""
     if user_id not in user_sessions:
@@ -0,0 +1,176 @@
+"""
+Формат хранения сессий на диске.
+
+Сессия хранится как сжатый gzip файл JSON Lines: первая строка — заголовок с
+версией формата и полями сессии, затем по одной строке на сообщение истории.
+Системный промпт хранится в реестре промптов, а в файле сессии на него есть
+только ссылка: [роль, null, id промпта].
+Файл читается потоково, а заголовок можно прочитать, не распаковывая историю.
+Старые файлы .pickle читаются ограниченным распаковщиком, который не создает
+никаких объектов, кроме встроенных контейнеров, и конвертируются в новый формат.
+
+Запуск `python session_format.py` сравнивает уровни сжатия по размеру и времени.
+"""
+import os
+import gzip
+import json
+import time
+import random
+import pickle
+import tempfile
+
+from config import SESSION_COMPRESSION_LEVEL
+
+FORMAT_NAME = "terry-session"
+FORMAT_VERSION = 2
+SESSION_SUFFIX = ".jsonl.gz"
+LEGACY_SUFFIX = ".pickle"
+
+
+class SessionFormatError(Exception):
+    """Файл сессии поврежден или имеет неизвестный формат."""
+
+
+class _RestrictedUnpickler(pickle.Unpickler):
+    """Распаковщик, запрещающий загрузку любых классов и функций."""
+
+    def find_class(self, module, name):
+        raise SessionFormatError(f"Forbidden object in legacy session: {module}.{name}")
+
+
+def load_legacy_pickle(path):
+    """Читает сессию в старом формате pickle без выполнения произвольного кода."""
+    with open(path, "rb") as f:
+        session_data = _RestrictedUnpickler(f).load()
+    if not isinstance(session_data, dict) or not isinstance(session_data.get("history"), list):
+        raise SessionFormatError(f"Unexpected legacy session structure in {path}")
+    return session_data
+
+
+def encode_lines(session_data):
+    """Построчно кодирует сессию: заголовок, затем сообщения истории."""
+    header = {key: value for key, value in session_data.items() if key not in ("history", "system_prompt_text")}
+    header["format"] = FORMAT_NAME
+    header["version"] = FORMAT_VERSION
+    header["history_length"] = len(session_data["history"])
+    yield json.dumps(header, ensure_ascii=False)
+    prompt_id = session_data.get("system_prompt_id")
+    prompt_text = session_data.get("system_prompt_text")
+    history = session_data["history"]
+    pairs = history.pairs() if hasattr(history, "pairs") else ((m["role"], m["content"]) for m in history)
+    for role, content in pairs:
+        if prompt_id and role == "system" and content == prompt_text:
+            yield json.dumps([role, None, prompt_id])
+        else:
+            yield json.dumps([role, content], ensure_ascii=False)
+
+
+def write_session(path, session_data, compresslevel=SESSION_COMPRESSION_LEVEL):
+    """Атомарно записывает сессию: сначала во временный файл, затем переименование."""
+    path = os.fspath(path)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=compresslevel, mtime=0) as f:
+            for line in encode_lines(session_data):
+                f.write(line.encode("utf-8"))
+                f.write(b"\n")
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _parse_header(line):
+    try:
+        header = json.loads(line)
+    except ValueError as e:
+        raise SessionFormatError(f"Invalid session header: {str(e)}")
+    if not isinstance(header, dict) or header.get("format") != FORMAT_NAME:
+        raise SessionFormatError("Not a session file")
+    if header.get("version", 0) > FORMAT_VERSION:
+        raise SessionFormatError(f"Unsupported session format version {header.get('version')}")
+    return header
+
+
+def read_header(path):
+    """Читает только заголовок сессии (без истории)."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return _parse_header(f.readline())
+
+
+def iter_messages(lines, resolve_prompt=None):
+    """Потоково декодирует сообщения истории; ссылки на промпты разрешает resolve_prompt(id)."""
+    for line in lines:
+        if not line.strip():
+            continue
+        message = json.loads(line)
+        role, content = message[0], message[1]
+        if content is None and len(message) > 2:
+            if resolve_prompt is None:
+                raise SessionFormatError(f"Prompt reference {message[2]} without a prompt resolver")
+            content = resolve_prompt(message[2])
+            if content is None:
+                # Файл промпта потерян: сообщение пропускается, чтобы в истории не было None
+                continue
+        yield {"role": role, "content": content}
+
+
+def read_session(path, resolve_prompt=None):
+    """Читает сессию целиком: заголовок и историю."""
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            session_data = _parse_header(f.readline())
+            session_data["history"] = list(iter_messages(f, resolve_prompt))
+    except FileNotFoundError:
+        raise
+    except (OSError, EOFError, ValueError) as e:
+        raise SessionFormatError(f"Corrupted session file {path}: {str(e)}")
+    return session_data
+
+
+def _benchmark(messages=400, message_size=600, repeats=5):
+    """Сравнивает уровни сжатия на синтетической истории."""
+    rng = random.Random(0)
+    alphabet = "абвгдеёжзийклмнопрстуфхцчшщъыьэюяabcdefghijklmnopqrstuvwxyz"
+    vocabulary = ["".join(rng.choice(alphabet) for _ in range(rng.randint(2, 10))) for _ in range(3000)]
+
+    def sample_text():
+        words = []
+        while sum(len(word) + 1 for word in words) < message_size:
+            words.append(rng.choice(vocabulary))
+        return " ".join(words)
+
+    session_data = {
+        "history": [{"role": "user" if i % 2 else "assistant", "content": sample_text()} for i in range(messages)],
+        "current_model": "gpt-4o",
+        "provider": "PollinationsAI",
+        "system_prompt": None,
+        "is_image_mode": False,
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pickle_path = os.path.join(temp_dir, "session.pickle")
+        started = time.perf_counter()
+        for _ in range(repeats):
+            with open(pickle_path, "wb") as f:
+                pickle.dump(session_data, f)
+        pickle_ms = (time.perf_counter() - started) / repeats * 1000
+        print(f"pickle (uncompressed): {os.path.getsize(pickle_path):>9} bytes, save {pickle_ms:6.2f} ms")
+
+        path = os.path.join(temp_dir, "session" + SESSION_SUFFIX)
+        for level in (1, 3, 6, 9):
+            started = time.perf_counter()
+            for _ in range(repeats):
+                write_session(path, session_data, compresslevel=level)
+            save_ms = (time.perf_counter() - started) / repeats * 1000
+            started = time.perf_counter()
+            for _ in range(repeats):
+                read_session(path)
+            load_ms = (time.perf_counter() - started) / repeats * 1000
+            print(f"gzip level {level}:          {os.path.getsize(path):>9} bytes, save {save_ms:6.2f} ms, load {load_ms:6.2f} ms")
+
+
+if __name__ == "__main__":
+    _benchmark()
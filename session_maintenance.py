@@ -0,0 +1,296 @@
+"""
+Обслуживание каталога сессий chats/.
+
+    python session_maintenance.py report
+    python session_maintenance.py gc --idle-days 90 [--delete] [--dry-run]
+    python session_maintenance.py reshard [--dry-run]
+
+report — распределение размеров и давности сессий (заголовки файлов читаются
+параллельно в пуле процессов). gc — переносит в chats/archive/ (или удаляет)
+сессии, к которым не обращались дольше заданного срока, и файлы системных
+промптов из chats/prompts/, на которые не ссылается ни одна сессия (в том
+числе из архива). reshard — переносит
+файлы из общего каталога в подкаталоги по хешу идентификатора пользователя.
+
+Скрипт можно запускать при работающем боте: файлы, измененные за последние
+--quiet-minutes минут, не трогаются, перенос выполняется атомарно, а при
+переносе в шард существующий файл бота никогда не перезаписывается.
+"""
+import os
+import re
+import time
+import argparse
+import datetime
+from pathlib import Path
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from config import CHATS_DIR, PROMPTS_DIR
+from session import session_shard
+from session_format import SESSION_SUFFIX, LEGACY_SUFFIX, read_header
+
+ARCHIVE_DIR_NAME = "archive"
+SESSION_FILE_RE = re.compile(r"^user_(-?\d+)(" + re.escape(SESSION_SUFFIX) + "|" + re.escape(LEGACY_SUFFIX) + ")$")
+SHARD_DIR_RE = re.compile(r"^[0-9a-f]{2}$")
+
+AGE_BUCKETS = [(1, "< 1 day"), (7, "< 1 week"), (30, "< 1 month"), (90, "< 3 months"), (365, "< 1 year")]
+
+
+def list_session_files(chats_dir):
+    """Файлы сессий в общем каталоге и в подкаталогах-шардах."""
+    paths = []
+    with os.scandir(chats_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and SESSION_FILE_RE.match(entry.name):
+                paths.append(entry.path)
+            elif entry.is_dir() and SHARD_DIR_RE.match(entry.name):
+                with os.scandir(entry.path) as shard_entries:
+                    paths.extend(e.path for e in shard_entries if e.is_file() and SESSION_FILE_RE.match(e.name))
+    return paths
+
+
+def scan_session_file(path):
+    """Сведения об одном файле; выполняется в процессе пула."""
+    info = {"path": path, "size": 0, "mtime": 0.0, "last_interaction": None,
+            "history_length": None, "version": None, "prompt_id": None, "error": None}
+    try:
+        stat = os.stat(path)
+        info["size"] = stat.st_size
+        info["mtime"] = stat.st_mtime
+        if path.endswith(LEGACY_SUFFIX):
+            # Старые файлы pickle не разбираются: давность определяется по времени изменения
+            info["version"] = "pickle"
+            return info
+        header = read_header(path)
+        info["version"] = header.get("version")
+        info["history_length"] = header.get("history_length")
+        info["last_interaction"] = header.get("last_interaction")
+        info["prompt_id"] = header.get("system_prompt_id")
+    except Exception as e:
+        info["error"] = str(e) or type(e).__name__
+    return info
+
+
+def scan(chats_dir, workers):
+    paths = list_session_files(chats_dir)
+    if not paths:
+        return []
+    chunksize = max(1, len(paths) // (workers * 8))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(scan_session_file, paths, chunksize=chunksize))
+
+
+def idle_days(info, now):
+    """Сколько дней прошло с последнего обращения к сессии."""
+    last = None
+    if info["last_interaction"]:
+        try:
+            last = datetime.datetime.fromisoformat(info["last_interaction"]).timestamp()
+        except ValueError:
+            pass
+    if last is None:
+        last = info["mtime"]
+    return max(0.0, (now - last) / 86400)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def report(results, now):
+    sizes = sorted(info["size"] for info in results)
+    lengths = sorted(info["history_length"] for info in results if info["history_length"] is not None)
+    ages = Counter()
+    for info in results:
+        days = idle_days(info, now)
+        ages[next((label for limit, label in AGE_BUCKETS if days < limit), ">= 1 year")] += 1
+    versions = Counter(str(info["version"]) for info in results if info["error"] is None)
+    errors = [info for info in results if info["error"]]
+    sharded = sum(1 for info in results if SHARD_DIR_RE.match(Path(info["path"]).parent.name))
+
+    print(f"Sessions: {len(results)} ({sharded} sharded, {len(results) - sharded} flat), total {format_size(sum(sizes))}")
+    print("Size:   " + ", ".join(
+        f"p{int(q * 100)} {format_size(percentile(sizes, q))}" for q in (0.5, 0.9, 0.99)
+    ) + f", max {format_size(sizes[-1] if sizes else 0)}")
+    if lengths:
+        print("History: " + ", ".join(
+            f"p{int(q * 100)} {percentile(lengths, q)}" for q in (0.5, 0.9, 0.99)
+        ) + f", max {lengths[-1]} messages")
+    print("Idle:")
+    for label in [label for _, label in AGE_BUCKETS] + [">= 1 year"]:
+        print(f"  {label:<11} {ages[label]}")
+    print("Format versions: " + ", ".join(f"{version}: {count}" for version, count in sorted(versions.items())))
+    if errors:
+        print(f"Unreadable files: {len(errors)}")
+        for info in errors[:10]:
+            print(f"  {info['path']}: {info['error']}")
+
+
+def is_quiet(path, quiet_seconds, now, expected_mtime=None):
+    """Файл давно не менялся (и не изменился с момента сканирования)."""
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return False
+    if expected_mtime is not None and mtime != expected_mtime:
+        return False
+    return now - mtime >= quiet_seconds
+
+
+def collect_garbage(results, chats_dir, now, max_idle_days, quiet_seconds, delete, dry_run):
+    archive_dir = Path(chats_dir) / ARCHIVE_DIR_NAME
+    action = "delete" if delete else "archive"
+    done = skipped = freed = 0
+    for info in results:
+        if idle_days(info, now) < max_idle_days:
+            continue
+        path = info["path"]
+        # Повторная проверка прямо перед действием: бот мог обновить файл после сканирования
+        if not is_quiet(path, quiet_seconds, time.time(), info["mtime"]):
+            skipped += 1
+            continue
+        if dry_run:
+            print(f"would {action} {path}")
+        elif delete:
+            os.unlink(path)
+        else:
+            target = archive_dir / os.path.relpath(path, chats_dir)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, target)
+        done += 1
+        freed += info["size"]
+    verb = f"Would {action}" if dry_run else ("Deleted" if delete else "Archived")
+    print(f"{verb} {done} sessions idle for {max_idle_days}+ days ({format_size(freed)}); skipped {skipped} recently modified")
+
+
+def referenced_prompts(results):
+    return {info["prompt_id"] for info in results if info["prompt_id"]}
+
+
+def collect_prompt_garbage(results, chats_dir, scanned_at, quiet_seconds, delete, dry_run):
+    """
+    Переносит в архив (или удаляет) файлы промптов, на которые не ссылается ни
+    одна сессия из results. Промпт записывается раньше ссылающейся на него сессии,
+    поэтому недавно измененные файлы промптов не трогаются.
+    """
+    prompts_dir = Path(chats_dir) / PROMPTS_DIR.name
+    if not prompts_dir.is_dir():
+        return
+    unreadable = sum(1 for info in results if info["error"])
+    if unreadable:
+        # Ссылку из нечитаемой сессии не проверить; такой промпт удалять нельзя
+        print(f"Skipped prompt cleanup: {unreadable} session files could not be read")
+        return
+
+    referenced = referenced_prompts(results)
+    # Бот мог сохранить сессии со ссылкой на старый промпт уже после сканирования
+    for path in list_session_files(chats_dir):
+        try:
+            if path.endswith(SESSION_SUFFIX) and os.stat(path).st_mtime >= scanned_at:
+                referenced.add(read_header(path).get("system_prompt_id"))
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            print(f"Skipped prompt cleanup: {path} could not be read ({str(e) or type(e).__name__})")
+            return
+
+    archive_dir = Path(chats_dir) / ARCHIVE_DIR_NAME / PROMPTS_DIR.name
+    action = "delete" if delete else "archive"
+    done = skipped = 0
+    for path in sorted(prompts_dir.glob("*.txt")):
+        if path.stem in referenced:
+            continue
+        if not is_quiet(path, quiet_seconds, time.time()):
+            skipped += 1
+            continue
+        if dry_run:
+            print(f"would {action} {path}")
+        elif delete:
+            path.unlink()
+        else:
+            archive_dir.mkdir(parents=True, exist_ok=True)
+            os.replace(path, archive_dir / path.name)
+        done += 1
+    verb = f"Would {action}" if dry_run else ("Deleted" if delete else "Archived")
+    print(f"{verb} {done} unreferenced system prompts; skipped {skipped} recently modified")
+
+
+def reshard(chats_dir, now, quiet_seconds, dry_run):
+    moved = skipped = stale = 0
+    with os.scandir(chats_dir) as entries:
+        flat_files = [entry for entry in entries if entry.is_file() and entry.name.endswith(SESSION_SUFFIX)]
+    for entry in flat_files:
+        match = SESSION_FILE_RE.match(entry.name)
+        if not match:
+            continue
+        if not is_quiet(entry.path, quiet_seconds, now):
+            skipped += 1
+            continue
+        target = Path(chats_dir) / session_shard(match.group(1)) / entry.name
+        if dry_run:
+            print(f"would move {entry.path} -> {target}")
+            moved += 1
+            continue
+        target.parent.mkdir(exist_ok=True)
+        try:
+            # link не перезаписывает файл, который бот мог уже записать в шард
+            os.link(entry.path, target)
+        except FileExistsError:
+            # В шарде уже есть более новая версия; файл в общем каталоге устарел
+            stale += 1
+        except OSError:
+            if target.exists():
+                stale += 1
+                continue
+            os.replace(entry.path, target)
+            moved += 1
+            continue
+        else:
+            moved += 1
+        os.unlink(entry.path)
+    verb = "Would move" if dry_run else "Moved"
+    print(f"{verb} {moved} sessions into shards; removed {stale} stale flat copies; skipped {skipped} recently modified")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance of stored chat sessions")
+    parser.add_argument("command", choices=("report", "gc", "reshard"))
+    parser.add_argument("--chats-dir", default=str(CHATS_DIR), help="session directory (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="processes for scanning")
+    parser.add_argument("--idle-days", type=float, default=90, help="gc: sessions idle longer than this are removed")
+    parser.add_argument("--delete", action="store_true", help="gc: delete instead of moving to archive/")
+    parser.add_argument("--quiet-minutes", type=float, default=10,
+                        help="never touch files modified within this many minutes (default: %(default)s)")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would be done")
+    args = parser.parse_args()
+
+    now = time.time()
+    quiet_seconds = args.quiet_minutes * 60
+    if args.command == "reshard":
+        reshard(args.chats_dir, now, quiet_seconds, args.dry_run)
+        return
+
+    started = time.perf_counter()
+    results = scan(args.chats_dir, args.workers)
+    print(f"Scanned {len(results)} files with {args.workers} processes in {time.perf_counter() - started:.2f}s")
+    if args.command == "report":
+        report(results, now)
+    else:
+        collect_garbage(results, args.chats_dir, now, args.idle_days, quiet_seconds, args.delete, args.dry_run)
+        # Архивные сессии тоже ссылаются на промпты: без них их нельзя восстановить
+        archive_dir = Path(args.chats_dir) / ARCHIVE_DIR_NAME
+        archived = scan(archive_dir, args.workers) if archive_dir.is_dir() else []
+        collect_prompt_garbage(results + archived, args.chats_dir, now, quiet_seconds, args.delete, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Фоновая загрузка недавно активных сессий после запуска бота.
+
+После перезапуска первое сообщение каждого пользователя ждало бы чтения его
+сессии с диска. Предзагрузчик после начала опроса загружает сессии, файлы
+которых изменялись позже всего (файл переписывается при каждом сохранении,
+поэтому время изменения совпадает с последним обращением), параллельными
+пакетами в пуле потоков, пока не исчерпан бюджет памяти. Обработчик,
+которому сессия нужна раньше, ожидает уже идущую загрузку.
+"""
+import os
+import time
+import asyncio
+import traceback
+
+import metrics
+import offload
+from logger_setup import logger
+from config import (
+    CHATS_DIR,
+    SESSION_PRELOAD_MAX_AGE_HOURS,
+    SESSION_PRELOAD_MAX_SESSIONS,
+    SESSION_PRELOAD_MEMORY_MB,
+    SESSION_PRELOAD_BATCH,
+)
+from session import preload_session
+from session_maintenance import list_session_files, SESSION_FILE_RE
+
+
+def recent_session_users(chats_dir, max_age_hours, limit):
+    """Идентификаторы пользователей, чьи сессии изменялись за последние max_age_hours, новые первыми."""
+    cutoff = time.time() - max_age_hours * 3600
+    candidates = []
+    for path in list_session_files(chats_dir):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        match = SESSION_FILE_RE.match(os.path.basename(path))
+        if mtime >= cutoff and match:
+            candidates.append((mtime, int(match.group(1))))
+    candidates.sort(reverse=True)
+    return [user_id for _, user_id in candidates[:limit]]
+
+
+def _session_size(session):
+    return session.history.memory_size() + (len(session.last_image) if session.last_image is not None else 0)
+
+
+async def preload_hot_sessions(chats_dir=CHATS_DIR,
+                               max_age_hours=SESSION_PRELOAD_MAX_AGE_HOURS,
+                               max_sessions=SESSION_PRELOAD_MAX_SESSIONS,
+                               memory_budget_mb=SESSION_PRELOAD_MEMORY_MB,
+                               batch_size=SESSION_PRELOAD_BATCH):
+    """Фоновая задача: загружает недавно активные сессии пакетами, пока хватает бюджета памяти."""
+    if max_sessions <= 0:
+        return
+    started = time.perf_counter()
+    try:
+        user_ids = await offload.run_io(recent_session_users, chats_dir, max_age_hours, max_sessions)
+    except Exception as e:
+        logger.error(f"Failed to list sessions for preloading: {str(e)}")
+        logger.debug(traceback.format_exc())
+        return
+
+    budget = memory_budget_mb * 1024 * 1024
+    used = 0
+    loaded = 0
+    for i in range(0, len(user_ids), batch_size):
+        batch = user_ids[i:i + batch_size]
+        results = await asyncio.gather(*(preload_session(user_id) for user_id in batch), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.warning(f"Failed to preload session: {str(result)}")
+            elif result is not None:
+                loaded += 1
+                used += _session_size(result)
+        metrics.set_gauge("sessions_preloaded", loaded)
+        if used >= budget:
+            logger.info(f"Session preload stopped at memory budget of {memory_budget_mb} MB")
+            break
+
+    logger.info(
+        f"Preloaded {loaded} of {len(user_ids)} recently active sessions "
+        f"({used / 1024 / 1024:.1f} MB) in {time.perf_counter() - started:.2f}s"
+    )
@@ -0,0 +1,234 @@
+"""
+Сохранение состояния многошаговых сценариев (context.user_data) между перезапусками.
+
+Сохраняются только ключи из PERSISTED_KEYS: ожидание системного промпта,
+языка и текста перевода, вопроса об изображении, выбранный язык перевода
+и модели, выбранные для сравнения (/compare).
+Изменения дописываются в журнал chats/user_state.jsonl — по строке на
+пользователя (или чат), данные которого изменились, — в пуле потоков и без
+ожидания в обработчиках. Когда журнал становится намного больше числа
+актуальных записей, он переписывается целиком.
+
+Запуск `python state_persistence.py` сравнивает скорость с PicklePersistence.
+"""
+import os
+import json
+import time
+import asyncio
+import tempfile
+import traceback
+from pathlib import Path
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import offload
+from logger_setup import logger
+from config import STATE_FILE, STATE_FLUSH_INTERVAL
+
+PERSISTED_KEYS = (
+    "awaiting_system_prompt",
+    "awaiting_target_language",
+    "awaiting_translation_text",
+    "awaiting_image_question",
+    "translation_target_language",
+    "compare_models",
+    "compare_prompt",
+    "awaiting_compare_prompt",
+)
+
+# Журнал переписывается, когда в нем в COMPACT_RATIO раз больше строк, чем актуальных записей
+COMPACT_RATIO = 4
+COMPACT_MIN_RECORDS = 1000
+
+
+class IncrementalPersistence(BasePersistence):
+    def __init__(self, path=STATE_FILE, keys=PERSISTED_KEYS, update_interval=STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = Path(path)
+        self.keys = keys
+        # Последнее записанное состояние: {"user": {id: dict}, "chat": {id: dict}}
+        self._stored = {"user": {}, "chat": {}}
+        self._pending = []
+        self._log_records = 0
+        self._loaded = False
+        self._write_task = None
+
+    # Чтение журнала
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        kind, key, data = json.loads(line)
+                    except ValueError:
+                        # Незавершенная последняя строка после аварийной остановки
+                        logger.warning(f"Skipping corrupt line {line_number} in {self.path}")
+                        continue
+                    self._log_records += 1
+                    if data:
+                        self._stored[kind][key] = data
+                    else:
+                        self._stored[kind].pop(key, None)
+        except FileNotFoundError:
+            return
+        logger.info(
+            f"Loaded conversation state of {len(self._stored['user'])} users and "
+            f"{len(self._stored['chat'])} chats from {self._log_records} records"
+        )
+
+    def _restore(self, kind):
+        self._load()
+        return {key: dict(data) for key, data in self._stored[kind].items()}
+
+    async def get_user_data(self):
+        return self._restore("user")
+
+    async def get_chat_data(self):
+        return self._restore("chat")
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    # Запись изменений
+
+    def _update(self, kind, key, data):
+        filtered = {name: data[name] for name in self.keys if name in data}
+        if self._stored[kind].get(key, {}) == filtered:
+            return
+        if filtered:
+            self._stored[kind][key] = filtered
+        else:
+            self._stored[kind].pop(key, None)
+        self._pending.append(json.dumps([kind, key, filtered], ensure_ascii=False))
+        self._schedule_write()
+
+    def _schedule_write(self):
+        # Все изменения одного цикла сохранения записываются одной задачей
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.ensure_future(self._write_pending())
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)
+        while self._pending:
+            lines, self._pending = self._pending, []
+            self._log_records += len(lines)
+            live = len(self._stored["user"]) + len(self._stored["chat"])
+            if self._log_records > max(COMPACT_MIN_RECORDS, COMPACT_RATIO * live):
+                snapshot = [
+                    json.dumps([kind, key, data], ensure_ascii=False)
+                    for kind in ("user", "chat")
+                    for key, data in self._stored[kind].items()
+                ]
+                self._log_records = len(snapshot)
+                await offload.run_ordered(("state", self.path), self._rewrite, snapshot)
+            else:
+                await offload.run_ordered(("state", self.path), self._append, lines)
+
+    def _append(self, lines):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        except Exception as e:
+            logger.error(f"Failed to save conversation state: {str(e)}")
+            logger.debug(traceback.format_exc())
+
+    def _rewrite(self, lines):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write("".join(line + "\n" for line in lines))
+            os.replace(temp_path, self.path)
+            logger.info(f"Compacted conversation state log to {len(lines)} records")
+        except Exception as e:
+            logger.error(f"Failed to compact conversation state: {str(e)}")
+            logger.debug(traceback.format_exc())
+
+    async def update_user_data(self, user_id, data):
+        self._update("user", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._update("chat", chat_id, data)
+
+    async def drop_user_data(self, user_id):
+        self._update("user", user_id, {})
+
+    async def drop_chat_data(self, chat_id):
+        self._update("chat", chat_id, {})
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    # Данные в памяти приложения всегда актуальны, перечитывать нечего
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Дожидается записи всех изменений (вызывается при остановке бота)."""
+        self._schedule_write()
+        await self._write_task
+
+
+async def _benchmark(users=100_000, changed_fraction=0.01):
+    """Сравнивает с PicklePersistence: первое сохранение и сохранение после изменений 1% пользователей."""
+    from telegram.ext import PicklePersistence
+
+    def user_state(user_id):
+        return {"awaiting_translation_text": True, "translation_target_language": f"lang-{user_id % 50}"}
+
+    changed = range(0, users, int(1 / changed_fraction))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        backends = {
+            "PicklePersistence": PicklePersistence(os.path.join(temp_dir, "state.pickle"), on_flush=True),
+            "IncrementalPersistence": IncrementalPersistence(os.path.join(temp_dir, "state.jsonl")),
+        }
+        for name, persistence in backends.items():
+            await persistence.get_user_data()
+            started = time.perf_counter()
+            for user_id in range(users):
+                await persistence.update_user_data(user_id, user_state(user_id))
+            await persistence.flush()
+            initial_ms = (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            for user_id in changed:
+                await persistence.update_user_data(user_id, {"awaiting_image_question": True})
+            await persistence.flush()
+            incremental_ms = (time.perf_counter() - started) * 1000
+
+            size = sum(os.path.getsize(os.path.join(temp_dir, f)) for f in os.listdir(temp_dir) if f.startswith("state"))
+            print(f"{name:<24} initial {initial_ms:8.1f} ms, {len(changed)} changed users {incremental_ms:8.1f} ms, {size} bytes")
+    offload.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(_benchmark())
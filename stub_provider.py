@@ -0,0 +1,99 @@
+"""
+Локальный провайдер-заглушка с интерфейсом клиента g4f.
+
+Используется вместо g4f, когда AI_STUB_PROVIDERS=1: для проверки бота,
+фоновых проверок провайдеров и бенчмарков без доступа к сети. Задержку и
+вероятность ошибки можно задать для всех провайдеров или для отдельных.
+"""
+import time
+import random
+import asyncio
+
+from config import STUB_LATENCY, STUB_FAILURE_RATE, STUB_FAILING_PROVIDERS
+
+
+class StubProviderError(Exception):
+    """Ошибка, которую имитирует заглушка."""
+
+
+class _Behavior:
+    __slots__ = ("latency", "failure_rate")
+
+    def __init__(self, latency, failure_rate):
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+
+_default_behavior = _Behavior(STUB_LATENCY, STUB_FAILURE_RATE)
+_behaviors = {provider: _Behavior(STUB_LATENCY, 1.0) for provider in STUB_FAILING_PROVIDERS}
+
+
+def set_behavior(provider=None, latency=None, failure_rate=None):
+    """Задает задержку и вероятность ошибки для провайдера (или для всех, если provider=None)."""
+    if provider is None:
+        behavior = _default_behavior
+    else:
+        behavior = _behaviors.setdefault(provider, _Behavior(_default_behavior.latency, _default_behavior.failure_rate))
+    if latency is not None:
+        behavior.latency = latency
+    if failure_rate is not None:
+        behavior.failure_rate = failure_rate
+
+
+def reset_behaviors():
+    _behaviors.clear()
+    _default_behavior.latency = STUB_LATENCY
+    _default_behavior.failure_rate = STUB_FAILURE_RATE
+
+
+async def _simulate(provider):
+    behavior = _behaviors.get(str(provider), _default_behavior)
+    # Небольшой разброс задержки, чтобы заглушка была похожа на настоящий провайдер
+    await asyncio.sleep(behavior.latency * random.uniform(0.8, 1.2))
+    if random.random() < behavior.failure_rate:
+        raise StubProviderError(f"Stub provider {provider} failed: 503 Service Unavailable")
+
+
+def _reply_text(messages):
+    last = messages[-1]["content"] if messages else ""
+    if isinstance(last, list):
+        last = " ".join(part.get("text", "") for part in last if isinstance(part, dict))
+    return f"Stub reply to: {str(last)[:200]}"
+
+
+class _Obj:
+    """Простой объект с атрибутами, повторяющий структуру ответов g4f."""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class _StubCompletions:
+    def create(self, messages, model="", provider=None, stream=False, **kwargs):
+        # Как в g4f: с stream=True возвращается асинхронный итератор, иначе — awaitable с ответом
+        if stream:
+            return self._stream(messages, provider)
+        return self._complete(messages, model, provider)
+
+    async def _complete(self, messages, model, provider):
+        await _simulate(provider)
+        return _Obj(choices=[_Obj(message=_Obj(role="assistant", content=_reply_text(messages)))], model=model)
+
+    async def _stream(self, messages, provider):
+        await _simulate(provider)
+        text = _reply_text(messages)
+        for i in range(0, len(text), 16):
+            await asyncio.sleep(0)
+            yield _Obj(choices=[_Obj(delta=_Obj(content=text[i:i + 16]))])
+
+
+class _StubImages:
+    async def generate(self, prompt, model=None, provider=None, response_format=None, **kwargs):
+        await _simulate(provider or model)
+        return _Obj(data=[_Obj(url=f"https://stub.invalid/{model}/{int(time.time() * 1000)}.jpg")])
+
+
+class StubAsyncClient:
+    def __init__(self, *args, **kwargs):
+        self.chat = _Obj(completions=_StubCompletions())
+        self.images = _StubImages()
@@ -0,0 +1,51 @@
+import asyncio
+
+import ai_client
+import stub_provider
+
+
+class CountingImages(stub_provider._StubImages):
+    calls = 0
+
+    async def generate(self, prompt, **kwargs):
+        CountingImages.calls += 1
+        return await super().generate(prompt, **kwargs)
+
+
+class CountingClient(stub_provider.StubAsyncClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.images = CountingImages()
+
+
+def test_concurrent_identical_image_requests_share_one_call(monkeypatch):
+    monkeypatch.setattr(ai_client, "_async_client_class", CountingClient)
+    monkeypatch.setattr(stub_provider._default_behavior, "latency", 0.05)
+    monkeypatch.setattr(stub_provider._default_behavior, "failure_rate", 0)
+    CountingImages.calls = 0
+
+    async def scenario():
+        return await asyncio.gather(
+            ai_client.generate_image("Provider", "flux", "a red fox"),
+            ai_client.generate_image("Provider", "flux", "a red fox"),
+        )
+
+    first, second = asyncio.run(scenario())
+    assert first == second
+    assert CountingImages.calls == 1
+
+
+def test_image_variants_are_separate_calls(monkeypatch):
+    monkeypatch.setattr(ai_client, "_async_client_class", CountingClient)
+    monkeypatch.setattr(stub_provider._default_behavior, "latency", 0.01)
+    monkeypatch.setattr(stub_provider._default_behavior, "failure_rate", 0)
+    CountingImages.calls = 0
+
+    async def scenario():
+        return await asyncio.gather(
+            ai_client.generate_image("Provider", "flux", "a red fox", variant=0),
+            ai_client.generate_image("Provider", "flux", "a red fox", variant=1),
+        )
+
+    asyncio.run(scenario())
+    assert CountingImages.calls == 2
@@ -0,0 +1,66 @@
+import asyncio
+
+import metrics
+import offload
+import image_cache as image_cache_module
+from image_cache import ImageCache, normalize_prompt
+
+
+def test_normalize_prompt_ignores_case_spacing_and_trailing_punctuation():
+    assert normalize_prompt("  A red   FOX!! ") == normalize_prompt("a red fox")
+
+
+def test_lru_evicts_least_recently_used_entry():
+    cache = ImageCache(max_entries=2, ttl=0, cache_dir="")
+    cache.put("flux", "a", "file-a")
+    cache.put("flux", "b", "file-b")
+    assert cache.get("flux", "a").file_id == "file-a"
+    cache.put("flux", "c", "file-c")
+
+    assert cache.get("flux", "b") is None
+    assert cache.get("flux", "a") is not None
+    assert cache.get("flux", "c") is not None
+
+
+def test_expired_entry_is_a_miss(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(image_cache_module.time, "time", lambda: now[0])
+    cache = ImageCache(max_entries=10, ttl=60, cache_dir="")
+    cache.put("flux", "a", "file-a")
+    now[0] += 61
+
+    assert cache.get("flux", "a") is None
+    assert cache.misses == 1
+
+
+def test_hit_is_recorded_by_caller_only():
+    cache = ImageCache(max_entries=10, ttl=0, cache_dir="")
+    cache.put("flux", "a", "file-a")
+    assert cache.get("flux", "a") is not None
+    assert cache.hits == 0
+    cache.record(True)
+    assert cache.hit_ratio() == 1.0
+
+
+def test_local_copy_of_evicted_entry_is_deleted(tmp_path):
+    async def scenario():
+        cache = ImageCache(max_entries=1, ttl=0, cache_dir=tmp_path)
+        cache.put("flux", "a", "file-a", b"a")
+        cache.put("flux", "b", "file-b", b"b")
+        await offload.drain()
+        await asyncio.sleep(0)
+        await offload.drain()
+        return cache
+
+    cache = asyncio.run(scenario())
+    entry = cache.get("flux", "b")
+    assert entry.path is not None
+    assert sorted(path.name for path in tmp_path.iterdir()) == [entry.path.name]
+
+
+def test_format_snapshot_lists_recorded_metrics():
+    metrics.increment("test_requests", result="hit")
+    metrics.observe("test_latency_seconds", 0.5)
+    text = metrics.format_snapshot()
+    assert "test_requests{result=hit} = 1" in text
+    assert "test_latency_seconds: count=1" in text
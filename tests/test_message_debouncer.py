@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+
+from message_debouncer import MessageDebouncer, flush_pending_messages
+import message_debouncer as debouncer_module
+
+
+class FakeApplication:
+    def create_task(self, coro, update=None):
+        return asyncio.ensure_future(coro)
+
+
+def text_update(text):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=2), effective_chat=SimpleNamespace(id=3),
+        message=SimpleNamespace(text=text, photo=None), callback_query=None,
+    )
+
+
+def test_button_press_sends_pending_messages_first(monkeypatch):
+    debouncer = MessageDebouncer(window=10, max_wait=10)
+    monkeypatch.setattr(debouncer_module, "message_debouncer", debouncer)
+    answered = []
+
+    async def answer(update, context, text):
+        answered.append(text)
+
+    async def scenario():
+        context = SimpleNamespace(application=FakeApplication())
+        debouncer.add((3, 2), text_update("a"), context, "a", answer)
+        debouncer.add((3, 2), text_update("b"), context, "b", answer)
+        button = SimpleNamespace(
+            effective_user=SimpleNamespace(id=2), effective_chat=SimpleNamespace(id=3),
+            message=None, callback_query=SimpleNamespace(data="model:flux"),
+        )
+        await flush_pending_messages(button, context)
+        assert answered == ["a\nb"]
+
+    asyncio.run(scenario())
+
+
+def test_flush_all_answers_pending_messages():
+    debouncer = MessageDebouncer(window=10, max_wait=10)
+    answered = []
+
+    async def answer(update, context, text):
+        answered.append(text)
+
+    async def scenario():
+        context = SimpleNamespace(application=FakeApplication())
+        debouncer.add((3, 2), text_update("a"), context, "a", answer)
+        await debouncer.flush_all()
+
+    asyncio.run(scenario())
+    assert answered == ["a"]
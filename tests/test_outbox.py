@@ -0,0 +1,79 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest
+
+import outbox
+from outbox import OutboundScheduler, TokenBucket, split_text, PRIORITY_INTERACTIVE, PRIORITY_PROGRESS
+
+
+def private_chat(chat_id=1):
+    return SimpleNamespace(id=chat_id, type="private")
+
+
+def test_split_text_prefers_line_breaks_and_trims_boundaries():
+    text = "a" * 6 + "\n" + "b" * 6 + " " + "c" * 3
+    assert split_text(text, limit=8) == ["aaaaaa", "bbbbbb", "ccc"]
+
+
+def test_split_text_cuts_long_words():
+    assert split_text("x" * 10, limit=4) == ["xxxx", "xxxx", "xx"]
+
+
+def test_token_bucket_overdraft_delays_next_send():
+    bucket = TokenBucket(rate=2, capacity=2)
+    now = bucket.updated
+    bucket.consume(now, 4)
+    assert bucket.delay(now) == pytest.approx(1.5)
+
+
+def test_interactive_sends_go_before_progress():
+    order = []
+
+    async def scenario():
+        scheduler = OutboundScheduler(global_rate=1000, private_rate=20, group_rate=20, action_rate=20)
+        chat = private_chat()
+        # Расходуем запас чата, чтобы следующие отправки ждали в очереди
+        for _ in range(outbox.CHAT_BURST):
+            await scheduler.send(chat, lambda: asyncio.sleep(0))
+
+        async def record(name):
+            order.append(name)
+
+        progress = asyncio.ensure_future(scheduler.send(chat, lambda: record("progress"), PRIORITY_PROGRESS))
+        await asyncio.sleep(0)
+        interactive = asyncio.ensure_future(scheduler.send(chat, lambda: record("interactive"), PRIORITY_INTERACTIVE))
+        await asyncio.gather(progress, interactive)
+
+    asyncio.run(scenario())
+    assert order == ["interactive", "progress"]
+
+
+def test_chat_actions_do_not_use_message_budget():
+    async def scenario():
+        scheduler = OutboundScheduler(global_rate=1000, private_rate=0.1, group_rate=0.1, action_rate=0.1)
+        chat = private_chat()
+        await scheduler.send(chat, lambda: asyncio.sleep(0), PRIORITY_PROGRESS, budget=outbox.BUDGET_ACTIONS)
+        started = time.monotonic()
+        await scheduler.send(chat, lambda: asyncio.sleep(0))
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 0.1
+
+
+def test_broken_markup_in_split_part_is_sent_as_plain_text(monkeypatch):
+    monkeypatch.setattr(outbox, "scheduler", OutboundScheduler(global_rate=1000, private_rate=1000, group_rate=1000))
+    sent = []
+
+    async def reply_text(text, reply_markup=None, **kwargs):
+        if kwargs.get("parse_mode") and text.count("*") % 2:
+            raise BadRequest("Can't parse entities: can't find end of the entity")
+        sent.append((text, kwargs.get("parse_mode")))
+
+    message = SimpleNamespace(chat=private_chat(), reply_text=reply_text)
+    text = "*" + "a" * 4090 + " " + "b" * 10 + "*"
+    asyncio.run(outbox.reply_text(message, text, parse_mode="Markdown"))
+    assert [mode for _, mode in sent] == [None, None]
+    assert sent[1][0] == "b" * 10 + "*"
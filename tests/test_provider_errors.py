@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from provider_errors import ProviderError, RetryBudget, classify, wrap_error
+
+
+class RateLimitError(Exception):
+    pass
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("status: 503", ("server_error", True)),
+    ("HTTP/1.1 502 from upstream", ("server_error", True)),
+    ("Response 429: slow down", ("rate_limit", True)),
+    ("Stub provider failed: 503 Service Unavailable", ("server_error", True)),
+    ("Error code: 401", ("auth", False)),
+    ("status_code=404", ("model_not_found", False)),
+    ("status 400", ("bad_request", False)),
+    ("Request blocked by content policy", ("content_refused", False)),
+    ("The model refused to answer", ("content_refused", False)),
+    ("Read timed out", ("timeout", True)),
+])
+def test_message_classification(message, expected):
+    assert classify(Exception(message)) == expected
+
+
+@pytest.mark.parametrize("message", [
+    "Prompt of 500 tokens is too long",
+    "Context is 4096 tokens, got 4500",
+    "Account blocked",
+    "Safety first",
+])
+def test_numbers_and_loose_words_do_not_decide_category(message):
+    assert classify(Exception(message)) == ("unknown", False)
+
+
+def test_class_status_and_builtin_errors():
+    assert classify(RateLimitError("slow down")) == ("rate_limit", True)
+    assert classify(ConnectionRefusedError(111, "Connection refused")) == ("network", True)
+    assert classify(asyncio.TimeoutError()) == ("timeout", True)
+
+    error = Exception("upstream failed")
+    error.status = 500
+    assert classify(error) == ("server_error", True)
+
+
+def test_wrap_error_keeps_provider_errors():
+    error = ProviderError("empty", "P", "m", "empty_response", transient=True)
+    assert wrap_error(error, "P", "m") is error
+    wrapped = wrap_error(Exception("HTTP 503"), "P", "m")
+    assert (wrapped.category, wrapped.transient, wrapped.provider) == ("server_error", True, "P")
+
+
+def test_retry_budget_is_funded_by_requests():
+    budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2)
+    budget.tokens = 0
+    assert not budget.try_spend()
+    budget.record_request()
+    budget.record_request()
+    assert budget.try_spend()
+    assert not budget.try_spend()
@@ -0,0 +1,39 @@
+import asyncio
+
+import ai_client
+import stub_provider
+from provider_errors import RetryBudget
+from provider_health import ProviderHealth
+
+
+def test_probes_mark_model_down_after_threshold_and_back_up(monkeypatch):
+    monkeypatch.setattr(ai_client, "_async_client_class", stub_provider.StubAsyncClient)
+    monkeypatch.setattr(ai_client, "retry_budget", RetryBudget(ratio=1, min_per_second=0, max_tokens=10))
+    ai_client.retry_budget.tokens = 0
+    health = ProviderHealth(timeout=1, failure_threshold=2, include_images=False)
+    model_info = {"provider": "Flaky"}
+
+    async def probe():
+        await health.probe_model("text", "gpt-test", model_info)
+        return health.is_available("text", "gpt-test")
+
+    stub_provider.set_behavior("Flaky", latency=0, failure_rate=1)
+    try:
+        assert asyncio.run(probe())
+        assert not asyncio.run(probe())
+        assert "503" in health.status("text", "gpt-test").last_error
+
+        stub_provider.set_behavior("Flaky", failure_rate=0)
+        assert asyncio.run(probe())
+        assert health.status("text", "gpt-test").failures == 0
+    finally:
+        stub_provider.reset_behaviors()
+
+    # Проверки идут без повторов и не пополняют бюджет повторов пользователей
+    assert ai_client.retry_budget.tokens == 0
+
+
+def test_probe_budget_limits_probes_per_hour():
+    health = ProviderHealth(budget_per_hour=3)
+    assert health._take_budget(5) == 3
+    assert health._take_budget(5) == 0
@@ -0,0 +1,53 @@
+import pytest
+
+import quota
+from quota import QuotaManager, QuotaUsage, QuotaExceeded
+
+
+class FakeRegistry:
+    def __init__(self, limits):
+        self.limits = limits
+
+    def quota(self, model_type, model):
+        return self.limits.get(model, {})
+
+
+class FakeSession:
+    def __init__(self):
+        self.quota_usage = QuotaUsage()
+
+
+def make_manager(monkeypatch, tmp_path, model_limits=None, requests=2, images=10):
+    monkeypatch.setattr(quota, "model_registry", FakeRegistry(model_limits or {}))
+    limits = {
+        "user": {"requests": requests, "tokens": 0, "images": images},
+        "group": {"requests": 0, "tokens": 0, "images": 0},
+    }
+    return QuotaManager(path=tmp_path / "group_quotas.json", limits=limits)
+
+
+def test_release_returns_request_to_quota(monkeypatch, tmp_path):
+    manager = make_manager(monkeypatch, tmp_path)
+    session = FakeSession()
+    manager.acquire(1, session, None, "text", "gpt-4o")
+    charge = manager.acquire(1, session, None, "text", "gpt-4o")
+    with pytest.raises(QuotaExceeded):
+        manager.acquire(1, session, None, "text", "gpt-4o")
+
+    manager.release(charge)
+    manager.release(charge)
+    manager.acquire(1, session, None, "text", "gpt-4o")
+    with pytest.raises(QuotaExceeded):
+        manager.acquire(1, session, None, "text", "gpt-4o")
+
+
+def test_image_variants_checked_against_each_model_limit(monkeypatch, tmp_path):
+    manager = make_manager(monkeypatch, tmp_path, model_limits={"dall-e-3": {"images": 1}})
+    session = FakeSession()
+    with pytest.raises(QuotaExceeded) as error:
+        manager.acquire(1, session, None, "image", "flux", images=4,
+                        variant_models=["flux", "dall-e-3", "flux", "dall-e-3"])
+    assert error.value.model == "dall-e-3"
+
+    manager.acquire(1, session, None, "image", "flux", images=3, variant_models=["flux", "dall-e-3", "flux"])
+    assert session.quota_usage.window("images").total(quota.time.time()) == 3
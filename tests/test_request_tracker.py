@@ -0,0 +1,87 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+import request_tracker
+from request_tracker import run_user_request, cancel_user_request, RequestSuperseded, serialize_per_user
+
+
+def test_new_request_supersedes_previous():
+    async def scenario():
+        first = asyncio.ensure_future(run_user_request(10, 1, asyncio.sleep(10, "first")))
+        await asyncio.sleep(0)
+        second = await run_user_request(10, 1, asyncio.sleep(0, "second"))
+        with pytest.raises(RequestSuperseded):
+            await first
+        return second
+
+    assert asyncio.run(scenario()) == "second"
+
+
+def test_cancel_user_request_stops_request():
+    async def scenario():
+        request = asyncio.ensure_future(run_user_request(10, 1, asyncio.sleep(10)))
+        await asyncio.sleep(0)
+        assert cancel_user_request(1, reason="new chat")
+        with pytest.raises(RequestSuperseded):
+            await request
+        assert not cancel_user_request(1)
+
+    asyncio.run(scenario())
+
+
+def test_requests_in_other_chats_are_independent():
+    async def scenario():
+        private = asyncio.ensure_future(run_user_request(1, 1, asyncio.sleep(0.05, "private")))
+        await asyncio.sleep(0)
+        group = await run_user_request(-100, 1, asyncio.sleep(0, "group"))
+        return await private, group
+
+    assert asyncio.run(scenario()) == ("private", "group")
+
+
+def test_cancel_without_chat_stops_requests_in_all_chats():
+    async def scenario():
+        requests = [asyncio.ensure_future(run_user_request(chat_id, 1, asyncio.sleep(10))) for chat_id in (1, -100)]
+        other_user = asyncio.ensure_future(run_user_request(1, 2, asyncio.sleep(0.05, "other")))
+        await asyncio.sleep(0)
+        assert cancel_user_request(1, reason="new chat")
+        for request in requests:
+            with pytest.raises(RequestSuperseded):
+                await request
+        return await other_user
+
+    assert asyncio.run(scenario()) == "other"
+
+
+def test_updates_are_processed_concurrently(monkeypatch):
+    # Иначе второе обновление ждет первое и не может его отменить
+    monkeypatch.setattr(bot, "TOKEN", "123:test")
+    assert bot.build_application().concurrent_updates > 1
+
+
+def test_updates_of_one_user_are_handled_in_order():
+    order = []
+
+    @serialize_per_user
+    async def handler(update, context):
+        order.append(("start", update.name))
+        await asyncio.sleep(context)
+        order.append(("end", update.name))
+
+    def update(name, user_id):
+        return SimpleNamespace(name=name, effective_user=SimpleNamespace(id=user_id))
+
+    async def scenario():
+        await asyncio.gather(
+            handler(update("first", 1), 0.02),
+            handler(update("second", 1), 0),
+            handler(update("other user", 2), 0),
+        )
+
+    asyncio.run(scenario())
+    assert order.index(("end", "first")) < order.index(("start", "second"))
+    assert order.index(("end", "other user")) < order.index(("end", "first"))
+    assert request_tracker._user_locks == {}
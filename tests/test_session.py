@@ -0,0 +1,48 @@
+import pickle
+import asyncio
+
+import offload
+import session
+from session import (
+    UserSession, load_user_session, sharded_session_path, flat_session_path, legacy_session_path,
+    _serialize_session, get_or_create_session_async, save_user_session, user_sessions,
+)
+from session_format import write_session, read_session
+
+
+def test_load_reads_shard_when_flat_file_moved_meanwhile(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    saved = UserSession()
+    saved.add_message("user", "hello")
+    path = sharded_session_path(7)
+    path.parent.mkdir(parents=True)
+    write_session(path, _serialize_session(saved))
+    # Путь выбран, когда файл еще лежал в общем каталоге
+    monkeypatch.setattr(session, "session_path", flat_session_path)
+
+    loaded = load_user_session(7)
+    assert list(loaded.history.pairs()) == [("user", "hello")]
+
+
+def test_legacy_upgrade_is_queued_before_later_saves(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    legacy_file = legacy_session_path(8)
+    legacy_file.parent.mkdir(parents=True)
+    legacy_file.write_bytes(pickle.dumps({
+        "history": [{"role": "user", "content": "old"}], "current_model": None, "provider": None, "is_image_mode": False,
+    }))
+
+    async def scenario():
+        loaded = await get_or_create_session_async(8)
+        loaded.add_message("assistant", "new")
+        save_user_session(8)
+        await offload.drain()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        user_sessions.pop(8, None)
+
+    assert not legacy_file.exists()
+    saved = read_session(sharded_session_path(8), lambda prompt_id: None)
+    assert [message["content"] for message in saved["history"]] == ["old", "new"]
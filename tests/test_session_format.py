@@ -0,0 +1,85 @@
+import gzip
+import pickle
+
+import pytest
+
+from session_format import (
+    FORMAT_VERSION,
+    SessionFormatError,
+    load_legacy_pickle,
+    read_header,
+    read_session,
+    write_session,
+)
+
+
+def session_data(history):
+    return {
+        "history": history,
+        "current_model": "gpt-4o",
+        "provider": "PollinationsAI",
+        "system_prompt_id": "p1",
+        "system_prompt_text": "Be brief",
+        "is_image_mode": False,
+    }
+
+
+def test_round_trip_stores_prompt_as_reference(tmp_path):
+    path = tmp_path / "user_1.jsonl.gz"
+    history = [
+        {"role": "system", "content": "Be brief"},
+        {"role": "user", "content": "Привет"},
+        {"role": "assistant", "content": "Hi"},
+    ]
+    write_session(path, session_data(history))
+
+    assert b"Be brief" not in gzip.decompress(path.read_bytes())
+    loaded = read_session(path, {"p1": "Be brief"}.get)
+    assert loaded["history"] == history
+    assert loaded["current_model"] == "gpt-4o"
+    assert loaded["version"] == FORMAT_VERSION
+
+
+def test_read_header_does_not_need_history(tmp_path):
+    path = tmp_path / "user_1.jsonl.gz"
+    write_session(path, session_data([{"role": "user", "content": "x"}]))
+    header = read_header(path)
+    assert header["history_length"] == 1
+    assert "history" not in header
+
+
+def test_missing_prompt_message_is_skipped(tmp_path):
+    path = tmp_path / "user_1.jsonl.gz"
+    write_session(path, session_data([{"role": "system", "content": "Be brief"}, {"role": "user", "content": "x"}]))
+    loaded = read_session(path, lambda prompt_id: None)
+    assert loaded["history"] == [{"role": "user", "content": "x"}]
+
+
+def test_corrupted_file_raises_format_error(tmp_path):
+    path = tmp_path / "user_1.jsonl.gz"
+    path.write_bytes(b"not gzip")
+    with pytest.raises(SessionFormatError):
+        read_session(path)
+
+
+def test_missing_file_raises_file_not_found(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        read_session(tmp_path / "missing.jsonl.gz")
+
+
+def test_legacy_pickle_with_plain_containers_loads(tmp_path):
+    path = tmp_path / "user_1.pickle"
+    path.write_bytes(pickle.dumps({"history": [{"role": "user", "content": "x"}], "current_model": None}))
+    assert load_legacy_pickle(path)["history"] == [{"role": "user", "content": "x"}]
+
+
+class Payload:
+    def __reduce__(self):
+        return (print, ("executed",))
+
+
+def test_legacy_pickle_rejects_classes(tmp_path):
+    path = tmp_path / "user_1.pickle"
+    path.write_bytes(pickle.dumps({"history": [], "payload": Payload()}))
+    with pytest.raises(SessionFormatError):
+        load_legacy_pickle(path)
@@ -0,0 +1,35 @@
+import os
+import time
+
+import session_maintenance
+from session import UserSession, sharded_session_path, _serialize_session
+from session_format import write_session
+
+
+def test_gc_removes_only_unreferenced_old_prompts(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    saved = UserSession()
+    saved.set_system_prompt("Be brief")
+    saved.add_message("user", "hello")
+    session_data = _serialize_session(saved)
+    path = sharded_session_path(5)
+    path.parent.mkdir(parents=True)
+    write_session(path, session_data)
+
+    prompts_dir = tmp_path / "chats" / "prompts"
+    prompts_dir.mkdir()
+    used = prompts_dir / f"{session_data['system_prompt_id']}.txt"
+    unused = prompts_dir / "unused.txt"
+    fresh = prompts_dir / "fresh.txt"
+    for prompt in (used, unused, fresh):
+        prompt.write_text("text")
+    hour_ago = time.time() - 3600
+    for prompt in (used, unused):
+        os.utime(prompt, (hour_ago, hour_ago))
+
+    results = [session_maintenance.scan_session_file(str(path))]
+    session_maintenance.collect_prompt_garbage(results, "chats", time.time(), 600, delete=True, dry_run=False)
+
+    assert used.exists()
+    assert fresh.exists()
+    assert not unused.exists()
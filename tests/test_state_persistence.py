@@ -0,0 +1,48 @@
+import asyncio
+
+import state_persistence
+from state_persistence import IncrementalPersistence
+
+
+def reload(path):
+    return asyncio.run(IncrementalPersistence(path).get_user_data())
+
+
+def test_only_persisted_keys_survive_restart(tmp_path):
+    path = tmp_path / "state.jsonl"
+
+    async def scenario():
+        persistence = IncrementalPersistence(path)
+        await persistence.get_user_data()
+        await persistence.update_user_data(1, {"awaiting_translation_text": True, "scratch": object()})
+        await persistence.update_user_data(2, {"awaiting_image_question": True})
+        await persistence.drop_user_data(2)
+        await persistence.flush()
+
+    asyncio.run(scenario())
+    assert reload(path) == {1: {"awaiting_translation_text": True}}
+
+
+def test_log_is_compacted_to_live_records(monkeypatch, tmp_path):
+    monkeypatch.setattr(state_persistence, "COMPACT_MIN_RECORDS", 10)
+    path = tmp_path / "state.jsonl"
+
+    async def scenario():
+        persistence = IncrementalPersistence(path)
+        await persistence.get_user_data()
+        for step in range(30):
+            await persistence.update_user_data(step % 2, {"translation_target_language": f"lang-{step}"})
+            await persistence.flush()
+
+    asyncio.run(scenario())
+    assert len(path.read_text(encoding="utf-8").splitlines()) < 10
+    assert reload(path) == {
+        0: {"translation_target_language": "lang-28"},
+        1: {"translation_target_language": "lang-29"},
+    }
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    path = tmp_path / "state.jsonl"
+    path.write_text('["user", 1, {"awaiting_system_prompt": true}]\n["user", 2, {"awai', encoding="utf-8")
+    assert reload(path) == {1: {"awaiting_system_prompt": True}}
@@ -0,0 +1,60 @@
+import json
+import asyncio
+
+import translation_batcher
+from translation_batcher import TranslationBatcher, parse_batch_response
+
+
+def test_concurrent_translations_share_one_provider_call(monkeypatch):
+    calls = []
+
+    async def fake_response(provider, model, messages):
+        calls.append(messages)
+        items = json.loads(messages[0]["content"].split("\n\n", 1)[1])
+        return json.dumps([{"id": item["id"], "translation": item["text"].upper()} for item in items])
+
+    monkeypatch.setattr(translation_batcher, "get_ai_response", fake_response)
+    monkeypatch.setattr(TranslationBatcher, "_provider", lambda self: "Provider")
+    batcher = TranslationBatcher(window=0.05)
+
+    async def scenario():
+        return await asyncio.gather(batcher.translate("кот", "English"), batcher.translate("пес", "English"))
+
+    assert asyncio.run(scenario()) == ["КОТ", "ПЕС"]
+    assert len(calls) == 1
+
+
+def test_idle_batcher_does_not_wait_for_the_window(monkeypatch):
+    calls = []
+
+    async def fake_response(provider, model, messages):
+        calls.append(messages)
+        await asyncio.sleep(0.05)
+        content = messages[0]["content"]
+        if content.startswith("Translate the following"):
+            return content.rsplit("\n\n", 1)[1].upper()
+        items = json.loads(content.split("\n\n", 1)[1])
+        return json.dumps([{"id": item["id"], "translation": item["text"].upper()} for item in items])
+
+    monkeypatch.setattr(translation_batcher, "get_ai_response", fake_response)
+    monkeypatch.setattr(TranslationBatcher, "_provider", lambda self: "Provider")
+    batcher = TranslationBatcher(window=0.5)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first = asyncio.ensure_future(batcher.translate("кот", "English"))
+        await asyncio.sleep(0.01)
+        # Пока первый запрос выполняется, следующие ждут окно и уходят одним пакетом
+        rest = asyncio.gather(batcher.translate("пес", "English"), batcher.translate("еж", "English"))
+        assert await first == "КОТ"
+        assert loop.time() - started < 0.3
+        return await rest
+
+    assert asyncio.run(scenario()) == ["ПЕС", "ЕЖ"]
+    assert len(calls) == 2
+
+
+def test_parse_batch_response_accepts_code_fence():
+    response = '```json\n[{"id": 1, "translation": "dog"}, {"id": 0, "translation": "cat"}]\n```'
+    assert parse_batch_response(response, 2) == ["cat", "dog"]
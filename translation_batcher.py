@@ -0,0 +1,171 @@
+"""
+Микропакетный перевод текста.
+
+Запросы на перевод (/translate и промпты в режиме изображений), пришедшие в
+пределах короткого окна, отправляются модели одним запросом со списком
+элементов в JSON, а ответы раздаются ожидающим обработчикам. Окно
+выдерживается, только пока предыдущий пакет еще выполняется: запрос,
+пришедший к простаивающему пакетировщику, отправляется сразу (вместе с
+запросами, пришедшими в ту же итерацию цикла событий). Если ответ
+пакета не удается разобрать, каждый элемент переводится отдельным запросом.
+"""
+import re
+import json
+import time
+import asyncio
+import traceback
+
+import metrics
+from logger_setup import logger
+from ai_client import get_ai_response
+from model_registry import model_registry
+from config import TRANSLATION_MODEL, TRANSLATION_BATCH_WINDOW, TRANSLATION_BATCH_SIZE
+
+SINGLE_PROMPT = (
+    "Translate the following text to {language}. "
+    "Return only the translated text without explanations or comments:\n\n{text}"
+)
+BATCH_PROMPT = (
+    "Translate each item of the JSON array below to the language given in its \"language\" field. "
+    "Return only a JSON array of objects {{\"id\": <item id>, \"translation\": <translated text>}} "
+    "with one object for every item, without explanations or comments.\n\n{items}"
+)
+
+_CODE_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+class BatchParseError(Exception):
+    """Ответ на пакетный запрос не соответствует ожидаемому формату."""
+
+
+class _PendingTranslation:
+    __slots__ = ("text", "language", "future")
+
+    def __init__(self, text, language, future):
+        self.text = text
+        self.language = language
+        self.future = future
+
+
+def parse_batch_response(response, count):
+    """Разбирает ответ пакета; возвращает переводы в порядке элементов."""
+    try:
+        items = json.loads(_CODE_FENCE.sub("", response.strip()))
+    except (TypeError, ValueError) as e:
+        raise BatchParseError(f"Invalid JSON: {str(e)}")
+    if not isinstance(items, list):
+        raise BatchParseError("Expected a JSON array")
+
+    translations = {}
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("translation"), str):
+            raise BatchParseError(f"Malformed item: {item!r}")
+        try:
+            translations[int(item.get("id"))] = item["translation"]
+        except (TypeError, ValueError):
+            raise BatchParseError(f"Malformed item id: {item!r}")
+
+    missing = [i for i in range(count) if i not in translations]
+    if missing:
+        raise BatchParseError(f"Missing items: {missing}")
+    return [translations[i] for i in range(count)]
+
+
+class TranslationBatcher:
+    def __init__(self, model=TRANSLATION_MODEL, window=TRANSLATION_BATCH_WINDOW, max_items=TRANSLATION_BATCH_SIZE):
+        self.model = model
+        self.window = window
+        self.max_items = max_items
+        self._pending = []
+        self._flush_handle = None
+        # Число отправленных, но еще не завершенных пакетов
+        self._inflight = 0
+
+    async def translate(self, text, language):
+        """Переводит text на language. Ошибка провайдера передается вызывающему."""
+        loop = asyncio.get_running_loop()
+        item = _PendingTranslation(text, language, loop.create_future())
+        self._pending.append(item)
+
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._flush_handle is None:
+            if self._inflight:
+                self._flush_handle = loop.call_later(self.window, self._flush)
+            else:
+                self._flush_handle = loop.call_soon(self._flush)
+        return await item.future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # Элементы, чьи обработчики уже отменены, не отправляем
+        batch = [item for item in self._pending if not item.future.done()]
+        self._pending = []
+        if batch:
+            self._inflight += 1
+            asyncio.ensure_future(self._run_batch(batch))
+
+    def _provider(self):
+        model_info = model_registry.get("text", self.model)
+        if model_info is None:
+            raise ValueError(f"Translation model {self.model} is not configured")
+        return model_info["provider"]
+
+    async def _request_single(self, item):
+        prompt = SINGLE_PROMPT.format(language=item.language, text=item.text)
+        return await get_ai_response(self._provider(), self.model, [{"role": "user", "content": prompt}])
+
+    async def _run_batch(self, batch):
+        try:
+            await self._send_batch(batch)
+        finally:
+            self._inflight -= 1
+
+    async def _send_batch(self, batch):
+        metrics.observe("translation_batch_size", len(batch))
+        if len(batch) == 1:
+            await self._run_individually(batch)
+            return
+
+        items = json.dumps(
+            [{"id": i, "language": item.language, "text": item.text} for i, item in enumerate(batch)],
+            ensure_ascii=False,
+        )
+        started = time.perf_counter()
+        try:
+            response = await get_ai_response(
+                self._provider(), self.model, [{"role": "user", "content": BATCH_PROMPT.format(items=items)}]
+            )
+            translations = parse_batch_response(response, len(batch))
+        except BatchParseError as e:
+            metrics.increment("translation_batch_fallbacks")
+            logger.warning(f"Could not parse batched translation of {len(batch)} items, translating individually: {str(e)}")
+            await self._run_individually(batch)
+            return
+        except Exception as e:
+            logger.error(f"Batched translation of {len(batch)} items failed: {str(e)}")
+            logger.debug(traceback.format_exc())
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+
+        logger.info(f"Translated {len(batch)} items in one request in {time.perf_counter() - started:.2f}s")
+        for item, translation in zip(batch, translations):
+            if not item.future.done():
+                item.future.set_result(translation)
+
+    async def _run_individually(self, batch):
+        results = await asyncio.gather(*(self._request_single(item) for item in batch), return_exceptions=True)
+        for item, result in zip(batch, results):
+            if item.future.done():
+                continue
+            if isinstance(result, BaseException):
+                item.future.set_exception(result)
+            else:
+                item.future.set_result(result)
+
+
+translation_batcher = TranslationBatcher()
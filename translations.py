@@ -9,12 +9,14 @@ TRANSLATIONS = {
         "cmd_newchat": "Начать новый текстовый разговор",
         "cmd_image": "Генерация изображений",
         "cmd_translate": "Перевод текста",
+        "cmd_compare": "Сравнить ответы моделей",
         "cmd_language": "Изменить язык интерфейса",
         "cmd_help": "Показать справку",
         
         # Приветствия и общие фразы
         "welcome": "Привет! Я Terry - сборник моделей AI. Используй /newchat для начала нового разговора с текстовыми моделями или /image для генерации изображений.",
         "error_occurred": "Произошла ошибка: {}",
+        "request_timeout": "Модель не ответила вовремя. Попробуйте еще раз или выберите другую модель.",
         
         # Выбор модели
         "select_text_model": "Выберите текстовую модель для разговора:",
@@ -29,6 +31,7 @@ TRANSLATIONS = {
         "system_prompt_question": "Хотите задать системный промпт?{}",
         "set_system_prompt": "Задать системный промпт",
         "no_system_prompt": "Без системного промпта",
+        "preset_unavailable": "Этот готовый промпт больше недоступен. Выберите модель заново через /newchat.",
         "send_system_prompt": "Пожалуйста, отправьте свой системный промпт в следующем сообщении.",
         "system_prompt_set": "Системный промпт установлен. Новый чат создан с моделью {}.\nОтправьте сообщение, чтобы начать разговор.",
         "chat_created_no_prompt": "Новый чат создан с моделью {}.\nСистемный промпт не установлен. Отправьте сообщение, чтобы начать разговор.",
@@ -40,6 +43,8 @@ TRANSLATIONS = {
         "no_image_found": "Не найдено изображение для анализа. Пожалуйста, отправьте изображение вместе с вопросом.",
         "image_error": "Произошла ошибка при анализе изображения: {}",
         "generated_with": "Сгенерировано с помощью {}",
+        "image_variants_set": "Количество вариантов изображения: {}. Дополнительные модели: {}",
+        "image_variants_failed": "Не удалось сгенерировать ни одного варианта изображения",
         
         # Перевод
         "translation_mode_activated": "🌐 Перевод\n\nПожалуйста, укажите язык, на который нужно перевести текст (например, 'английский', 'немецкий', 'французский' и т.д.).",
@@ -59,6 +64,26 @@ TRANSLATIONS = {
         
         # Ошибки
         "select_model_first": "Пожалуйста, выберите модель с помощью команды /newchat перед началом разговора.",
+        "model_unavailable": "Эта модель больше недоступна. Выберите другую модель с помощью /newchat или /image.",
+        "quota_user_requests": "Вы отправили слишком много запросов. Попробуйте снова через {} мин.",
+        "quota_user_tokens": "Лимит объема запросов исчерпан. Попробуйте снова через {} мин. или начните новый разговор через /newchat, чтобы история была короче.",
+        "quota_user_images": "Лимит генерации изображений на сегодня исчерпан. Попробуйте снова через {} мин.",
+        "quota_group_requests": "В этом чате отправлено слишком много запросов. Попробуйте снова через {} мин.",
+        "quota_group_tokens": "Лимит объема запросов для этого чата исчерпан. Попробуйте снова через {} мин.",
+        "quota_group_images": "Лимит генерации изображений в этом чате на сегодня исчерпан. Попробуйте снова через {} мин.",
+        "quota_model": "Лимит запросов к модели {} исчерпан. Попробуйте снова через {} мин. или выберите другую модель.",
+        "quota_request_too_large": "История разговора слишком длинная для вашего лимита. Начните новый разговор через /newchat.",
+        "compare_select_models": "Выберите от 2 до {} моделей, ответы которых нужно сравнить, и нажмите «Сравнить».",
+        "compare_run_button": "▶️ Сравнить",
+        "compare_too_few": "Выберите хотя бы две модели.",
+        "compare_too_many": "Можно выбрать не больше {} моделей.",
+        "compare_send_prompt": "Отправьте вопрос, который нужно задать моделям: {}",
+        "compare_started": "Отправляю вопрос моделям: {}. Ответы придут по мере готовности.",
+        "compare_answer_error": "{}: не удалось получить ответ ({})",
+        "compare_adopt_button": "📌 Добавить этот ответ в разговор",
+        "compare_adopted": "Ответ {} добавлен в историю разговора.",
+        "compare_expired": "Это сравнение устарело или ответ уже выбран.",
+        "compare_done": "Сравнение завершено за {} с. Выберите ответ, который нужно добавить в разговор.",
         
         # Названия языков для отображения
         "language_name_ru": "Русский",
@@ -72,12 +97,14 @@ TRANSLATIONS = {
         "cmd_newchat": "Start a new text conversation",
         "cmd_image": "Generate images",
         "cmd_translate": "Translate text",
+        "cmd_compare": "Compare model answers",
         "cmd_language": "Change interface language",
         "cmd_help": "Show help",
         
         # Greetings and common phrases
         "welcome": "Hello! I'm Terry - a collection of AI models. Use /newchat to start a new conversation with text models or /image to generate images.",
         "error_occurred": "An error occurred: {}",
+        "request_timeout": "The model did not respond in time. Please try again or choose another model.",
         
         # Model selection
         "select_text_model": "Choose a text model for conversation:",
@@ -92,6 +119,7 @@ TRANSLATIONS = {
         "system_prompt_question": "Do you want to set a system prompt?{}",
         "set_system_prompt": "Set system prompt",
         "no_system_prompt": "No system prompt",
+        "preset_unavailable": "This preset prompt is no longer available. Please choose the model again with /newchat.",
         "send_system_prompt": "Please send your system prompt in the next message.",
         "system_prompt_set": "System prompt set. New chat created with model {}.\nSend a message to start the conversation.",
         "chat_created_no_prompt": "New chat created with model {}.\nNo system prompt set. Send a message to start the conversation.",
@@ -103,6 +131,8 @@ TRANSLATIONS = {
         "no_image_found": "No image found for analysis. Please send an image with your question.",
         "image_error": "An error occurred while analyzing the image: {}",
         "generated_with": "Generated with {}",
+        "image_variants_set": "Number of image variants: {}. Additional models: {}",
+        "image_variants_failed": "Failed to generate any image variant",
         
         # Translation
         "translation_mode_activated": "🌐 Translation\n\nPlease specify the language to translate to (for example, 'English', 'German', 'French', etc.).",
@@ -122,6 +152,26 @@ TRANSLATIONS = {
         
         # Errors
         "select_model_first": "Please select a model using the /newchat command before starting a conversation.",
+        "model_unavailable": "This model is no longer available. Please choose another one with /newchat or /image.",
+        "quota_user_requests": "You have sent too many requests. Please try again in {} min.",
+        "quota_user_tokens": "Your request volume limit is used up. Please try again in {} min. or start a new conversation with /newchat to shorten the history.",
+        "quota_user_images": "Your image generation limit for today is used up. Please try again in {} min.",
+        "quota_group_requests": "Too many requests have been sent in this chat. Please try again in {} min.",
+        "quota_group_tokens": "The request volume limit of this chat is used up. Please try again in {} min.",
+        "quota_group_images": "The image generation limit of this chat for today is used up. Please try again in {} min.",
+        "quota_model": "The request limit for {} is used up. Please try again in {} min. or choose another model.",
+        "quota_request_too_large": "The conversation history is too long for your limit. Please start a new conversation with /newchat.",
+        "compare_select_models": "Choose 2 to {} models whose answers you want to compare and press “Compare”.",
+        "compare_run_button": "▶️ Compare",
+        "compare_too_few": "Please choose at least two models.",
+        "compare_too_many": "You can choose at most {} models.",
+        "compare_send_prompt": "Send the question to ask these models: {}",
+        "compare_started": "Sending the question to: {}. Answers will arrive as soon as they are ready.",
+        "compare_answer_error": "{}: failed to get an answer ({})",
+        "compare_adopt_button": "📌 Add this answer to the conversation",
+        "compare_adopted": "The answer of {} was added to the conversation history.",
+        "compare_expired": "This comparison is outdated or an answer has already been chosen.",
+        "compare_done": "Comparison finished in {} s. Choose the answer to add to the conversation.",
         
         # Language names for display
         "language_name_ru": "Russian",
@@ -135,12 +185,14 @@ TRANSLATIONS = {
         "cmd_newchat": "Пачаць новую размову",
         "cmd_image": "Стварыць выявы",
         "cmd_translate": "Перакласьці тэкст",
+        "cmd_compare": "Параўнаць адказы мадэляў",
         "cmd_language": "Зьмяніць мову інтэрфэйсу",
         "cmd_help": "Паказаць даведку",
 
         # Greetings and common phrases
         "welcome": "Прывітаньне! Я Terry - склад мадэляў AI. Выкарыстоўвайце /newchat для пачатку новай размовы з тэкставымі мадэлямі або /image для стварэньня выявы.",
         "error_occurred": "Адбылася памылка: {}",
+        "request_timeout": "Мадэль не адказала своечасова. Паспрабуйце яшчэ раз або выберыце іншую мадэль.",
 
         # Model selection
         "select_text_model": "Выберыце тэкставую мадэль для размовы:",
@@ -155,6 +207,7 @@ TRANSLATIONS = {
         "system_prompt_question": "Хочаце задаць сыстэмны прампт?{}",
         "set_system_prompt": "Задаць сыстэмны прампт",
         "no_system_prompt": "Без сыстэмнага прампту",
+        "preset_unavailable": "Гэты гатовы прампт больш недаступны. Выберыце мадэль зноў праз /newchat.",
         "send_system_prompt": "Адпраўце свой сыстэмны прампт у наступным паведамленьні.",
         "system_prompt_set": "Сыстэмны прампт усталяваны. Новая размова створаная з мадэльлю {}.\nАдпраўце паведамленьне, каб пачаць размову.",
         "chat_created_no_prompt": "Новая размова створаная з мадэльлю {}.\nСыстэмны прампт не ўсталяваны. Адпраўце паведамленьне, каб пачаць размову.",
@@ -166,6 +219,8 @@ TRANSLATIONS = {
         "no_image_found": "Выява ня знойдзеная для аналізу. Адпраўце выяву з пытаньнем.",
         "image_error": "Адбылася памылка пры аналізе выявы: {}",
         "generated_with": "Створана з дапамогай {}",
+        "image_variants_set": "Колькасьць варыянтаў выявы: {}. Дадатковыя мадэлі: {}",
+        "image_variants_failed": "Не атрымалася стварыць ніводнага варыянту выявы",
         
         # Translation
         "translation_mode_activated": "🌐 Пераклад\n\nКалі ласка, укажыце мову, на якую вы хочаце перакласьці (напрыклад, 'ангельская', 'нямецкая', 'француская' і г.д.).",
@@ -185,6 +240,26 @@ TRANSLATIONS = {
         
         # Errors
         "select_model_first": "Выберыце мадэль праз /newchat перад пачаткам размовы.",
+        "model_unavailable": "Гэтая мадэль больш недаступная. Выберыце іншую мадэль праз /newchat або /image.",
+        "quota_user_requests": "Вы адправілі занадта шмат запытаў. Паспрабуйце зноў праз {} хв.",
+        "quota_user_tokens": "Ліміт аб'ёму запытаў вычарпаны. Паспрабуйце зноў праз {} хв. або пачніце новую размову праз /newchat, каб гісторыя была карацейшай.",
+        "quota_user_images": "Ліміт генерацыі выяў на сёння вычарпаны. Паспрабуйце зноў праз {} хв.",
+        "quota_group_requests": "У гэтым чаце адпраўлена занадта шмат запытаў. Паспрабуйце зноў праз {} хв.",
+        "quota_group_tokens": "Ліміт аб'ёму запытаў для гэтага чата вычарпаны. Паспрабуйце зноў праз {} хв.",
+        "quota_group_images": "Ліміт генерацыі выяў у гэтым чаце на сёння вычарпаны. Паспрабуйце зноў праз {} хв.",
+        "quota_model": "Ліміт запытаў да мадэлі {} вычарпаны. Паспрабуйце зноў праз {} хв. або выберыце іншую мадэль.",
+        "quota_request_too_large": "Гісторыя размовы занадта доўгая для вашага ліміту. Пачніце новую размову праз /newchat.",
+        "compare_select_models": "Выберыце ад 2 да {} мадэляў, адказы якіх трэба параўнаць, і націсніце «Параўнаць».",
+        "compare_run_button": "▶️ Параўнаць",
+        "compare_too_few": "Выберыце хаця б дзве мадэлі.",
+        "compare_too_many": "Можна выбраць не больш за {} мадэляў.",
+        "compare_send_prompt": "Адпраўце пытанне, якое трэба задаць мадэлям: {}",
+        "compare_started": "Адпраўляю пытанне мадэлям: {}. Адказы прыйдуць па меры гатоўнасці.",
+        "compare_answer_error": "{}: не атрымалася атрымаць адказ ({})",
+        "compare_adopt_button": "📌 Дадаць гэты адказ у размову",
+        "compare_adopted": "Адказ {} дададзены ў гісторыю размовы.",
+        "compare_expired": "Гэта параўнанне састарэла або адказ ужо выбраны.",
+        "compare_done": "Параўнанне скончана за {} с. Выберыце адказ, які трэба дадаць у размову.",
         
         # Language names for display
         "language_name_ru": "Расейская",